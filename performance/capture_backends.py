@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Compare the capture backends of the background writer.
+
+Writes the same synthetic events (function calls with line snapshots and
+their objects) through the ORM and the raw sqlite3 capture stores and reports
+rows per second for each.
+"""
+import argparse
+import json
+import time
+
+from spacetimepy.core.capture_store import create_capture_store
+from spacetimepy.core.models import init_db
+from spacetimepy.core.representation import ObjectManager
+from spacetimepy.core.writer import CallEnd, CallStart, Snapshot, build_batch
+
+
+def make_events(object_manager, calls, snapshots_per_call):
+    """Build the events a line-monitored function would produce"""
+    events = []
+    submitted_refs = set()
+    snapshot_id = 0
+
+    def capture(value, objects):
+        ref, prepared = object_manager.prepare(value, submitted_refs)
+        if prepared is not None:
+            submitted_refs.add(ref)
+            objects.append(prepared)
+        return ref
+
+    for call_id in range(1, calls + 1):
+        objects = []
+        locals_refs = {"n": capture(call_id, objects), "data": capture([call_id], objects)}
+        events.append((objects, CallStart(
+            id=call_id, function="simple_function", file=__file__, line=1,
+            start_ns=time.time_ns(), locals_refs=locals_refs, globals_refs={},
+            code_definition_id=None, call_metadata=None, parent_call_id=None, session_id=None,
+            order_in_session=call_id - 1, order_in_parent=None
+        )))
+        previous_id = None
+        for order in range(snapshots_per_call):
+            snapshot_id += 1
+            objects = []
+            locals_refs = {"i": capture(order, objects), "data": capture([call_id, order], objects)}
+            events.append((objects, Snapshot(
+                id=snapshot_id, function_call_id=call_id, line_number=order + 2,
+                timestamp_ns=time.time_ns(), locals_refs=locals_refs, globals_refs={},
+                order_in_call=order, previous_snapshot_id=previous_id
+            )))
+            previous_id = snapshot_id
+        objects = []
+        events.append((objects, CallEnd(call_id, time.time_ns(), capture(call_id * 2, objects), None)))
+    return events
+
+
+def count_rows(events):
+    """Number of rows inserted for a list of events (objects, identities, calls, snapshots)"""
+    objects = {prepared.ref: prepared for event_objects, _ in events for prepared in event_objects}
+    identities = {prepared.identity_hash for prepared in objects.values()}
+    records = sum(1 for _, record in events if not isinstance(record, CallEnd))
+    return len(objects) + len(identities) + records
+
+
+def run(backend, calls, snapshots_per_call, batch_size):
+    Session = init_db(":memory:")
+    session = Session()
+    object_manager = ObjectManager(session)
+    events = make_events(object_manager, calls, snapshots_per_call)
+
+    # Batch the events like the writer does, without its thread, to time the store only
+    store = create_capture_store(backend, session, object_manager)
+
+    t1 = time.perf_counter()
+    for start in range(0, len(events), batch_size):
+        store.write(build_batch(events[start:start + batch_size]))
+        session.commit()
+    elapsed = time.perf_counter() - t1
+
+    session.close()
+    rows = count_rows(events)
+    return {"backend": backend, "rows": rows, "seconds": elapsed, "rows_per_second": rows / elapsed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--snapshots", type=int, default=10, help="Snapshots per call")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    results = [run(backend, args.calls, args.snapshots, args.batch_size) for backend in ("orm", "sqlite")]
+    for result in results:
+        print(f"{result['backend']:>6}: {result['rows']} rows in {result['seconds']:.3f}s "
+              f"({result['rows_per_second']:.0f} rows/s)")
+
+    with open("capture_backends.json", "w") as f:
+        json.dump(results, f)
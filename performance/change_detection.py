@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Measure what the change detector saves when values are captured again.
+
+For each type of value, times ObjectManager.store with the change detector
+("detector") and without it ("strict", every value pickled and hashed):
+"unchanged" stores the same value again, as line snapshots do most of the
+time, and "changed" mutates one element before each store, so that every
+store is a new version and the fingerprint is pure overhead.
+
+The detector compares elements by identity in Python: it wins when pickling
+is expensive for the number of elements (long strings, objects with many
+attributes) and loses on nested structures of small values, which is why the
+monitor only enables it with strict=False.
+"""
+import argparse
+import json
+import time
+
+from spacetimepy.core.change_detection import ChangeDetector
+from spacetimepy.core.models import init_db
+from spacetimepy.core.representation import ObjectManager
+
+
+class Point:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+        self.history = [(x - i, y + i) for i in range(20)]
+
+
+def make_values(size):
+    """Values of each captured type, of roughly the given number of elements"""
+    return {
+        "list": list(range(size)),
+        "strings": [f"item{i}" for i in range(size)],
+        "documents": [f"document {i} " * 1000 for i in range(size // 10)],
+        "dict": {f"key{i}": i for i in range(size)},
+        "nested": [{"id": i, "tags": ["a", "b"], "point": (i, i)} for i in range(size // 10)],
+        "objects": [Point(i, i) for i in range(size // 10)],
+        "custom": Point(1, 2),
+    }
+
+
+def mutate(value, i):
+    """Change one element of a value"""
+    if isinstance(value, list):
+        element = value[len(value) // 2]
+        if isinstance(element, dict):
+            element["id"] = i
+        elif isinstance(element, Point):
+            element.x = i
+        else:
+            value[len(value) // 2] = i
+    elif isinstance(value, dict):
+        value[next(iter(value))] = i
+    else:
+        value.x = i
+
+
+def time_store(manager, value, repeat, changed):
+    manager.store(value)
+    total = 0
+    for i in range(repeat):
+        if changed:
+            mutate(value, -i - 1)
+        t1 = time.perf_counter_ns()
+        manager.store(value)
+        total += time.perf_counter_ns() - t1
+    return total / repeat / 1000
+
+
+def run(size, repeat):
+    results = {}
+    for type_name in make_values(size):
+        results[type_name] = {}
+        for mode in ("strict", "detector"):
+            for changed in (False, True):
+                session = init_db(":memory:")()
+                manager = ObjectManager(session)
+                manager.changes = ChangeDetector() if mode == "detector" else None
+                value = make_values(size)[type_name]
+                column = f"{mode} {'changed' if changed else 'unchanged'}"
+                results[type_name][column] = time_store(manager, value, repeat, changed)
+                session.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=1000, help="Elements per value")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    results = run(args.size, args.repeat)
+    columns = ["strict unchanged", "detector unchanged", "strict changed", "detector changed"]
+    print(f"{'type':>9} " + " ".join(f"{column:>19}" for column in columns) + "   (us per store)")
+    for type_name, timings in results.items():
+        print(f"{type_name:>9} " + " ".join(f"{timings[column]:>19.1f}" for column in columns))
+
+    with open("change_detection.json", "w") as f:
+        json.dump(results, f)
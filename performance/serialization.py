@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Compare the cost of serializing captured values, per type of value.
+
+"before" pickles a value twice, once for its reference and once for its
+stored payload, as the object manager used to. The other columns time
+ObjectManager.prepare, which pickles once and hashes that pickle with each
+available hash function.
+"""
+import argparse
+import hashlib
+import json
+import time
+
+from spacetimepy.core.models import init_db
+from spacetimepy.core.representation import HASH_FUNCTIONS, ObjectManager, PickleConfig
+
+
+class Point:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+        self.history = [(x - i, y + i) for i in range(20)]
+
+
+def make_values(size):
+    """Values of each captured type, of roughly the given number of elements"""
+    return {
+        "list": list(range(size)),
+        "dict": {f"key{i}": i for i in range(size)},
+        "tuple": tuple(str(i) for i in range(size)),
+        "bytes": bytes(size * 8),
+        "nested": [{"id": i, "tags": ["a", "b"], "point": (i, i)} for i in range(size // 10)],
+        "custom": Point(1, 2),
+    }
+
+
+def time_per_value(function, value, repeat):
+    t1 = time.perf_counter_ns()
+    for _ in range(repeat):
+        function(value)
+    return (time.perf_counter_ns() - t1) / repeat / 1000
+
+
+def before(config):
+    """Reference and payload pickled separately"""
+    def serialize(value):
+        hashlib.md5(config.dumps(value)).hexdigest()
+        config.dumps(value, type(value).__module__)
+    return serialize
+
+
+def run(size, repeat):
+    session = init_db(":memory:")()
+    manager = ObjectManager(session)
+    results = {}
+    for type_name, value in make_values(size).items():
+        results[type_name] = {"before": time_per_value(before(PickleConfig()), value, repeat)}
+        for name, hasher in sorted(HASH_FUNCTIONS.items()):
+            manager.hasher = hasher
+            results[type_name][name] = time_per_value(manager.prepare, value, repeat)
+    session.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=1000, help="Elements per value")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    results = run(args.size, args.repeat)
+    columns = ["before", *sorted(HASH_FUNCTIONS)]
+    print(f"{'type':>8} " + " ".join(f"{column:>10}" for column in columns) + "   (us per value)")
+    for type_name, timings in results.items():
+        print(f"{type_name:>8} " + " ".join(f"{timings[column]:>10.1f}" for column in columns))
+
+    with open("serialization.json", "w") as f:
+        json.dump(results, f)
@@ -3,18 +3,27 @@ SpaceTimePy - A Python execution monitoring and analysis tool.
 """
 
 from .core import (
+    CaptureBudget,
+    CheckpointPolicy,
+    ChunkPolicy,
     CodeDefinition,
     CodeManager,
     CodeObjectLink,
+    CommitPolicy,
     FunctionCall,
     FunctionCallRepository,
     MonitoringSession,
     ObjectIdentity,
     ObjectManager,
+    OverheadGovernor,
+    ProcessShard,
     PyMonitoring,  # Backward compatibility alias
+    RefIndex,
+    Sampler,
     SpaceTimeMonitor,
     StackSnapshot,
     StoredObject,
+    ValueSummary,
     disable_recording,
     enable_recording,
     end_session,
@@ -25,6 +34,7 @@ from .core import (
     load_execution_data,
     load_snapshot,
     load_snapshot_in_frame,
+    merge_shards,
     pymonitor,
     reanimate_function,
     recording_context,
@@ -76,6 +86,14 @@ __all__ = [
     'FunctionCallRepository',
     'CodeManager',
     'ObjectManager',
+    'CommitPolicy',
+    'Sampler',
+    'OverheadGovernor',
+    'CaptureBudget',
+    'ValueSummary',
+    'CheckpointPolicy',
+    'RefIndex',
+    'ChunkPolicy',
     #decorators
     'pymonitor',
     'function',
@@ -89,6 +107,7 @@ __all__ = [
     'CodeDefinition',
     'CodeObjectLink',
     'MonitoringSession',
+    'ProcessShard',
     # Monitoring
     'init_monitoring',
     'pymonitor',
@@ -107,6 +126,8 @@ __all__ = [
     'load_snapshot',
     'load_snapshot_in_frame',
     'replay_session_from',
+    # Process shards
+    'merge_shards',
     # API functionality
     'start_api',
     'refresh_api_database',
@@ -3,23 +3,24 @@ Core functionality for SpaceTimePy.
 This module contains the core implementation of the monitoring system.
 """
 
+from .checkpoint import CheckpointPolicy
+from .chunking import ChunkPolicy
 from .code_manager import CodeManager
 from .function_call import FunctionCallRepository
+from .governor import OverheadGovernor
 from .models import (
     CodeDefinition,
     CodeObjectLink,
     FunctionCall,
     MonitoringSession,
     ObjectIdentity,
+    ProcessShard,
     StackSnapshot,
     StoredObject,
     export_db,
     init_db,
 )
-from .monitoring import SpaceTimeMonitor, init_monitoring, pymonitor, function, line
-
-# Backward compatibility alias
-PyMonitoring = SpaceTimeMonitor
+from .monitoring import SpaceTimeMonitor, function, init_monitoring, line, pymonitor
 from .reanimation import (
     load_execution_data,
     load_snapshot,
@@ -28,9 +29,17 @@ from .reanimation import (
     replay_session_from,
     run_with_state,
 )
+from .ref_index import RefIndex
 from .representation import ObjectManager
+from .sampling import Sampler
 from .session import end_session, session_context, start_session
+from .shards import find_shards, merge_shards, shard_path
+from .summaries import CaptureBudget, ValueSummary
 from .trace import TraceExporter
+from .writer import CaptureWriter, CommitPolicy
+
+# Backward compatibility alias
+PyMonitoring = SpaceTimeMonitor
 
 
 # Recording control helper functions
@@ -117,6 +126,15 @@ __all__ = [
     'CodeManager',
     'ObjectManager',
     'TraceExporter',
+    'CaptureWriter',
+    'CommitPolicy',
+    'Sampler',
+    'OverheadGovernor',
+    'CaptureBudget',
+    'ValueSummary',
+    'CheckpointPolicy',
+    'RefIndex',
+    'ChunkPolicy',
     # Models
     'StoredObject',
     'ObjectIdentity',
@@ -125,6 +143,7 @@ __all__ = [
     'CodeDefinition',
     'CodeObjectLink',
     'MonitoringSession',
+    'ProcessShard',
     # Session management
     'start_session',
     'end_session',
@@ -140,4 +159,8 @@ __all__ = [
     'load_snapshot_in_frame',
     'run_with_state',
     'replay_session_from',
+    # Process shards
+    'shard_path',
+    'find_shards',
+    'merge_shards',
 ]
@@ -0,0 +1,305 @@
+"""
+Per-code-object capture plans.
+
+A CapturePlan gathers everything the monitoring callbacks need to know about a
+monitored code object and that does not change between calls: argument names,
+ignored variables, hooks, the lines to snapshot, how calls are sampled and
+which functions track it, and the compiled accessors of the watched paths.
+Plans are compiled when a function is decorated so that the callbacks only do
+a single dict lookup keyed by the code object.
+
+A GlobalsClosure does the same for the global variables a code object (and
+the functions it calls) reads.
+"""
+
+import ast
+import dis
+import linecache
+import operator
+import types
+from collections.abc import Callable, Iterable, Mapping
+from typing import Any
+
+from .sampling import Sampler
+
+PlanKey = tuple[str, str]  # (co_filename, co_qualname)
+
+_MISSING = object()
+
+# Instructions that can run arbitrary code or mutate an object in place
+# (besides every opcode whose name contains CALL). Item and attribute reads
+# run __getitem__, __missing__, __getattr__ or properties, which can mutate
+# their receiver (a defaultdict inserts missing keys), and unpacking advances
+# iterators.
+_IMPURE_OPNAMES = frozenset({
+    "STORE_SUBSCR", "STORE_SLICE", "STORE_ATTR", "DELETE_SUBSCR", "DELETE_ATTR",
+    "BINARY_SUBSCR", "BINARY_SLICE", "LOAD_ATTR", "LOAD_SUPER_ATTR", "UNPACK_SEQUENCE", "UNPACK_EX",
+    "FOR_ITER", "SEND", "YIELD_VALUE", "GET_AWAITABLE", "GET_ANEXT", "END_ASYNC_FOR",
+    "BEFORE_WITH", "BEFORE_ASYNC_WITH", "WITH_EXCEPT_START", "CLEANUP_THROW",
+    "IMPORT_NAME", "IMPORT_FROM", "LOAD_BUILD_CLASS",
+})
+
+
+def plan_key(code: types.CodeType) -> PlanKey:
+    """Return the key identifying a function across reloads of its module.
+
+    Unlike the bare function name, the key tells apart same-named functions
+    defined in different modules or classes.
+    """
+    return (code.co_filename, code.co_qualname)
+
+
+def tagged_lines(code: types.CodeType, tag: str = "#tag") -> frozenset[int]:
+    """Return the lines of a code object whose source contains the tag comment"""
+    linecache.checkcache(code.co_filename)
+    lines = {line for _, _, line in code.co_lines() if line is not None}
+    return frozenset(line for line in lines if tag in linecache.getline(code.co_filename, line))
+
+
+def pure_lines(code: types.CodeType) -> frozenset[int]:
+    """Return the lines of a code object that cannot mutate objects in place.
+
+    A line is impure if it calls something, reads or stores an item or
+    attribute, applies an in-place operator, iterates, unpacks, yields or
+    imports. Rebinding a name is not a mutation. Other operators are assumed
+    to be free of side effects.
+    """
+    lines = set()
+    impure = set()
+    for instruction in dis.get_instructions(code):
+        line = instruction.positions.lineno if instruction.positions is not None else None
+        if line is None:
+            # Exception cleanup, it only rebinds names
+            continue
+        lines.add(line)
+        opname = instruction.opname
+        if ("CALL" in opname or opname in _IMPURE_OPNAMES
+                # In-place operators, and subscripts from Python 3.14 on
+                or (opname == "BINARY_OP" and (instruction.argrepr.endswith("=") or instruction.argrepr == "[]"))):
+            impure.add(line)
+    return frozenset(lines - impure)
+
+
+class WatchPath:
+    """Compiled accessor of a watched variable, attribute path or item path.
+
+    A path is a variable name followed by attribute reads and subscripts with
+    literal keys, e.g. ``bird_rect.y``, ``pipes[-1].x`` or ``state["score"]``.
+
+    Args:
+        path: The path, used as the name of the captured value
+    """
+
+    __slots__ = ("path", "root", "steps")
+
+    def __init__(self, path: str):
+        self.path = path
+        steps: list[Callable[[Any], Any]] = []
+        try:
+            node = ast.parse(path.strip(), mode="eval").body
+        except SyntaxError as e:
+            raise ValueError(f"Invalid watch path: {path!r}") from e
+        while True:
+            match node:
+                case ast.Name(id=root):
+                    break
+                case ast.Attribute(value=node, attr=attr):
+                    steps.append(operator.attrgetter(attr))
+                case ast.Subscript(value=node, slice=key_node):
+                    try:
+                        key = ast.literal_eval(key_node)
+                    except ValueError as e:
+                        raise ValueError(f"Invalid watch path: {path!r}, subscripts must be literals") from e
+                    steps.append(operator.itemgetter(key))
+                case _:
+                    raise ValueError(f"Invalid watch path: {path!r}, only names, attributes and subscripts are allowed")
+        self.root = root
+        self.steps = tuple(reversed(steps))
+
+    def read(self, value: Any) -> Any:
+        """Follow the path from the value of the root variable"""
+        for step in self.steps:
+            value = step(value)
+        return value
+
+    def __repr__(self):
+        return f"WatchPath({self.path!r})"
+
+
+def compile_watch(paths: Iterable[str | WatchPath] | None) -> tuple[WatchPath, ...] | None:
+    """Compile watched paths (None means every variable is captured)
+
+    Raises:
+        ValueError: If a path is not a name followed by attributes and literal subscripts
+    """
+    if paths is None:
+        return None
+    if isinstance(paths, str):
+        paths = [paths]
+    return tuple(path if isinstance(path, WatchPath) else WatchPath(path) for path in paths)
+
+
+class CapturePlan:
+    """Static capture information for one code object"""
+
+    __slots__ = (
+        "allowed_lines", "arg_names", "code", "func", "ignore", "key", "lines", "mode",
+        "pure_lines", "return_hooks", "sampler", "start_hooks", "tracking_keys", "use_tag_line", "watch",
+    )
+
+    def __init__(self, code: types.CodeType, func: Callable | None = None, mode: str = "function",
+                 ignore: Iterable[str] = (), start_hooks: Iterable[Callable] = (),
+                 return_hooks: Iterable[Callable] = (), lines: Iterable[int] | None = None,
+                 use_tag_line: bool = False, sampler: Sampler | None = None,
+                 watch: Iterable[str | WatchPath] | None = None):
+        self.code = code
+        self.key = plan_key(code)
+        self.func = func  # Function object, used to store its code definition
+        self.mode = mode
+        self.arg_names = code.co_varnames[:code.co_argcount]
+        self.ignore = frozenset(ignore)
+        self.start_hooks = tuple(start_hooks)
+        self.return_hooks = tuple(return_hooks)
+        self.lines = None if lines is None else frozenset(lines)
+        self.use_tag_line = use_tag_line
+
+        # Lines to snapshot in line mode (None means every line)
+        allowed = self.lines
+        if use_tag_line:
+            tagged = tagged_lines(code)
+            allowed = tagged if allowed is None else allowed & tagged
+        self.allowed_lines: frozenset[int] | None = allowed
+
+        # Lines after which the objects bound to locals are unchanged (line mode only)
+        self.pure_lines: frozenset[int] = pure_lines(code) if mode == "line" else frozenset()
+
+        # Decides which calls are recorded (None records every call)
+        self.sampler = sampler
+
+        # Only these paths are captured instead of every local and used global (None captures everything)
+        self.watch = compile_watch(watch)
+
+        # Keys of the functions tracking this one: if any, it is only recorded
+        # while one of them is running
+        self.tracking_keys: set[PlanKey] = set()
+
+    @classmethod
+    def for_function(cls, func: Any, **options) -> "CapturePlan":
+        """Compile the plan of a function object"""
+        return cls(func.__code__, func=func, **options)
+
+    def rebind(self, code: types.CodeType, func: Callable | None = None, **options) -> "CapturePlan":
+        """Compile the same options for another code object of the function (e.g. after a reload)
+
+        Keyword arguments override the options of this plan.
+        """
+        options = {
+            "mode": self.mode,
+            "ignore": self.ignore,
+            "start_hooks": self.start_hooks,
+            "return_hooks": self.return_hooks,
+            "lines": self.lines,
+            "use_tag_line": self.use_tag_line,
+            "sampler": self.sampler,
+            "watch": self.watch,
+            **options,
+        }
+        plan = CapturePlan(code, func=func, **options)
+        plan.tracking_keys = self.tracking_keys
+        return plan
+
+    def watched_values(self, frame_locals: Mapping[str, Any], frame_globals: dict) -> tuple[dict[str, Any], dict[str, Any]]:
+        """Read the watched paths in a frame.
+
+        A path whose root is a local variable is a local, otherwise it is read
+        from the globals. Paths that cannot be read (unbound variable, missing
+        attribute, index out of range) are left out.
+
+        Returns:
+            Tuple (locals, globals) of dictionaries of paths to values
+        """
+        watched_locals: dict[str, Any] = {}
+        watched_globals: dict[str, Any] = {}
+        for watch in self.watch or ():
+            if watch.root in frame_locals:
+                values, value = watched_locals, frame_locals[watch.root]
+            elif watch.root in frame_globals:
+                values, value = watched_globals, frame_globals[watch.root]
+            else:
+                continue
+            try:
+                values[watch.path] = watch.read(value)
+            except (AttributeError, LookupError, TypeError):
+                continue
+        return watched_locals, watched_globals
+
+    @property
+    def is_tracked(self) -> bool:
+        """Whether the function is only recorded inside the functions tracking it"""
+        return bool(self.tracking_keys)
+
+    def __repr__(self):
+        return f"CapturePlan({self.key[1]!r}, mode={self.mode!r})"
+
+
+class GlobalsClosure:
+    """Transitive global variables read by a code object.
+
+    The closure follows the global functions called by the code, recursively,
+    and records where each global variable lives. Names bound to functions or
+    modules, and names that were missing, are recorded as guards: as long as
+    they keep the same binding the closure is valid and the current values of
+    the variables are a handful of dict reads away.
+
+    Args:
+        code: The code object to analyze
+        globals: The globals dictionary the code runs with
+        accessed_names: Function returning the global names read by a code object
+    """
+
+    __slots__ = ("globals", "guards", "variables")
+
+    def __init__(self, code: types.CodeType, globals: dict,
+                 accessed_names: Callable[[types.CodeType], Iterable[str]]):
+        self.globals = globals
+        self.variables: list[tuple[dict, str]] = []  # (globals dict, name) of each variable
+        self.guards: list[tuple[dict, str, Any, types.CodeType | None]] = []  # (globals dict, name, bound object, its code)
+        self._collect(code, globals, accessed_names, {code})
+
+    def _collect(self, code, globals, accessed_names, visited):
+        for name in accessed_names(code):
+            value = globals.get(name, _MISSING)
+            if value is _MISSING or isinstance(value, types.ModuleType):
+                self.guards.append((globals, name, value, None))
+            elif isinstance(value, types.FunctionType):
+                func_code = value.__code__
+                self.guards.append((globals, name, value, func_code))
+                # Follow the called function once
+                if func_code not in visited:
+                    visited.add(func_code)
+                    self._collect(func_code, value.__globals__, accessed_names, visited)
+            else:
+                self.variables.append((globals, name))
+
+    def is_valid(self) -> bool:
+        """Whether every function, module and missing name still has the same binding"""
+        for globals, name, expected, code in self.guards:
+            value = globals.get(name, _MISSING)
+            if value is not expected or (code is not None and value.__code__ is not code):
+                return False
+        return True
+
+    def resolve(self) -> dict[str, Any] | None:
+        """Return the current values of the variables.
+
+        Returns:
+            Dictionary of variable names to values, or None if a variable was
+            deleted or rebound to a function or module (the closure must be rebuilt)
+        """
+        values = {}
+        for globals, name in self.variables:
+            value = globals.get(name, _MISSING)
+            if value is _MISSING or isinstance(value, types.FunctionType | types.ModuleType):
+                return None
+            values[name] = value
+        return values
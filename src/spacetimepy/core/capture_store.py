@@ -0,0 +1,292 @@
+"""
+Capture-side persistence backends used by the CaptureWriter.
+
+Both backends write the tables defined in models.py. The ORM backend goes
+through the SQLAlchemy session, the sqlite backend bypasses the unit of work
+and issues prepared ``executemany`` statements on the raw sqlite3 connection
+behind the session. The read side (web API, reanimation, explorers) keeps using
+the ORM models in both cases.
+"""
+
+import json
+import logging
+from datetime import datetime
+from typing import Any, NamedTuple
+
+from sqlalchemy import insert, update
+from sqlalchemy.orm import Session
+
+from .models import FunctionCall, StackSnapshot
+from .representation import ObjectManager, PreparedObject
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_BACKENDS = ("orm", "sqlite")
+
+# Same text format as the SQLAlchemy SQLite DateTime type, so that rows written
+# by both backends are read back identically by the ORM
+SQLITE_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER for IN (...) lookups
+_LOOKUP_CHUNK_SIZE = 500
+
+
+class CaptureBatch(NamedTuple):
+    """Rows of a batch of capture events, ready to be written"""
+    objects: list[PreparedObject]
+    code_definitions: list[dict[str, Any]]
+    calls: list[dict[str, Any]]  # New function_calls rows
+    snapshots: list[dict[str, Any]]  # New stack_snapshots rows
+    call_ends: list[dict[str, Any]]  # Updates of end_ns/return_ref/call_metadata/exception_ref by call id
+    first_snapshots: list[dict[str, Any]]  # Updates of first_snapshot_id by call id
+    next_snapshots: list[dict[str, Any]]  # Updates of next_snapshot_id by snapshot id
+
+
+class OrmCaptureStore:
+    """Write capture batches through the SQLAlchemy session"""
+
+    def __init__(self, session: Session, object_manager: ObjectManager):
+        self.session = session
+        self.object_manager = object_manager
+
+    def write(self, batch: CaptureBatch):
+        for prepared in batch.objects:
+            self.object_manager.store_prepared(prepared)
+        for definition in batch.code_definitions:
+            self.object_manager.store_code_definition(**definition)
+
+        # Objects are flushed by the object manager, rows referencing them come after
+        self.session.flush()
+        if batch.calls:
+            self.session.execute(insert(FunctionCall), batch.calls)
+        if batch.snapshots:
+            self.session.execute(insert(StackSnapshot), batch.snapshots)
+        if batch.call_ends:
+            self.session.execute(update(FunctionCall), batch.call_ends)
+        if batch.first_snapshots:
+            self.session.execute(update(FunctionCall), batch.first_snapshots)
+        if batch.next_snapshots:
+            self.session.execute(update(StackSnapshot), batch.next_snapshots)
+
+    def clear_cache(self):
+        self.object_manager.clear_cache()
+
+
+class SqliteCaptureStore:
+    """Write capture batches with executemany on the raw sqlite3 connection.
+
+    The statements run on the connection of the session, inside its current
+    transaction, so commits and rollbacks of the session apply to them.
+    Objects are written with the same identity and version semantics as
+    ObjectManager.store(), and the stored refs and identities are shared with
+    it through its ref index.
+    """
+
+    def __init__(self, session: Session, object_manager: ObjectManager):
+        self.session = session
+        self.object_manager = object_manager
+        self._class_code_refs: dict[type, str | None] = {}  # Class definition stored for each class
+
+    def _connection(self):
+        """Return the raw sqlite3 connection of the session's transaction"""
+        return self.session.connection().connection.driver_connection
+
+    def write(self, batch: CaptureBatch):
+        # Make pending ORM changes (sessions, class definitions) visible first
+        self.session.flush()
+        cursor = self._connection().cursor()
+        try:
+            new_objects = self._write_objects(cursor, batch.objects)
+            if batch.code_definitions:
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO code_definitions (id, name, type, module_path, code_content, first_line_no, creation_time) "
+                    "VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                    [(ObjectManager.code_definition_id(d["code_content"]), d["name"], d["type"], d["module_path"],
+                      d["code_content"], d["first_line_no"]) for d in batch.code_definitions]
+                )
+            if batch.calls:
+                cursor.executemany(
+                    "INSERT INTO function_calls (id, function, file, line, start_ns, end_ns, call_metadata, "
+                    "locals_refs, globals_refs, return_ref, exception_ref, code_definition_id, session_id, parent_call_id, "
+                    "order_in_parent, order_in_session, first_snapshot_id, thread_id, thread_name, task_name, process_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(c["id"], c["function"], c["file"], c["line"], c["start_ns"], c["end_ns"],
+                      _json(c["call_metadata"]), _json(c["locals_refs"]), _json(c["globals_refs"]), c["return_ref"],
+                      c["exception_ref"], c["code_definition_id"], c["session_id"], c["parent_call_id"], c["order_in_parent"],
+                      c["order_in_session"], c["first_snapshot_id"], c["thread_id"], c["thread_name"], c["task_name"], c["process_id"])
+                     for c in batch.calls]
+                )
+            if batch.snapshots:
+                cursor.executemany(
+                    "INSERT INTO stack_snapshots (id, function_call_id, line_number, timestamp_ns, locals_refs, "
+                    "globals_refs, order_in_call, is_keyframe, next_snapshot_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(s["id"], s["function_call_id"], s["line_number"], s["timestamp_ns"], _json(s["locals_refs"]),
+                      _json(s["globals_refs"]), s["order_in_call"], s["is_keyframe"], s["next_snapshot_id"])
+                     for s in batch.snapshots]
+                )
+            if batch.call_ends:
+                cursor.executemany(
+                    "UPDATE function_calls SET end_ns = ?, return_ref = ?, call_metadata = ?, exception_ref = ? WHERE id = ?",
+                    [(e["end_ns"], e["return_ref"], _json(e["call_metadata"]), e["exception_ref"], e["id"])
+                     for e in batch.call_ends]
+                )
+            if batch.first_snapshots:
+                cursor.executemany(
+                    "UPDATE function_calls SET first_snapshot_id = ? WHERE id = ?",
+                    [(f["first_snapshot_id"], f["id"]) for f in batch.first_snapshots]
+                )
+            if batch.next_snapshots:
+                cursor.executemany(
+                    "UPDATE stack_snapshots SET next_snapshot_id = ? WHERE id = ?",
+                    [(n["next_snapshot_id"], n["id"]) for n in batch.next_snapshots]
+                )
+        finally:
+            cursor.close()
+
+        self._link_classes(new_objects)
+
+    def _write_objects(self, cursor, objects: list[PreparedObject]) -> list[PreparedObject]:
+        """Write objects not stored yet and return them"""
+        index = self.object_manager.index
+        new_objects: dict[str, PreparedObject] = {}
+        for prepared in objects:
+            if prepared.ref not in index:
+                new_objects.setdefault(prepared.ref, prepared)
+        # Refs missing from the index may have been evicted or stored by an earlier run
+        self._drop_stored(cursor, new_objects)
+        if not new_objects:
+            return []
+
+        # Get or create identities
+        identities: dict[str, int] = {}  # Dict[identity_hash, object_identities.id] of the new objects
+        versions: dict[str, int] = {}  # Dict[identity_hash, latest version_number] of the new objects
+        missing: dict[str, str] = {}
+        for p in new_objects.values():
+            entry = index.identity(p.identity_hash)
+            if entry is not None:
+                identities[p.identity_hash], versions[p.identity_hash] = entry
+            else:
+                missing[p.identity_hash] = p.type_name
+        if missing:
+            self._load_identities(cursor, list(missing), identities)
+            to_create = [identity_hash for identity_hash in missing if identity_hash not in identities]
+            if to_create:
+                now = _datetime(datetime.now())
+                identity_ids = self.object_manager.identity_ids
+                if identity_ids is not None:
+                    # Share the allocator of the object manager so that both paths never collide
+                    rows = [(identity_ids.next(), identity_hash, missing[identity_hash], now) for identity_hash in to_create]
+                    cursor.executemany(
+                        "INSERT INTO object_identities (id, identity_hash, name, creation_time) VALUES (?, ?, ?, ?)", rows
+                    )
+                    identities.update((row[1], row[0]) for row in rows)
+                else:
+                    cursor.executemany(
+                        "INSERT INTO object_identities (identity_hash, name, creation_time) VALUES (?, ?, ?)",
+                        [(identity_hash, missing[identity_hash], now) for identity_hash in to_create]
+                    )
+                    self._load_identities(cursor, to_create, identities)
+                versions.update(dict.fromkeys(to_create, 0))
+            self._load_versions(cursor, [identities[h] for h in missing if h not in versions], identities, versions)
+
+        # Chunks are content addressed too, and shared by the versions of chunked objects
+        chunk_index = self.object_manager.chunk_index
+        chunks = {ref: data for p in new_objects.values() for ref, data in p.chunks if ref not in chunk_index}
+        if chunks:
+            cursor.executemany("INSERT OR IGNORE INTO object_chunks (id, data) VALUES (?, ?)", chunks.items())
+            for ref in chunks:
+                chunk_index.add(ref)
+
+        # Each new object is the next version of its identity, in the order of the batch
+        rows = []
+        for p in new_objects.values():
+            versions[p.identity_hash] += 1
+            rows.append((p.ref, identities[p.identity_hash], versions[p.identity_hash], p.type_name, p.is_primitive,
+                         p.primitive_value, p.pickle_data))
+        cursor.executemany(
+            "INSERT INTO stored_objects (id, identity_id, version_number, type_name, is_primitive, "
+            "primitive_value, pickle_data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        # Write through to the index
+        for p in new_objects.values():
+            index.add(p.ref)
+            index.set_identity(p.identity_hash, identities[p.identity_hash], versions[p.identity_hash])
+        return list(new_objects.values())
+
+    def _drop_stored(self, cursor, objects: dict[str, PreparedObject]):
+        """Remove the objects already in the database, e.g. evicted from the index, and index them"""
+        index = self.object_manager.index
+        refs = [ref for ref in objects if index.may_be_stored(ref)]
+        for start in range(0, len(refs), _LOOKUP_CHUNK_SIZE):
+            chunk = refs[start:start + _LOOKUP_CHUNK_SIZE]
+            placeholders = ", ".join("?" * len(chunk))
+            cursor.execute(f"SELECT id FROM stored_objects WHERE id IN ({placeholders})", chunk)
+            for (ref,) in cursor.fetchall():
+                del objects[ref]
+                index.add(ref)
+
+    def _load_versions(self, cursor, identity_ids: list[int], identities: dict[str, int], versions: dict[str, int]):
+        """Look up the latest version numbers (0 if none) of existing identities"""
+        latest: dict[int, int] = {}
+        for start in range(0, len(identity_ids), _LOOKUP_CHUNK_SIZE):
+            chunk = identity_ids[start:start + _LOOKUP_CHUNK_SIZE]
+            placeholders = ", ".join("?" * len(chunk))
+            cursor.execute(
+                f"SELECT identity_id, MAX(version_number) FROM stored_objects WHERE identity_id IN ({placeholders}) "
+                "GROUP BY identity_id", chunk
+            )
+            latest.update(cursor.fetchall())
+        ids = set(identity_ids)
+        for identity_hash, identity_id in identities.items():
+            if identity_id in ids:
+                versions[identity_hash] = latest.get(identity_id) or 0
+
+    def _load_identities(self, cursor, identity_hashes: list[str], identities: dict[str, int]):
+        for start in range(0, len(identity_hashes), _LOOKUP_CHUNK_SIZE):
+            chunk = identity_hashes[start:start + _LOOKUP_CHUNK_SIZE]
+            placeholders = ", ".join("?" * len(chunk))
+            cursor.execute(
+                f"SELECT identity_hash, id FROM object_identities WHERE identity_hash IN ({placeholders})", chunk
+            )
+            identities.update(cursor.fetchall())
+
+    def _link_classes(self, objects: list[PreparedObject]):
+        """Store class definitions of custom objects (through the ORM, it is rare)"""
+        code_manager = self.object_manager.code_manager
+        if code_manager is None:
+            return
+        for prepared in objects:
+            cls = prepared.value_class
+            if cls is None:
+                continue
+            try:
+                if cls not in self._class_code_refs:
+                    self._class_code_refs[cls] = code_manager.store_class(cls)
+                code_ref = self._class_code_refs[cls]
+                if code_ref:
+                    code_manager.link_object(prepared.ref, code_ref)
+            except Exception:
+                logger.exception("Error storing class definition")
+
+    def clear_cache(self):
+        """Forget every cached row, e.g. after the session was rolled back"""
+        self._class_code_refs.clear()
+        self.object_manager.clear_cache()
+
+
+def create_capture_store(backend: str, session: Session, object_manager: ObjectManager):
+    """Create the capture store for a backend name ("orm" or "sqlite")"""
+    if backend == "orm":
+        return OrmCaptureStore(session, object_manager)
+    if backend == "sqlite":
+        return SqliteCaptureStore(session, object_manager)
+    raise ValueError(f"Invalid capture backend: {backend}. Must be one of {', '.join(CAPTURE_BACKENDS)}")
+
+
+def _datetime(value: datetime | None) -> str | None:
+    return value.strftime(SQLITE_DATETIME_FORMAT) if value is not None else None
+
+
+def _json(value: Any) -> str | None:
+    return json.dumps(value) if value is not None else None
@@ -0,0 +1,183 @@
+"""
+Change detection of captured values.
+
+Line snapshots capture the same lists, dicts and objects again and again,
+most of the time unchanged. A ChangeDetector remembers, per object, the
+elements it was made of and the ref it was stored under: when the object
+still holds the same elements at the next capture, its ref is reused
+without pickling.
+
+Elements are compared by identity, not by value: atomic elements (numbers,
+strings, bytes) are immutable, so the same objects are the same values, as
+are tuples of them. Only the mutable builtin containers and plain objects
+among the elements are compared recursively. The remembered elements are kept alive, so that their
+ids cannot be reused by other objects. Values the detector cannot describe
+(array-likes, objects with custom pickling, containers referenced twice, or
+more than max_items elements) are always pickled again.
+
+Comparing is a pass over the elements of each container, which costs about
+as much as pickling small atoms: the detector pays off for values whose
+pickle is expensive (large strings or bytes, many attributes), and is off
+unless the monitor runs with strict=False.
+"""
+
+import operator
+import threading
+from collections import OrderedDict, deque
+from typing import Any
+
+_ATOMS = frozenset((int, float, bool, str, bytes, type(None)))
+_SEQUENCES = frozenset((list, tuple, set, frozenset, deque))
+_IMMUTABLE = frozenset((tuple, frozenset))
+
+
+class _Unsupported(Exception):
+    """The value cannot be fingerprinted"""
+
+
+class Fingerprint:
+    """Elements of a container or plain object, and the fingerprints of those that are not atomic"""
+
+    __slots__ = ("children", "cls", "elements")
+
+    def __init__(self, cls: type, elements: tuple, children: tuple[tuple[int, "Fingerprint"], ...]):
+        self.cls = cls
+        self.elements = elements  # Kept alive, so that their ids are not reused
+        self.children = children  # (index, fingerprint) of the mutable containers and objects among the elements
+
+    @property
+    def frozen(self) -> bool:
+        """Whether the value cannot change: a tuple or frozenset of atoms and frozen values"""
+        return self.cls in _IMMUTABLE and not self.children
+
+
+class ChangeDetector:
+    """Reuse the refs of captured values that still hold the same elements.
+
+    Args:
+        max_entries: Number of objects remembered (least recently captured are forgotten)
+        max_items: Largest number of elements fingerprinted per value, larger values are rehashed
+        dispatch_table: Pickling reducers of the object manager, types in it are rehashed
+    """
+
+    def __init__(self, max_entries: int = 1024, max_items: int = 10_000, dispatch_table: dict | None = None):
+        if max_entries < 1 or max_items < 1:
+            raise ValueError("The change detector must keep at least one entry and one item")
+        self.max_entries = max_entries
+        self.max_items = max_items
+        self.dispatch_table = dispatch_table or {}
+        self._entries: OrderedDict[int, tuple[Any, Fingerprint, str]] = OrderedDict()  # Dict[id, (value, fingerprint, ref)]
+        self._plain_classes: dict[type, bool] = {}  # Whether instances of a class are pickled as their __dict__
+        self._lock = threading.Lock()  # Monitored threads capture concurrently, values are compared outside the lock
+        self.hits = 0
+        self.misses = 0
+
+    def _elements(self, value: Any, cls: type) -> tuple:
+        """Return what the pickle of a value is made of: elements, keys and values, or attributes"""
+        if cls in self.dispatch_table:
+            raise _Unsupported
+        if cls is dict:
+            return (*value, *value.values())
+        if cls in _SEQUENCES:
+            return tuple(value)
+        plain = self._plain_classes.get(cls)
+        if plain is None:
+            plain = self._plain_classes[cls] = _is_plain_class(cls)
+        if not plain:
+            raise _Unsupported
+        try:
+            attributes = vars(value)
+        except TypeError:
+            raise _Unsupported from None
+        return (*attributes, *attributes.values())
+
+    def fingerprint(self, value: Any) -> Fingerprint | None:
+        """Return the fingerprint of a value, or None if it cannot be fingerprinted"""
+        try:
+            return self._fingerprint(value, set(), [0])
+        except (_Unsupported, RuntimeError):  # RuntimeError: container changed size during iteration
+            return None
+
+    def _fingerprint(self, value: Any, visited: set[int], count: list[int]) -> Fingerprint:
+        if id(value) in visited:
+            raise _Unsupported  # Shared and recursive references change the pickle's memo
+        visited.add(id(value))
+        cls = type(value)
+        elements = self._elements(value, cls)
+        count[0] += len(elements)
+        if count[0] > self.max_items:
+            raise _Unsupported
+        children = []
+        if not _ATOMS.issuperset(map(type, elements)):
+            for i, element in enumerate(elements):
+                element_cls = type(element)
+                if element_cls in _ATOMS or (element_cls in _IMMUTABLE and _ATOMS.issuperset(map(type, element))):
+                    continue
+                child = self._fingerprint(element, visited, count)
+                if not child.frozen:  # The identity of a frozen value is enough
+                    children.append((i, child))
+        return Fingerprint(cls, elements, tuple(children))
+
+    def _unchanged(self, value: Any, fingerprint: Fingerprint) -> bool:
+        """Whether a value still holds the elements of its fingerprint"""
+        if type(value) is not fingerprint.cls:
+            return False
+        elements = self._elements(value, fingerprint.cls)
+        if len(elements) != len(fingerprint.elements) or not all(map(operator.is_, elements, fingerprint.elements)):
+            return False
+        for i, child in fingerprint.children:
+            if not self._unchanged(elements[i], child):
+                return False
+        return True
+
+    def check(self, value: Any) -> tuple[str | None, Fingerprint | None]:
+        """Return the ref of a value if it did not change since it was remembered, and its fingerprint"""
+        if type(value) in _ATOMS:
+            return None, None
+        entry = self._entries.get(id(value))
+        if entry is not None and entry[0] is value:
+            try:
+                unchanged = self._unchanged(value, entry[1])
+            except (_Unsupported, RuntimeError):
+                unchanged = False
+            if unchanged:
+                with self._lock:
+                    if id(value) in self._entries:
+                        self._entries.move_to_end(id(value))
+                    self.hits += 1
+                return entry[2], entry[1]
+        with self._lock:
+            self.misses += 1
+        return None, self.fingerprint(value)
+
+    def remember(self, value: Any, ref: str, fingerprint: Fingerprint | None):
+        """Remember the ref a value was stored under, with its fingerprint computed by check()"""
+        with self._lock:
+            if fingerprint is None:
+                self._entries.pop(id(value), None)
+                return
+            self._entries[id(value)] = (value, fingerprint, ref)
+            self._entries.move_to_end(id(value))
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Forget every remembered value"""
+        with self._lock:
+            self._entries.clear()
+
+
+_HEAPTYPE = 1 << 9  # Py_TPFLAGS_HEAPTYPE: class defined in Python
+
+
+def _is_plain_class(cls: type) -> bool:
+    """Whether instances of a class are pickled as their class and their __dict__"""
+    if hasattr(cls, "__slots__"):
+        return False
+    # Subclasses of builtin types (list, dict, Exception...) also pickle their builtin state
+    if not all(base is object or base.__flags__ & _HEAPTYPE for base in cls.__mro__):
+        return False
+    # Custom pickling may depend on anything
+    return (cls.__reduce_ex__ is object.__reduce_ex__ and cls.__reduce__ is object.__reduce__
+            and getattr(cls, "__getstate__", object.__getstate__) is object.__getstate__
+            and not hasattr(cls, "__getnewargs_ex__") and not hasattr(cls, "__getnewargs__"))
@@ -0,0 +1,305 @@
+"""
+Incremental checkpoints of the in-memory database.
+
+With ``in_memory=True`` captured rows live in a ``:memory:`` SQLite database
+that is backed up to ``db_path`` at shutdown. A Checkpointer persists them
+incrementally instead: at an interval, or once enough events were captured, the
+rows added since the last checkpoint are copied into the on-disk database,
+attached to the in-memory connection, with ``INSERT ... SELECT`` statements.
+
+Rows are tracked by rowid watermarks. Rows that can still change after they
+were copied (calls that did not end, the last snapshot of such calls,
+sessions) are copied again at the next checkpoint. Snapshots of ended calls
+can be evicted from memory once persisted, which bounds the memory of long
+running processes: the on-disk database is then the only complete copy.
+
+The same copy implements append mode, where the in-memory database starts
+empty instead of loading the existing file: its integer IDs continue after
+those of the file (see max_ids) and code links, which the file may already
+have, are matched by content when they are copied. Object identities are
+hashes of memory addresses, meaningless in another process: those of an
+appended run are scoped to the run on disk, so that they never merge with
+the identities of earlier runs.
+"""
+
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import Callable
+from typing import Any
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from .models import Base, migrate_db
+
+logger = logging.getLogger(__name__)
+
+DISK_SCHEMA = "checkpoint_disk"
+
+# Rows that can change after they were copied, as SQL conditions on the in-memory table.
+# They are copied again (INSERT OR REPLACE) at the next checkpoint, rows of other tables never change.
+MUTABLE_ROWS = {
+    "monitoring_sessions": "1",
+    "process_shards": "1",
+    "function_calls": "end_ns IS NULL",
+    "stack_snapshots": "next_snapshot_id IS NULL AND function_call_id IN "
+                       "(SELECT id FROM main.function_calls WHERE end_ns IS NULL)",
+}
+
+# Snapshots that can no longer change: those of ended calls
+EVICTABLE_SNAPSHOTS = "function_call_id IN (SELECT id FROM main.function_calls WHERE end_ns IS NOT NULL)"
+
+# Columns copied through an SQL expression: identity hashes are prefixed with the scope
+# of the run, identities already on disk keep their disk ID
+COPIED_COLUMNS = {
+    "object_identities": {
+        "identity_hash": ":scope || identity_hash",
+    },
+    "stored_objects": {
+        "identity_id": f"(SELECT d.id FROM {DISK_SCHEMA}.object_identities d JOIN main.object_identities m "
+                       f"ON d.identity_hash = :scope || m.identity_hash WHERE m.id = stored_objects.identity_id)",
+    },
+}
+
+# Rows copied without their ID, unless the disk already has an equal row
+DEDUPLICATED_ROWS = {
+    "code_object_links": f"NOT EXISTS (SELECT 1 FROM {DISK_SCHEMA}.code_object_links d "
+                         f"WHERE d.object_id = code_object_links.object_id AND d.definition_id = code_object_links.definition_id)",
+}
+
+# Tables whose integer IDs are allocated by the monitor, continuing after the file's in append mode
+ALLOCATED_IDS = ("function_calls", "stack_snapshots", "object_identities", "monitoring_sessions")
+
+
+class CheckpointPolicy:
+    """Decide when the in-memory database is checkpointed to disk.
+
+    Args:
+        interval: Checkpoint every this many seconds (None disables the time trigger)
+        max_events: Checkpoint once this many events were captured since the last checkpoint
+        evict_snapshots: Delete the persisted snapshots of ended calls from memory
+    """
+
+    def __init__(self, interval: float | None = 5.0, max_events: int | None = None, evict_snapshots: bool = False):
+        if interval is not None and interval <= 0:
+            raise ValueError(f"Invalid checkpoint interval: {interval}. Must be positive")
+        if max_events is not None and max_events < 1:
+            raise ValueError(f"Invalid checkpoint event count: {max_events}. Must be at least 1")
+        if interval is None and max_events is None:
+            raise ValueError("A checkpoint policy needs an interval or an event count")
+        self.interval = interval
+        self.max_events = max_events
+        self.evict_snapshots = evict_snapshots
+
+    @classmethod
+    def from_option(cls, option: "CheckpointPolicy | float | dict[str, Any] | bool | None") -> "CheckpointPolicy | None":
+        """Build a policy from the checkpoint option of the monitor
+
+        Args:
+            option: A CheckpointPolicy, True (every 5 seconds), a number of seconds
+                or a dict of CheckpointPolicy arguments
+        """
+        if option is None or option is False or isinstance(option, CheckpointPolicy):
+            return option or None
+        if option is True:
+            return cls()
+        if isinstance(option, dict):
+            return cls(**option)
+        if isinstance(option, int | float):
+            return cls(interval=option)
+        raise ValueError(f"Invalid checkpoint policy: {option!r}")
+
+    def is_due(self, elapsed: float, events: int) -> bool:
+        """Whether a checkpoint is due, given the time and events since the last one"""
+        if self.max_events is not None and events >= self.max_events:
+            return True
+        return self.interval is not None and elapsed >= self.interval
+
+
+class Checkpointer:
+    """Copy the rows captured in an in-memory database to its on-disk file.
+
+    checkpoint() does the copy and must run with exclusive use of the
+    session, once it is committed. start() runs a thread that calls
+    ``trigger`` whenever the policy says a checkpoint is due; ``events``
+    returns the number of events captured so far.
+
+    Args:
+        db_path: On-disk database receiving the rows
+        policy: When to checkpoint and whether to evict snapshots (None: only explicit checkpoints)
+        session: Session of the in-memory database, its rows present now are already on disk
+        identity_scope: Prefix of the identity hashes written to disk, unique to the run in append
+            mode (empty when the in-memory database was loaded from the file)
+    """
+
+    POLL_INTERVAL = 0.05  # Seconds between two checks of the policy
+
+    def __init__(self, db_path: str, policy: CheckpointPolicy | None, session: Session, identity_scope: str = ""):
+        self.db_path = os.path.abspath(db_path)
+        self.policy = policy
+        self.identity_scope = identity_scope
+        self._attached_to: sqlite3.Connection | None = None
+        self._watermarks: dict[str, int] = {}  # Highest rowid copied, per table
+        self._reopened: dict[str, list[int]] = {}  # Rowids of copied rows that can still change, per table
+
+        # Counters
+        self.checkpoints = 0
+        self.copied = 0
+        self.evicted = 0
+
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+        create_schema(self.db_path)
+        connection = _driver_connection(session)
+        for table in Base.metadata.sorted_tables:
+            self._watermarks[table.name] = _max_rowid(connection, table.name)
+
+    def start(self, trigger: Callable[[], Any], events: Callable[[], int]):
+        """Start the thread checkpointing when the policy says so"""
+        if self.policy is None:
+            return
+        self._thread = threading.Thread(target=self._run, args=(trigger, events),
+                                        name="spacetimepy-checkpointer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the checkpoint thread (without a final checkpoint)"""
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self, trigger: Callable[[], Any], events: Callable[[], int]):
+        last_time = time.monotonic()
+        last_events = events()
+        while not self._stop.wait(self.POLL_INTERVAL):
+            now = time.monotonic()
+            current_events = events()
+            if current_events == last_events:
+                last_time = now  # Nothing to persist: the interval starts at the next event
+                continue
+            if not self.policy.is_due(now - last_time, current_events - last_events):  # type: ignore[union-attr]
+                continue
+            try:
+                trigger()
+            except Exception:
+                logger.exception("Checkpoint failed")
+            last_time = time.monotonic()
+            last_events = current_events
+
+    def checkpoint(self, session: Session) -> dict[str, int]:
+        """Copy the rows added or changed since the last checkpoint to disk.
+
+        The session must be committed and not used by anyone else meanwhile.
+
+        Returns:
+            Number of rows copied per table, and of snapshots evicted ("evicted")
+        """
+        connection = _driver_connection(session)
+        if self._attached_to is not connection:
+            connection.execute(f"ATTACH DATABASE ? AS {DISK_SCHEMA}", (self.db_path,))
+            self._attached_to = connection
+
+        counts: dict[str, int] = {}
+        watermarks: dict[str, int] = {}
+        try:
+            for table in Base.metadata.sorted_tables:
+                name = table.name
+                watermarks[name] = _max_rowid(connection, name)
+                columns = _shared_columns(connection, name)
+                expressions = COPIED_COLUMNS.get(name, {})
+                where = "((rowid > :low AND rowid <= :high) OR rowid IN (SELECT value FROM json_each(:reopened)))"
+                if name in DEDUPLICATED_ROWS:
+                    columns.remove("id")
+                    where += f" AND {DEDUPLICATED_ROWS[name]}"
+                    verb = "INSERT"
+                else:
+                    verb = "INSERT OR REPLACE" if name in MUTABLE_ROWS else "INSERT OR IGNORE"
+                select = ", ".join(expressions.get(column, column) for column in columns)
+                cursor = connection.execute(
+                    f"{verb} INTO {DISK_SCHEMA}.{name} ({', '.join(columns)}) SELECT {select} FROM main.{name} WHERE {where}",
+                    {"low": self._watermarks[name], "high": watermarks[name],
+                     "reopened": _json_list(self._reopened.get(name, [])), "scope": self.identity_scope},
+                )
+                counts[name] = max(cursor.rowcount, 0)
+            if self.policy is not None and self.policy.evict_snapshots:
+                cursor = connection.execute(
+                    f"DELETE FROM main.stack_snapshots WHERE rowid <= ? AND {EVICTABLE_SNAPSHOTS}",
+                    (watermarks["stack_snapshots"],),
+                )
+                counts["evicted"] = max(cursor.rowcount, 0)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+        # Rows copied now that may change before the next checkpoint
+        for name, condition in MUTABLE_ROWS.items():
+            self._reopened[name] = [row[0] for row in connection.execute(
+                f"SELECT rowid FROM main.{name} WHERE rowid <= ? AND ({condition})", (watermarks[name],)
+            )]
+        self._watermarks = watermarks
+        self.checkpoints += 1
+        self.copied += sum(count for name, count in counts.items() if name != "evicted")
+        self.evicted += counts.get("evicted", 0)
+        logger.debug(f"Checkpoint to {self.db_path}: {counts}")
+        return counts
+
+    def detach(self, session: Session):
+        """Detach the on-disk database from the in-memory connection (the session must be committed)"""
+        if self._attached_to is not None:
+            _driver_connection(session).execute(f"DETACH DATABASE {DISK_SCHEMA}")
+            self._attached_to = None
+
+    def stats(self) -> dict[str, int]:
+        """Return the checkpoint counters"""
+        return {"checkpoints": self.checkpoints, "copied": self.copied, "evicted": self.evicted}
+
+
+def create_schema(db_path: str):
+    """Create (or migrate) the tables of a database file"""
+    engine = create_engine(f"sqlite:///{db_path}")
+    try:
+        Base.metadata.create_all(engine)
+        migrate_db(engine)
+    finally:
+        engine.dispose()
+
+
+def max_ids(db_path: str) -> dict[str, int]:
+    """Return the highest ID of the tables whose IDs the monitor allocates, in a database file
+
+    Missing files and tables count as empty, the file is not loaded.
+    """
+    ids = dict.fromkeys(ALLOCATED_IDS, 0)
+    if not os.path.exists(db_path):
+        return ids
+    conn = sqlite3.connect(db_path)
+    try:
+        for table in ALLOCATED_IDS:
+            with contextlib.suppress(sqlite3.OperationalError):
+                ids[table] = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+    finally:
+        conn.close()
+    return ids
+
+
+def _driver_connection(session: Session) -> sqlite3.Connection:
+    return session.connection().connection.driver_connection  # type: ignore[return-value]
+
+
+def _max_rowid(connection: sqlite3.Connection, table: str) -> int:
+    return connection.execute(f"SELECT COALESCE(MAX(rowid), 0) FROM main.{table}").fetchone()[0]
+
+
+def _shared_columns(connection: sqlite3.Connection, table: str) -> list[str]:
+    disk_columns = {row[1] for row in connection.execute(f"PRAGMA {DISK_SCHEMA}.table_info({table})")}
+    return [row[1] for row in connection.execute(f"PRAGMA main.table_info({table})") if row[1] in disk_columns]
+
+
+def _json_list(values: list[int]) -> str:
+    return "[" + ",".join(str(value) for value in values) + "]"
@@ -0,0 +1,148 @@
+"""
+Content-addressed chunking of large containers.
+
+A new version of a large list is pickled and stored in full, even when a
+single element changed. With a ChunkPolicy the object manager splits lists,
+dicts, bytes and numeric arrays that span more than one chunk into
+fixed-size chunks, stored once each in the object_chunks table under the
+hash of their content. The stored object is then a ChunkManifest, the
+ordered refs of its chunks, and its ref is the hash of the manifest (the
+root of a one-level Merkle tree). Successive versions share their unchanged
+chunks: storing one writes the chunks that changed and a small manifest.
+
+Every chunk is still pickled and hashed at each capture, only the writes
+are proportional to the change. Chunks are pickled separately, so an
+object referenced from two chunks is rehydrated as two copies.
+"""
+
+import importlib
+import itertools
+from collections.abc import Callable
+from typing import Any
+
+
+class ChunkManifest:
+    """Ordered chunk refs of a chunked value, stored in place of its pickle.
+
+    Args:
+        kind: Type of the value: "list", "dict", "bytes", "bytearray" or "ndarray"
+        chunks: Refs of the chunks, in order
+        length: Number of elements (of bytes for bytes and arrays)
+        dtype: Element type of arrays
+        shape: Shape of arrays
+    """
+
+    def __init__(self, kind: str, chunks: list[str], length: int, dtype: str | None = None,
+                 shape: tuple | None = None):
+        self.kind = kind
+        self.chunks = chunks
+        self.length = length
+        self.dtype = dtype
+        self.shape = shape
+
+    def assemble(self, payloads: list[bytes], loads: Callable[[bytes], Any]) -> Any:
+        """Rebuild the value from the payloads of its chunks, in order"""
+        if self.kind == "list":
+            return list(itertools.chain.from_iterable(loads(payload) for payload in payloads))
+        if self.kind == "dict":
+            return dict(itertools.chain.from_iterable(loads(payload) for payload in payloads))
+        if self.kind == "bytes":
+            return b"".join(payloads)
+        if self.kind == "bytearray":
+            return bytearray(b"".join(payloads))
+        if self.kind == "ndarray":
+            numpy = importlib.import_module("numpy")
+            return numpy.frombuffer(b"".join(payloads), dtype=numpy.dtype(self.dtype)).reshape(self.shape).copy()
+        raise ValueError(f"Unknown chunked value kind: {self.kind}")
+
+    def __eq__(self, other):
+        return isinstance(other, ChunkManifest) and self.__dict__ == other.__dict__
+
+    def __hash__(self):
+        return hash((self.kind, tuple(self.chunks)))
+
+    def __repr__(self):
+        return f"<{self.kind} of length {self.length} in {len(self.chunks)} chunks>"
+
+
+class ChunkPolicy:
+    """Which values the object manager stores in chunks, and the size of the chunks.
+
+    A list, dict, bytes, bytearray or numeric numpy array is chunked when it
+    spans more than one chunk.
+
+    Args:
+        items: Elements per chunk of lists, items per chunk of dicts
+        size_bytes: Bytes per chunk of bytes, bytearrays and arrays
+    """
+
+    def __init__(self, items: int = 1024, size_bytes: int = 64 * 1024):
+        if items < 1:
+            raise ValueError(f"Invalid number of items per chunk: {items}. Must be at least 1")
+        if size_bytes < 1:
+            raise ValueError(f"Invalid chunk size: {size_bytes}. Must be at least 1 byte")
+        self.items = items
+        self.size_bytes = size_bytes
+
+    @classmethod
+    def from_option(cls, option: "ChunkPolicy | int | dict[str, Any] | bool | None") -> "ChunkPolicy | None":
+        """Build a policy from the chunking option of the monitor
+
+        Args:
+            option: A ChunkPolicy, True (default sizes), an int (items per chunk)
+                or a dict of ChunkPolicy arguments
+        """
+        if option is None or option is False or isinstance(option, ChunkPolicy):
+            return option or None
+        if option is True:
+            return cls()
+        if isinstance(option, dict):
+            return cls(**option)
+        if isinstance(option, int):
+            return cls(items=option)
+        raise ValueError(f"Invalid chunk policy: {option!r}")
+
+    def split(self, value: Any, dumps: Callable[[Any], bytes | None],
+              hasher: Callable[[bytes], str]) -> tuple[ChunkManifest, dict[str, bytes]] | None:
+        """Split a value into chunks.
+
+        Args:
+            value: The value
+            dumps: Pickles the elements of a list or dict chunk (None if they cannot be pickled)
+            hasher: Content hash giving the refs of the chunks
+
+        Returns:
+            The manifest of the value and the payloads of its distinct chunks by ref,
+            or None if the value is not chunked
+        """
+        cls = type(value)
+        dtype = shape = None
+        if cls is list or cls is dict:
+            if len(value) <= self.items:
+                return None
+            elements = value if cls is list else list(value.items())
+            payloads = [dumps(elements[i:i + self.items]) for i in range(0, len(elements), self.items)]
+            if any(payload is None for payload in payloads):
+                return None
+        elif cls is bytes or cls is bytearray or _is_array(value):
+            if cls is bytes or cls is bytearray:
+                data = memoryview(value)
+            else:
+                dtype, shape = value.dtype.str, tuple(value.shape)
+                data = memoryview(value.tobytes())
+            if len(data) <= self.size_bytes:
+                return None
+            payloads = [bytes(data[i:i + self.size_bytes]) for i in range(0, len(data), self.size_bytes)]
+        else:
+            return None
+        refs = [hasher(payload) for payload in payloads]  # type: ignore[arg-type]
+        manifest = ChunkManifest(cls.__name__, refs, len(value) if dtype is None else len(data), dtype, shape)
+        return manifest, dict(zip(refs, payloads, strict=True))  # type: ignore[arg-type]
+
+
+def _is_array(value: Any) -> bool:
+    """Whether a value is a numpy array of plain numbers, chunked as its raw bytes"""
+    cls = type(value)
+    if cls.__name__ != "ndarray" or cls.__module__ != "numpy":
+        return False
+    return not value.dtype.hasobject and value.dtype.fields is None
@@ -5,7 +5,13 @@ from typing import Any
 from sqlalchemy import func, text
 from sqlalchemy.orm import Session
 
-from .models import CodeDefinition, FunctionCall, StackSnapshot
+from .models import (
+    CodeDefinition,
+    FunctionCall,
+    StackSnapshot,
+    ns_to_datetime,
+    resolve_snapshot_refs,
+)
 from .representation import ObjectManager, PickleConfig
 
 logger = logging.getLogger(__name__)
@@ -70,7 +76,7 @@ class FunctionCallRepository:
         query = self.session.query(FunctionCall)
         if function_name:
             query = query.filter(FunctionCall.function == function_name)
-        calls = query.order_by(FunctionCall.start_time.asc()).all()
+        calls = query.order_by(FunctionCall.start_ns.asc()).all()
         return [call.id for call in calls]
 
     def get_functions_with_traces(self) -> list[dict[str, Any]]:
@@ -93,8 +99,8 @@ class FunctionCallRepository:
                 func.count(StackSnapshot.id).label('trace_count'),
                 FunctionCall.file,
                 FunctionCall.line,
-                func.min(FunctionCall.start_time).label('first_occurrence'),
-                func.max(FunctionCall.start_time).label('last_occurrence')
+                func.min(FunctionCall.start_ns).label('first_occurrence'),
+                func.max(FunctionCall.start_ns).label('last_occurrence')
             ).outerjoin(
                 StackSnapshot, FunctionCall.id == StackSnapshot.function_call_id
             ).group_by(
@@ -113,8 +119,8 @@ class FunctionCallRepository:
                     "trace_count": row.trace_count,
                     "file": row.file,
                     "line": row.line,
-                    "first_occurrence": row.first_occurrence,
-                    "last_occurrence": row.last_occurrence
+                    "first_occurrence": ns_to_datetime(row.first_occurrence),
+                    "last_occurrence": ns_to_datetime(row.last_occurrence)
                 })
 
             return functions
@@ -168,7 +174,7 @@ class FunctionCallRepository:
                     logger.error(f"Error retrieving code definition: {e}")
 
             traces = []
-            for snapshot in snapshots:
+            for snapshot, (locals_refs_dict, globals_refs_dict) in zip(snapshots, resolve_snapshot_refs(snapshots), strict=True):
                 # Convert datetime to string to avoid serialization issues
                 start_time_str = function_call.start_time.isoformat() if function_call.start_time is not None else None
                 end_time_str = function_call.end_time.isoformat() if function_call.end_time is not None else None
@@ -177,9 +183,6 @@ class FunctionCallRepository:
                 prev_snapshot = snapshot.get_previous_snapshot(self.session)
 
                 # Create trace data with proper handling of all attributes
-                locals_refs_dict = snapshot.locals_refs or {}
-                globals_refs_dict = snapshot.globals_refs or {}
-
                 trace_data = {
                     "id": str(snapshot.id),
                     "function": function_call.function,
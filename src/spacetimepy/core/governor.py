@@ -0,0 +1,140 @@
+"""
+Adaptive overhead control for SpaceTimeMonitor.
+
+The OverheadGovernor receives the time spent in the monitoring callbacks of
+each function and compares it with wall time over fixed windows. When the
+share of time spent monitoring exceeds the budget, the hottest function is
+downgraded one capture level; when there is room again, the last downgrade is
+undone. The monitor applies the level changes and records them in the session
+metadata.
+"""
+
+import threading
+from typing import Any
+
+from .capture_plan import CapturePlan, PlanKey
+
+# Capture levels, from the most to the least detailed
+GOVERNOR_LEVELS = ("line", "function", "sampled", "off")
+
+
+class OverheadGovernor:
+    """Keep the time spent in monitoring callbacks under a share of wall time.
+
+    Args:
+        budget: Highest acceptable share of wall time spent in callbacks (0.05 is 5%)
+        window: Length in seconds of the measurement windows
+        sample_every: Record one call out of this many at the "sampled" level
+        margin: A downgrade is undone once the overhead it saved fits in this share of the budget
+    """
+
+    def __init__(self, budget: float = 0.05, window: float = 1.0, sample_every: int = 10, margin: float = 0.8):
+        if not 0 < budget < 1:
+            raise ValueError(f"Invalid overhead budget: {budget}. Must be between 0 and 1")
+        if window <= 0:
+            raise ValueError(f"Invalid governor window: {window}. Must be positive")
+        if sample_every < 1:
+            raise ValueError(f"Invalid sampling interval: {sample_every}. Must be at least 1")
+
+        self.budget = budget
+        self.window = window
+        self.sample_every = sample_every
+        self.margin = margin
+
+        self.levels: dict[PlanKey, str] = {}  # Current level of every function seen
+        self._window_start: float | None = None
+        self._spent: dict[PlanKey, float] = {}  # Callback time per function in the current window
+        self._total = 0.0
+        self._downgrades: list[tuple[PlanKey, float]] = []  # (function, overhead share it was using), last first to undo
+
+        self.overhead = 0.0  # Overhead of the last complete window
+        self._lock = threading.Lock()  # Callbacks of every monitored thread report to the governor
+
+    @classmethod
+    def from_option(cls, option: "OverheadGovernor | float | bool | dict[str, Any] | None") -> "OverheadGovernor | None":
+        """Build a governor from the governor option of init_monitoring
+
+        Args:
+            option: An OverheadGovernor, True (default budget), a budget (float)
+                or a dict of OverheadGovernor arguments
+
+        Returns:
+            The matching OverheadGovernor, or None if option is None or False
+        """
+        if option is None or option is False:
+            return None
+        if isinstance(option, OverheadGovernor):
+            return option
+        if option is True:
+            return cls()
+        if isinstance(option, dict):
+            return cls(**option)
+        if isinstance(option, float):
+            return cls(budget=option)
+        raise ValueError(f"Invalid governor option: {option!r}. Must be an OverheadGovernor, a bool, a budget or a dict")
+
+    def record(self, plan: CapturePlan, elapsed: float, now: float) -> list[tuple[PlanKey, str, str]]:
+        """Record time spent in a callback for a function.
+
+        Args:
+            plan: Capture plan of the function
+            elapsed: Seconds spent in the callback
+            now: perf_counter() value at the end of the callback
+
+        Returns:
+            Level changes to apply as (function key, old level, new level), at most one per window
+        """
+        with self._lock:
+            if self._window_start is None:
+                self._window_start = now - elapsed
+            spent = self._spent.get(plan.key)
+            if spent is None:
+                self._spent[plan.key] = elapsed
+                self.levels.setdefault(plan.key, plan.mode)
+            else:
+                self._spent[plan.key] = spent + elapsed
+            self._total += elapsed
+            if now - self._window_start < self.window:
+                return []
+            return self._evaluate(now)
+
+    def _evaluate(self, now: float) -> list[tuple[PlanKey, str, str]]:
+        wall = now - self._window_start  # type: ignore[operator]
+        self.overhead = self._total / wall
+        changes = []
+        if self.overhead > self.budget:
+            # Downgrade the function that cost the most and can still be downgraded
+            for key, spent in sorted(self._spent.items(), key=lambda item: item[1], reverse=True):
+                level = self.levels[key]
+                if level != "off":
+                    new_level = GOVERNOR_LEVELS[GOVERNOR_LEVELS.index(level) + 1]
+                    self.levels[key] = new_level
+                    self._downgrades.append((key, spent / wall))
+                    changes.append((key, level, new_level))
+                    break
+        elif self._downgrades:
+            key, saved = self._downgrades[-1]
+            if self.overhead + saved <= self.budget * self.margin:
+                # Undo the last downgrade
+                self._downgrades.pop()
+                level = self.levels[key]
+                new_level = GOVERNOR_LEVELS[GOVERNOR_LEVELS.index(level) - 1]
+                self.levels[key] = new_level
+                changes.append((key, level, new_level))
+
+        self._window_start = now
+        self._spent = {}
+        self._total = 0.0
+        return changes
+
+    def after_fork(self):
+        """Start a new window in a forked process (the lock may have been held by another thread)"""
+        self._lock = threading.Lock()
+        self._window_start = None
+        self._spent = {}
+        self._total = 0.0
+
+    @property
+    def degraded(self) -> dict[PlanKey, str]:
+        """Level of every function that is currently downgraded"""
+        return {key: self.levels[key] for key, _ in self._downgrades}
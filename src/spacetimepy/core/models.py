@@ -2,6 +2,7 @@ import datetime
 import logging
 import os
 import sqlite3
+import threading
 from typing import Any
 
 from sqlalchemy import (
@@ -17,7 +18,11 @@ from sqlalchemy import (
     and_,
     create_engine,
     desc,
+    inspect,
+    text,
+    true,
 )
+from sqlalchemy.ext.hybrid import Comparator, hybrid_property
 from sqlalchemy.orm import (
     Mapped,
     Session,
@@ -33,6 +38,46 @@ logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+
+def ns_to_datetime(ns: int | None) -> datetime.datetime | None:
+    """Convert nanoseconds since the epoch to a local datetime, as datetime.now() returns"""
+    if ns is None:
+        return None
+    seconds, remainder = divmod(ns, 1_000_000_000)
+    return datetime.datetime.fromtimestamp(seconds).replace(microsecond=remainder // 1000)
+
+
+def datetime_to_ns(value: datetime.datetime | None) -> int | None:
+    """Convert a local datetime to nanoseconds since the epoch"""
+    if value is None:
+        return None
+    return int(value.replace(microsecond=0).timestamp()) * 1_000_000_000 + value.microsecond * 1000
+
+
+def _to_ns(operand: Any) -> Any:
+    """Convert the datetimes of a query operand (or of a list of them) to nanoseconds"""
+    if isinstance(operand, datetime.datetime):
+        return datetime_to_ns(operand)
+    if isinstance(operand, list | tuple):
+        return [_to_ns(item) for item in operand]
+    return operand
+
+
+class NsComparator(Comparator):
+    """Query side of a datetime attribute stored as nanoseconds since the epoch.
+
+    Orders by the nanoseconds column, and compares it to datetimes converted
+    to nanoseconds, so that filters and sorts on the datetime attributes keep
+    working in queries.
+    """
+
+    def operate(self, op, *other, **kwargs):
+        return op(self.expression, *(_to_ns(operand) for operand in other), **kwargs)
+
+    def reverse_operate(self, op, other, **kwargs):
+        return op(_to_ns(other), self.expression, **kwargs)
+
+
 class ObjectIdentity(Base):
     """Model for tracking object identity"""
     __tablename__ = 'object_identities'
@@ -79,30 +124,63 @@ class StoredObject(Base):
     identity = relationship("ObjectIdentity", back_populates="versions")
     code_definitions = relationship("CodeDefinition", secondary="code_object_links", back_populates="objects")
 
+class ObjectChunk(Base):
+    """Model for the chunks of large objects, shared by their versions
+
+    Objects stored in chunks have a ChunkManifest, the ordered IDs of their
+    chunks, as pickle_data (see chunking.py).
+    """
+    __tablename__ = 'object_chunks'
+
+    id: Mapped[str] = mapped_column(String, primary_key=True)  # Hash of the data
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)  # Pickle of the elements, or raw bytes
+
 class StackSnapshot(Base):
     """Model for storing stack state at each line execution
 
     Each snapshot represents the state of local and global variables
     at a specific line during function execution. Snapshots form a
     chronological sequence within a function call.
+
+    Keyframe snapshots store every binding. Other snapshots only store the
+    bindings that changed since the previous snapshot of the call, a removed
+    variable being mapped to None. Use get_full_refs() or
+    resolve_snapshot_refs() to read complete states.
     """
     __tablename__ = 'stack_snapshots'
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     function_call_id: Mapped[int] = mapped_column(Integer, ForeignKey('function_calls.id'), nullable=False)
     line_number: Mapped[int] = mapped_column(Integer, nullable=False)
-    timestamp: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.now)
+    timestamp_ns: Mapped[int | None] = mapped_column(Integer, nullable=True)  # Nanoseconds since the epoch
     locals_refs: Mapped[dict[str, str]] = mapped_column(JSON, nullable=False, default=dict)  # Dict[str, str] mapping variable names to object refs
     globals_refs: Mapped[dict[str, str]] = mapped_column(JSON, nullable=False, default=dict)  # Dict[str, str] mapping variable names to object refs
 
     # Chronological ordering within a function call
     order_in_call: Mapped[int | None] = mapped_column(Integer, nullable=True)  # Position in the execution sequence
 
+    # Whether locals_refs/globals_refs hold the full state or a delta from the previous snapshot
+    is_keyframe: Mapped[bool] = mapped_column(Boolean, nullable=False, default=True, server_default=true())
+
     # Relationships
     function_call = relationship("FunctionCall", back_populates="stack_snapshots")
     next_snapshot_id: Mapped[int | None] = mapped_column(Integer, ForeignKey('stack_snapshots.id'), nullable=True)
     next_snapshot = relationship("StackSnapshot", foreign_keys=[next_snapshot_id], remote_side=[id], uselist=False)
 
+    @hybrid_property
+    def timestamp(self) -> datetime.datetime | None:
+        """Time of the snapshot as a local datetime"""
+        return ns_to_datetime(self.timestamp_ns)
+
+    @timestamp.inplace.setter
+    def _timestamp_setter(self, value: datetime.datetime | None):
+        self.timestamp_ns = datetime_to_ns(value)
+
+    @timestamp.inplace.comparator
+    @classmethod
+    def _timestamp_comparator(cls) -> NsComparator:
+        return NsComparator(cls.timestamp_ns)
+
     def get_previous_snapshot(self, session):
         """Get the previous snapshot in the execution sequence.
 
@@ -117,6 +195,32 @@ class StackSnapshot(Base):
             StackSnapshot.order_in_call < self.order_in_call
         ).order_by(desc(StackSnapshot.order_in_call)).first()
 
+    def get_full_refs(self, session) -> tuple[dict[str, str], dict[str, str]]:
+        """Get the complete locals and globals refs of this snapshot.
+
+        Delta snapshots are applied on top of the closest previous keyframe.
+
+        Args:
+            session: SQLAlchemy session to use for query
+
+        Returns:
+            Tuple of (locals_refs, globals_refs) dictionaries
+        """
+        if self.is_keyframe or self.order_in_call is None:
+            return dict(self.locals_refs or {}), dict(self.globals_refs or {})
+
+        keyframe_order = session.query(func.max(StackSnapshot.order_in_call)).filter(
+            StackSnapshot.function_call_id == self.function_call_id,
+            StackSnapshot.order_in_call < self.order_in_call,
+            StackSnapshot.is_keyframe.is_(True)
+        ).scalar()
+        snapshots = session.query(StackSnapshot).filter(
+            StackSnapshot.function_call_id == self.function_call_id,
+            StackSnapshot.order_in_call >= (keyframe_order or 0),
+            StackSnapshot.order_in_call < self.order_in_call
+        ).order_by(StackSnapshot.order_in_call).all()
+        return resolve_snapshot_refs([*snapshots, self])[-1]
+
     @property
     def is_first_in_call(self):
         """Return True if this is the first snapshot in its function call"""
@@ -127,6 +231,47 @@ class StackSnapshot(Base):
         """Return True if this is the last snapshot in its function call"""
         return self.next_snapshot_id is None
 
+def apply_snapshot_delta(refs: dict[str, str], delta: dict[str, str | None]) -> dict[str, str]:
+    """Return a copy of refs updated with a snapshot delta (None removes a variable)"""
+    refs = dict(refs)
+    for name, ref in delta.items():
+        if ref is None:
+            refs.pop(name, None)
+        else:
+            refs[name] = ref
+    return refs
+
+
+def diff_snapshot_refs(previous: dict[str, str], current: dict[str, str]) -> dict[str, str | None]:
+    """Return the delta turning the previous refs into the current ones"""
+    delta: dict[str, str | None] = {name: ref for name, ref in current.items() if previous.get(name) != ref}
+    delta.update((name, None) for name in previous if name not in current)
+    return delta
+
+
+def resolve_snapshot_refs(snapshots: list["StackSnapshot"]) -> list[tuple[dict[str, str], dict[str, str]]]:
+    """Get the complete refs of consecutive snapshots of one function call.
+
+    Args:
+        snapshots: Snapshots ordered by order_in_call, starting at a keyframe
+
+    Returns:
+        List of (locals_refs, globals_refs) tuples, one per snapshot
+    """
+    states = []
+    locals_refs: dict[str, str] = {}
+    globals_refs: dict[str, str] = {}
+    for snapshot in snapshots:
+        if snapshot.is_keyframe is not False:
+            locals_refs = dict(snapshot.locals_refs or {})
+            globals_refs = dict(snapshot.globals_refs or {})
+        else:
+            locals_refs = apply_snapshot_delta(locals_refs, snapshot.locals_refs or {})
+            globals_refs = apply_snapshot_delta(globals_refs, snapshot.globals_refs or {})
+        states.append((locals_refs, globals_refs))
+    return states
+
+
 class FunctionCall(Base):
     """Model for storing function call information"""
     __tablename__ = 'function_calls'
@@ -135,14 +280,16 @@ class FunctionCall(Base):
     function: Mapped[str] = mapped_column(String, nullable=False)
     file: Mapped[str | None] = mapped_column(String, nullable=True)
     line: Mapped[int | None] = mapped_column(Integer, nullable=True)
-    start_time: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=False)
-    end_time: Mapped[datetime.datetime | None] = mapped_column(DateTime, nullable=True)
+    # Nanoseconds since the epoch, read from the monotonic clock anchored to wall time (see start_time/end_time)
+    start_ns: Mapped[int] = mapped_column(Integer, nullable=False)
+    end_ns: Mapped[int | None] = mapped_column(Integer, nullable=True)
     call_metadata: Mapped[dict[str, Any] | None] = mapped_column(JSON, nullable=True)  # For storing additional data like PyRAPL measurements
 
     # Store references to objects
     locals_refs: Mapped[dict[str, str]] = mapped_column(JSON, nullable=False, default=dict)  # Dict[str, str] mapping variable names to object refs
     globals_refs: Mapped[dict[str, str]] = mapped_column(JSON, nullable=False, default=dict)  # Dict[str, str] mapping variable names to object refs
     return_ref: Mapped[str | None] = mapped_column(String, nullable=True)  # Reference to return value in object manager
+    exception_ref: Mapped[str | None] = mapped_column(String, nullable=True)  # Reference to the exception that ended the call, if any
 
     # Code version tracking
     code_definition_id: Mapped[str | None] = mapped_column(String, ForeignKey('code_definitions.id'), nullable=True)
@@ -162,12 +309,61 @@ class FunctionCall(Base):
     # First snapshot reference for efficient stack trace retrieval
     first_snapshot_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
 
+    # Thread the call ran on (parent calls are always on the same thread)
+    thread_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    thread_name: Mapped[str | None] = mapped_column(String, nullable=True)
+    # Process the call ran in (calls of forked processes are linked to the call that forked them)
+    process_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    # asyncio task the call started in, if any
+    task_name: Mapped[str | None] = mapped_column(String, nullable=True)
+
     # Relationships
     session = relationship("MonitoringSession", foreign_keys=[session_id], back_populates="function_calls")
-    stack_snapshots = relationship("StackSnapshot", back_populates="function_call", order_by="StackSnapshot.timestamp")
+    stack_snapshots = relationship("StackSnapshot", back_populates="function_call", order_by="StackSnapshot.timestamp_ns")
     code_definition = relationship("CodeDefinition", back_populates="function_calls")
     parent_call = relationship("FunctionCall", foreign_keys=[parent_call_id], remote_side=[id], backref="child_calls")
 
+    @hybrid_property
+    def start_time(self) -> datetime.datetime | None:
+        """Start of the call as a local datetime (microsecond precision)"""
+        return ns_to_datetime(self.start_ns)
+
+    @start_time.inplace.setter
+    def _start_time_setter(self, value: datetime.datetime):
+        self.start_ns = datetime_to_ns(value)  # type: ignore[assignment]
+
+    @start_time.inplace.comparator
+    @classmethod
+    def _start_time_comparator(cls) -> NsComparator:
+        return NsComparator(cls.start_ns)
+
+    @hybrid_property
+    def end_time(self) -> datetime.datetime | None:
+        """End of the call as a local datetime, None while it is running"""
+        return ns_to_datetime(self.end_ns)
+
+    @end_time.inplace.setter
+    def _end_time_setter(self, value: datetime.datetime | None):
+        self.end_ns = datetime_to_ns(value)
+
+    @end_time.inplace.comparator
+    @classmethod
+    def _end_time_comparator(cls) -> NsComparator:
+        return NsComparator(cls.end_ns)
+
+    @property
+    def duration_ns(self) -> int | None:
+        """Exact duration of the call in nanoseconds, or None if it did not end"""
+        if self.end_ns is None or self.start_ns is None:
+            return None
+        return self.end_ns - self.start_ns
+
+    @property
+    def duration(self) -> float | None:
+        """Duration of the call in seconds, or None if it did not end"""
+        duration_ns = self.duration_ns
+        return duration_ns / 1e9 if duration_ns is not None else None
+
     def get_child_calls(self, session : Session):
         """Get all child function calls ordered by their execution sequence
 
@@ -179,7 +375,7 @@ class FunctionCall(Base):
         """
         return session.query(FunctionCall).filter(
             FunctionCall.parent_call_id == self.id
-        ).order_by(FunctionCall.order_in_parent, FunctionCall.start_time).all()
+        ).order_by(FunctionCall.order_in_parent, FunctionCall.start_ns).all()
 
     def get_execution_tree(self, session, max_depth=None, current_depth=0):
         """Recursively build the execution tree starting from this function call
@@ -231,16 +427,23 @@ class FunctionCall(Base):
             "line": self.line,
             "start_time": self.start_time.isoformat() if self.start_time else None,
             "end_time": self.end_time.isoformat() if self.end_time else None,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
             "call_metadata": self.call_metadata,
             "locals_refs": self.locals_refs,
             "globals_refs": self.globals_refs,
             "return_ref": self.return_ref,
+            "exception_ref": self.exception_ref,
             "code_definition_id": self.code_definition_id,
             "session_id": self.session_id,
             "parent_call_id": self.parent_call_id,
             "order_in_parent": self.order_in_parent,
             "order_in_session": self.order_in_session,
-            "first_snapshot_id": self.first_snapshot_id
+            "first_snapshot_id": self.first_snapshot_id,
+            "thread_id": self.thread_id,
+            "thread_name": self.thread_name,
+            "process_id": self.process_id,
+            "task_name": self.task_name
         }
 
 class CodeDefinition(Base):
@@ -347,12 +550,72 @@ class MonitoringSession(Base):
             FunctionCall.parent_call_id.is_(None))  # Only top-level calls
         ).order_by(FunctionCall.order_in_session).all()
 
-def init_db(db_path, in_memory=True):
+class ProcessShard(Base):
+    """Model for the process that wrote a shard database
+
+    With shard_by_process, every monitored process writes to its own database.
+    A forked process records the process, call and session it was forked from
+    so that merge_shards can link its calls back to the parent process.
+    """
+    __tablename__ = 'process_shards'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    pid: Mapped[int] = mapped_column(Integer, nullable=False)
+    parent_pid: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    # Innermost recorded call of the forking thread, in the parent shard
+    parent_call_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    # Session active in the parent process at the fork, in the parent shard
+    parent_session_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    # Session that continues it in this shard (merged into the parent session)
+    session_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    start_time: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=False, default=datetime.datetime.now)
+
+
+class IdAllocator:
+    """Hands out monotonically increasing primary keys without a database round trip.
+
+    The allocator is seeded from the current ``MAX(id)`` of a table so that rows
+    built in memory can reference each other (parent calls, snapshot chains)
+    before they are flushed.
+    """
+
+    def __init__(self, start: int = 0):
+        self._last = start
+        self._lock = threading.Lock()  # Callbacks of several threads allocate IDs concurrently
+
+    @classmethod
+    def from_table(cls, session: Session, model, start: int = 0) -> "IdAllocator":
+        """Create an allocator continuing after the highest ID stored for a model
+
+        Args:
+            session: SQLAlchemy session to use for the query
+            model: Mapped class with an integer ``id`` primary key
+            start: Lowest seed, the highest ID of rows stored elsewhere (append mode)
+
+        Returns:
+            An IdAllocator whose next ID is ``max(MAX(id), start) + 1``
+        """
+        return cls(max(session.query(func.max(model.id)).scalar() or 0, start))
+
+    def next(self) -> int:
+        """Return the next free ID"""
+        with self._lock:
+            self._last += 1
+            return self._last
+
+    @property
+    def last(self) -> int:
+        """The last ID handed out (or the seed if none was allocated yet)"""
+        return self._last
+
+def init_db(db_path, in_memory=True, load_existing=True):
     """Initialize the database and return session factory
 
     Args:
         db_path: Path to the SQLite database file or ':memory:' for in-memory database
         in_memory: Whether to use an in-memory database (default: True)
+        load_existing: Copy an existing db_path into the in-memory database (default: True).
+            Without it the in-memory database starts empty (append mode).
 
     Returns:
         SQLAlchemy Session factory configured for the database
@@ -363,19 +626,20 @@ def init_db(db_path, in_memory=True):
     try:
         # Handle file-based databases
         if in_memory:
-            dest = sqlite3.connect(':memory:')
+            # The capture writer and the web API use the connection from other threads,
+            # access is serialized by the monitor
+            dest = sqlite3.connect(':memory:', check_same_thread=False)
             if db_path != ":memory:":
                 # Ensure we have an absolute path
                 db_path = os.path.abspath(db_path)
 
                 # If database exists but appears corrupted, create a backup
-                if os.path.exists(db_path):
+                if load_existing and os.path.exists(db_path):
                     source = sqlite3.connect(db_path)
                     source.backup(dest)
                     db_path = ':memory:'
         else:
-            dest = sqlite3.connect(db_path)
-
+            dest = sqlite3.connect(db_path, check_same_thread=False)
 
         def get_connection():
             # just a debug print to verify that it's indeed getting called:
@@ -385,6 +649,7 @@ def init_db(db_path, in_memory=True):
 
         # Create tables
         Base.metadata.create_all(engine)
+        migrate_db(engine)
 
         # Create and return session factory
         return sessionmaker(bind=engine, expire_on_commit=False)
@@ -394,6 +659,52 @@ def init_db(db_path, in_memory=True):
         raise RuntimeError(f"Failed to initialize database: {e}") from e
 
 
+# Columns added after the first release: (table, column, SQL definition)
+ADDED_COLUMNS = [
+    ("stack_snapshots", "is_keyframe", "BOOLEAN NOT NULL DEFAULT 1"),
+    ("function_calls", "thread_id", "INTEGER"),
+    ("function_calls", "thread_name", "VARCHAR"),
+    ("function_calls", "exception_ref", "VARCHAR"),
+    ("function_calls", "task_name", "VARCHAR"),
+    ("function_calls", "process_id", "INTEGER"),
+]
+
+
+# DateTime columns replaced by nanoseconds since the epoch: (table, old column, new column)
+CONVERTED_COLUMNS = [
+    ("function_calls", "start_time", "start_ns"),
+    ("function_calls", "end_time", "end_ns"),
+    ("stack_snapshots", "timestamp", "timestamp_ns"),
+]
+
+
+def migrate_db(engine):
+    """Add the columns missing from a database created by an older version
+
+    Args:
+        engine: SQLAlchemy engine of the database
+    """
+    inspector = inspect(engine)
+    existing = {table: {column["name"] for column in inspector.get_columns(table)}
+                for table in inspector.get_table_names()}
+    with engine.begin() as connection:
+        for table, column, definition in ADDED_COLUMNS:
+            if table in existing and column not in existing[table]:
+                logger.info(f"Adding column {table}.{column}")
+                connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+        for table, old_column, column in CONVERTED_COLUMNS:
+            if table in existing and old_column in existing[table]:
+                logger.info(f"Converting column {table}.{old_column} to {column}")
+                if column not in existing[table]:
+                    connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER"))
+                # Stored as local "YYYY-MM-DD HH:MM:SS.ffffff" strings
+                connection.execute(text(
+                    f"UPDATE {table} SET {column} = CAST(strftime('%s', {old_column}, 'utc') AS INTEGER) * 1000000000 "
+                    f"+ CAST(substr({old_column}, 21, 6) AS INTEGER) * 1000 WHERE {old_column} IS NOT NULL"
+                ))
+                connection.execute(text(f"ALTER TABLE {table} DROP COLUMN {old_column}"))
+
+
 def export_db(session : "Session", db_path: str):
     """Exports the current sessionto a specified file.
 
@@ -1,20 +1,43 @@
 import atexit
+import contextlib
 import datetime
 import dis
 import inspect
 import json
-import linecache
 import logging
 import os
 import sys
-from time import perf_counter
+import threading
+from time import perf_counter, perf_counter_ns, time_ns
 import traceback
 import types
-from typing import Any
+from typing import Any, ClassVar
 
+from .capture_plan import CapturePlan, GlobalsClosure, PlanKey, compile_watch, plan_key
+from .change_detection import ChangeDetector
+from .checkpoint import Checkpointer, CheckpointPolicy, max_ids
+from .chunking import ChunkPolicy
 from .function_call import FunctionCallRepository
-from .models import FunctionCall, MonitoringSession, StackSnapshot, export_db, init_db
-from .representation import ObjectManager, PickleConfig
+from .governor import OverheadGovernor
+from .models import (
+    FunctionCall,
+    IdAllocator,
+    MonitoringSession,
+    ObjectIdentity,
+    ProcessShard,
+    StackSnapshot,
+    diff_snapshot_refs,
+    export_db,
+    init_db,
+    ns_to_datetime,
+)
+from .representation import INLINE_LIMIT, ObjectManager, PickleConfig, PreparedObject, content_hasher
+from .ref_index import RefIndex
+from .sampling import Sampler
+from .shards import shard_path
+from .stats import MonitorStats
+from .summaries import CaptureBudget
+from .writer import CallEnd, CallStart, CaptureWriter, CodeDefinitionRecord, CommitPolicy, PendingCall, Snapshot
 
 # Configure logging - only show warnings and errors
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -22,12 +45,56 @@ logger = logging.getLogger(__name__)
 
 MONITOR_TOOL_ID = sys.monitoring.PROFILER_ID
 
+# Local events of every monitored code object: calls, returns and generator/coroutine suspensions
+_CALL_EVENTS = (sys.monitoring.events.PY_START | sys.monitoring.events.PY_RETURN |
+                sys.monitoring.events.PY_YIELD | sys.monitoring.events.PY_RESUME)
+# Exceptions thrown into generators and propagating out of frames, these can only be enabled globally
+_EXCEPTION_EVENTS = sys.monitoring.events.PY_THROW | sys.monitoring.events.PY_UNWIND
+
+# Values of these types never change while bound to the same object
+_IMMUTABLE_TYPES = frozenset({int, float, complex, str, bytes, bool, type(None)})
+
+Bindings = dict[str, tuple[Any, str]]  # Variable name -> (captured value, its ref)
+
+# Call stack entry of a call that was sampled out
+_SAMPLED_OUT = PendingCall(id=0, function="<sampled out>", call_metadata=None, dropped=True)
+
+
+class _ThreadState:
+    """Monitored calls running on one thread"""
+
+    __slots__ = ("active_plan_counts", "call_stack", "parent_id_for_next_call", "plan_stack", "thread_id", "thread_name")
+
+    def __init__(self):
+        self.call_stack: list[FunctionCall | PendingCall] = []  # Stack to keep track of FunctionCall objects instead of just IDs
+        self.plan_stack: list[CapturePlan] = []  # Capture plan of each call on the call stack
+        self.active_plan_counts: dict[PlanKey, int] = {}  # Number of recorded calls running per function key
+        self.parent_id_for_next_call: int | None = None  # Parent of the next call, set when replaying
+        self.thread_id = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+
+
+def _current_task_name() -> str | None:
+    """Name of the asyncio task running on this thread, if any"""
+    asyncio = sys.modules.get("asyncio")
+    if asyncio is None or asyncio._get_running_loop() is None:
+        return None
+    task = asyncio.current_task()
+    return task.get_name() if task is not None else None
+
+
 class SpaceTimeMonitor:
     _instance = None
 
     _monitored_functions = {}
     _tracked_functions = {}
 
+    # Capture plans compiled by the decorators, by code object and by function key
+    # (the key finds the plan of a reloaded function whose code object changed)
+    _capture_plans: ClassVar[dict[types.CodeType, CapturePlan]] = {}
+    _capture_plans_by_key: ClassVar[dict[PlanKey, CapturePlan]] = {}
+    _suspended_line_codes: ClassVar[set[types.CodeType]] = set()  # Line mode code objects whose line events are off while sampled out
+
     @classmethod
     def get_instance(cls) -> 'SpaceTimeMonitor | None':
         """Get the current SpaceTimeMonitor instance.
@@ -37,14 +104,36 @@ class SpaceTimeMonitor:
         """
         return cls._instance
 
-    def __init__(self, db_path="monitoring.db", pickle_config: PickleConfig | None = None, in_memory=True, performance=False):
+    def __init__(self, db_path="monitoring.db", pickle_config: PickleConfig | None = None, in_memory=True, performance=False,
+                 async_writer=False, queue_size=1000, backpressure="block",
+                 commit_policy: CommitPolicy | str | int | None = None, capture_backend="orm",
+                 snapshot_keyframe_interval: int | None = None,
+                 governor: OverheadGovernor | float | bool | None = None, shard_by_process=False,
+                 stats_textfile: str | None = None, capture_budget: CaptureBudget | int | dict | None = None,
+                 checkpoint: CheckpointPolicy | float | dict | bool | None = None, append=False,
+                 hash_function="md5", ref_index: RefIndex | int | dict | None = None, strict=True,
+                 inline_primitives: int = INLINE_LIMIT, chunking: ChunkPolicy | int | dict | bool | None = None):
         if hasattr(self, 'initialized') and self._instance is not None:
             return
         self.initialized = True
+        self._pid = os.getpid()
+        # Shard mode: every process writes to its own database, next to db_path, merged by merge_shards
+        self._shard_base = db_path if shard_by_process else None
+        self._fork_origin: tuple[int, int | None, int | None, str | None] | None = None  # (pid, call ID, session ID, session name) at the last fork
+        if shard_by_process:
+            db_path = shard_path(db_path, self._pid)
+            in_memory = False  # Forked processes must not share a connection or an export
         self.db_path = db_path
-        self.call_stack : list[FunctionCall] = []  # Stack to keep track of FunctionCall objects instead of just IDs
+        # Call stacks are per thread: calls running on other threads are neither parents nor children
+        self._thread_local = threading.local()
+        self._thread_states: dict[int, _ThreadState] = {}  # Dict[thread ident, state] of every thread that ran a monitored function
+        # Calls of suspended generators and coroutines are off every stack until they resume (on any thread)
+        self._suspended_calls: dict[int, tuple[FunctionCall | PendingCall, CapturePlan]] = {}  # Dict[id(frame), (call, plan)]
         self.MONITOR_TOOL_ID = MONITOR_TOOL_ID
         self.in_memory = in_memory
+        # Timestamps are read from the monotonic clock: perf_counter_ns() + offset is the time since the epoch.
+        # The offset anchors it to the wall clock, again at each session start.
+        self._clock_offset_ns = time_ns() - perf_counter_ns()
         # Custom pickle configuration
         self.pickle_config = pickle_config
 
@@ -56,18 +145,28 @@ class SpaceTimeMonitor:
         self.session_function_calls = {}  # Dict mapping function names to lists of call IDs
         self._current_session_first_call_id = None # ID of the first call in the current session chain
         self._current_session_last_call_id = None  # ID of the last call in the current session chain
-        self._parent_id_for_next_call: int | None = None
 
         # Performance optimization: In-memory counters to avoid database queries
         self._current_session_call_count = 0  # Counter for order_in_session
+        # Guards the session, parent and snapshot counters shared by every thread
+        self._order_lock = threading.Lock()
         self._parent_call_child_counts = {}  # Dict[parent_id, child_count] for order_in_parent
         self._function_snapshot_counts = {}  # Dict[function_call_id, snapshot_count] for order_in_call
+        self._sampling_baseline: dict[PlanKey, tuple[int, int]] = {}  # Sampler (calls, recorded) counts at session start
+        self._last_snapshots: dict[int, StackSnapshot] = {}  # Dict[function_call_id, last snapshot] for snapshot chains
+
+        # Delta snapshots: a keyframe every snapshot_keyframe_interval snapshots of a call (None stores full snapshots)
+        if snapshot_keyframe_interval is not None and snapshot_keyframe_interval < 1:
+            raise ValueError(f"Invalid snapshot keyframe interval: {snapshot_keyframe_interval}. Must be at least 1")
+        self.snapshot_keyframe_interval = snapshot_keyframe_interval
+        self._snapshot_states: dict[int, tuple[dict[str, str], dict[str, str], int]] = {}  # Dict[function_call_id, (locals_refs, globals_refs, deltas since keyframe)]
+
+        # Bindings captured at the last snapshot of each call, to reuse the refs of unchanged values
+        self._line_states: dict[int, tuple[types.FrameType, int, Bindings, Bindings]] = {}  # Dict[function_call_id, (frame, line, locals, globals)]
 
         # Performance optimization: Multi-layered caching for get_used_globals
         self._bytecode_cache = {}  # Cache for static bytecode analysis (code -> set of accessed names)
-        self._type_cache = {}  # Cache for type checking results (id(obj) -> type_info)
-        self._type_cache_max_size = 10000  # Prevent memory leaks
-        self._globals_result_cache = {}  # Cache for final results (code_id + globals_hash -> result)
+        self._globals_result_cache: dict[tuple[types.CodeType, int], GlobalsClosure] = {}  # Transitive closures ((code, id(globals)) -> closure)
 
         # Performance optimization: Cache for code definitions to avoid expensive inspect operations
         self._code_definition_cache = {}  # Cache for code definition results (func_obj -> {code_def_id, mtime, module_path})
@@ -75,22 +174,56 @@ class SpaceTimeMonitor:
         # Functions to skip one line snapshot (e.g. hotswap function trampoline skip frame)
         self.skip_one_line_snapshot = set()
 
-        # Initialize the database and managers
-        try:
-            # First, initialize the database and ensure tables are created
-            Session = init_db(self.db_path, in_memory)
-
-            # Initialize the function call tracker
-            self.session = Session()
-
-            self.call_tracker = FunctionCallRepository(self.session, pickle_config=self.pickle_config)
-            self.object_manager = ObjectManager(self.session, pickle_config=self.pickle_config)
-
-            logger.info(f"Database initialized successfully at {self.db_path}")
-        except Exception as e:
-            logger.error(f"Failed to initialize database: {e}")
-            logger.error(traceback.format_exc())
-            self.call_tracker = None
+        # Group commits: snapshots and returns are committed according to the policy
+        self.commit_policy = CommitPolicy.from_option(commit_policy)
+
+        # Overhead governor: downgrades the capture level of hot functions when callbacks take too long
+        self.governor = OverheadGovernor.from_option(governor)
+        self._governed_plans: dict[PlanKey, CapturePlan] = {}  # Plans replaced by the governor, restored when it upgrades them back
+        self._governor_changes: list[dict[str, Any]] = []  # Level changes of the current session
+        self._governor_degraded_at_start: dict[str, str] = {}  # Functions downgraded when the session started
+        self._timed = performance or self.governor is not None  # Whether callbacks measure their duration
+
+        # Self-instrumentation: latency histograms of the monitor's phases, per function
+        self._stats = MonitorStats() if performance else None
+        self.stats_textfile = stats_textfile  # Prometheus text file written at session ends and shutdown
+
+        # Values over the capture budget are stored as summaries instead of pickles
+        self.capture_budget = CaptureBudget.from_option(capture_budget)
+        # Hash of the pickles that gives the references of objects
+        self.hasher = content_hasher(hash_function)
+        # Refs and identities already stored, skips the lookups of repeated values
+        self.ref_index = RefIndex.from_option(ref_index)
+        # Strict mode pickles and hashes every captured value, otherwise unchanged values reuse their ref
+        self.strict = strict
+        # Primitives up to this length are inlined in the ref maps instead of stored
+        if not isinstance(inline_primitives, int) or isinstance(inline_primitives, bool) or inline_primitives < 0:
+            raise ValueError(f"Invalid inline_primitives: {inline_primitives!r}. Must be a length, 0 to store every primitive")
+        self.inline_primitives = inline_primitives
+        # Large containers stored as chunks shared by their versions
+        self.chunking = ChunkPolicy.from_option(chunking)
+
+        if capture_backend != "orm" and not async_writer:
+            raise ValueError(f"The {capture_backend} capture backend requires async_writer=True")
+
+        # Incremental checkpoints of the in-memory database to db_path
+        self.checkpoint_policy = CheckpointPolicy.from_option(checkpoint)
+        if self.checkpoint_policy is not None and (not in_memory or db_path == ":memory:"):
+            raise ValueError("Checkpoints require an in-memory database exported to a file (in_memory=True, no shard_by_process)")
+        # Append mode: start empty and merge the new rows into db_path instead of loading and rewriting it
+        if append and (not in_memory or db_path == ":memory:"):
+            raise ValueError("Append mode requires an in-memory database exported to a file (in_memory=True, no shard_by_process)")
+        self.append = append
+        self._writer_options = {
+            "async_writer": async_writer,
+            "queue_size": queue_size,
+            "backpressure": backpressure,
+            "capture_backend": capture_backend,
+        }
+        self._db_lock = threading.RLock()  # Serializes session use between the writer and the monitor
+        self._open_database()
+        if shard_by_process:
+            self._record_shard()
 
         try:
             if sys.monitoring.get_tool(self.MONITOR_TOOL_ID) is None:
@@ -114,6 +247,31 @@ class SpaceTimeMonitor:
                 self.monitor_callback_line
             )
 
+            sys.monitoring.register_callback(
+                self.MONITOR_TOOL_ID,
+                sys.monitoring.events.PY_YIELD,
+                self.monitor_callback_function_yield
+            )
+
+            sys.monitoring.register_callback(
+                self.MONITOR_TOOL_ID,
+                sys.monitoring.events.PY_RESUME,
+                self.monitor_callback_function_resume
+            )
+
+            sys.monitoring.register_callback(
+                self.MONITOR_TOOL_ID,
+                sys.monitoring.events.PY_THROW,
+                self.monitor_callback_function_throw
+            )
+
+            sys.monitoring.register_callback(
+                self.MONITOR_TOOL_ID,
+                sys.monitoring.events.PY_UNWIND,
+                self.monitor_callback_function_unwind
+            )
+            sys.monitoring.set_events(self.MONITOR_TOOL_ID, sys.monitoring.get_events(self.MONITOR_TOOL_ID) | _EXCEPTION_EVENTS)
+
             logger.info("Registered monitoring callbacks")
         except Exception as e:
             logger.error(f"Failed to register monitoring callbacks: {e}")
@@ -122,13 +280,12 @@ class SpaceTimeMonitor:
         if self.performance:
             logger.info("Performance monitoring enabled")
             # Additional performance monitoring setup can go here
+            # Counters, durations are in the histograms of stats()
             self.performance_data = {
-                "function_starts": [],
-                "function_returns": [],
-                "line_events": [],
                 "line_failed_serialization": 0,
                 "line_failed_type": set(),
                 "line_captured_locals": 0,
+                "line_reused_refs": 0,
                 "function_failed_serialization": 0,
                 "function_failed_type": set(),
                 "function_captured_locals": 0,
@@ -137,19 +294,202 @@ class SpaceTimeMonitor:
         SpaceTimeMonitor._instance = self
         logger.info("Monitoring initialized successfully")
 
+    def _open_database(self):
+        """Connect to self.db_path and set up the managers and the writer"""
+        try:
+            # First, initialize the database and ensure tables are created
+            Session = init_db(self.db_path, self.in_memory, load_existing=not self.append)
+
+            # Initialize the function call tracker
+            self.session = Session()
+
+            self.call_tracker = FunctionCallRepository(self.session, pickle_config=self.pickle_config)
+            # Share the object manager so that its caches and ID allocator cover every store
+            self.object_manager = self.call_tracker.object_manager
+
+            # IDs are allocated in memory so that rows can link to each other (parent calls,
+            # snapshot chains, object identities) without flushing to learn their IDs.
+            # In append mode they continue after those of the file, which is not loaded.
+            seeds = max_ids(self.db_path) if self.append else {}
+            self._call_ids = IdAllocator.from_table(self.session, FunctionCall, seeds.get("function_calls", 0))
+            self._snapshot_ids = IdAllocator.from_table(self.session, StackSnapshot, seeds.get("stack_snapshots", 0))
+            self._session_ids = IdAllocator.from_table(self.session, MonitoringSession, seeds.get("monitoring_sessions", 0))
+            self.object_manager.identity_ids = IdAllocator.from_table(
+                self.session, ObjectIdentity, seeds.get("object_identities", 0)
+            )
+            self.object_manager.stats = self._stats
+            self.object_manager.budget = self.capture_budget
+            self.object_manager.hasher = self.hasher
+            self.object_manager.index = self.ref_index
+            self.object_manager.inline_limit = self.inline_primitives
+            self.object_manager.chunking = self.chunking
+            if not self.strict:
+                self.object_manager.changes = ChangeDetector(dispatch_table=self.object_manager.pickle_config.dispatch_table)
+            self.ref_index.reset(self.session)
+
+            logger.info(f"Database initialized successfully at {self.db_path}")
+        except Exception as e:
+            logger.error(f"Failed to initialize database: {e}")
+            logger.error(traceback.format_exc())
+            self.call_tracker = None
+
+        # Writer mode: callbacks only build records, a background thread persists them
+        self.writer: CaptureWriter | None = None
+        options = self._writer_options
+        if options["async_writer"] and self.call_tracker is not None:
+            # Refs whose payload was already handed to the writer, forgotten if the writer rolls back
+            self._submitted_refs = RefIndex(max_refs=self.object_manager.index.max_refs)
+            self.writer = CaptureWriter(
+                self.session,
+                self.object_manager,
+                lock=self._db_lock,
+                queue_size=options["queue_size"],
+                backpressure=options["backpressure"],
+                commit_policy=self.commit_policy,
+                capture_backend=options["capture_backend"],
+                stats=self._stats,
+                on_rollback=self._submitted_refs.clear,
+            )
+            self._last_snapshot_ids: dict[int, int] = {}  # Dict[function_call_id, last snapshot id] for snapshot chains
+
+        # Without a writer, callbacks use the session: monitored threads take turns.
+        # With one, they only build records and threads capture concurrently.
+        self._capture_lock: Any = self._db_lock if self.writer is None else contextlib.nullcontext()
+
+        # Checkpoint mode: a background thread persists new rows to db_path incrementally.
+        # Append mode persists them the same way, at export, with the identities of the run
+        # scoped by the ID they start after: runs that wrote identities start after different IDs.
+        self.checkpointer: Checkpointer | None = None
+        if (self.checkpoint_policy is not None or self.append) and self.call_tracker is not None:
+            identity_scope = f"{self.object_manager.identity_ids.last}:" if self.append else ""
+            with self._db_lock:
+                self.checkpointer = Checkpointer(self.db_path, self.checkpoint_policy, self.session, identity_scope)
+                self.session.commit()
+            self.checkpointer.start(self.checkpoint, lambda: self.commit_policy.events)
+
+    def _record_shard(self, parent_pid: int | None = None, parent_call_id: int | None = None,
+                      parent_session_id: int | None = None, session_id: int | None = None):
+        """Record which process writes the shard database, and where it was forked from"""
+        if self.call_tracker is None:
+            return
+        with self._db_lock:
+            self.session.add(ProcessShard(
+                pid=self._pid,
+                parent_pid=parent_pid,
+                parent_call_id=parent_call_id,
+                parent_session_id=parent_session_id,
+                session_id=session_id,
+            ))
+            self.session.commit()
+
+    def _before_fork(self):
+        """Remember where the process forks, for the shard of the child"""
+        state = getattr(self._thread_local, "state", None)
+        call_id = None
+        if state is not None:
+            call_id = next((call.id for call in reversed(state.call_stack) if call is not _SAMPLED_OUT), None)
+        session = self.current_session
+        self._fork_origin = (self._pid, call_id, session.id if session is not None else None,
+                             session.name if session is not None else None)
+
+    def _after_fork_in_child(self):
+        """Stop using the parent's database in a forked process.
+
+        In shard mode the child continues in its own shard: the calls running
+        in the parent at the fork are kept on the stack as sampled out entries
+        (they return in the child but belong to the parent), and the current
+        session is continued by a session of the shard. Otherwise capture stops
+        in the child, which must neither write to nor export the parent's database.
+        """
+        origin, self._fork_origin = self._fork_origin, None
+        # Locks may have been held by threads that do not exist in the child
+        self._db_lock = threading.RLock()
+        self._order_lock = threading.Lock()
+        if self.governor is not None:
+            self.governor.after_fork()
+        self.ref_index.after_fork()
+        for plan in self._capture_plans.values():
+            if plan.sampler is not None:
+                plan.sampler.after_fork()
+
+        if self._shard_base is None:
+            logger.warning("Monitored process forked without shard_by_process: not capturing in the child process")
+            self.call_tracker = None
+            self.writer = None
+            self.checkpointer = None
+            return
+
+        # Only the forking thread exists in the child
+        inherited = getattr(self._thread_local, "state", None)
+        state = _ThreadState()
+        if inherited is not None:
+            state.call_stack = [_SAMPLED_OUT] * len(inherited.call_stack)
+            state.plan_stack = list(inherited.plan_stack)
+        self._thread_local = threading.local()
+        self._thread_local.state = state
+        self._thread_states = {state.thread_id: state}
+        self._suspended_calls = {key: (_SAMPLED_OUT, plan) for key, (_, plan) in self._suspended_calls.items()}
+
+        # Calls, snapshots and code definitions of the parent are not in the new shard
+        self._current_session_call_count = 0
+        self._current_session_first_call_id = None
+        self._current_session_last_call_id = None
+        self.session_function_calls = {}
+        self._parent_call_child_counts = {}
+        self._function_snapshot_counts = {}
+        self._last_snapshots = {}
+        self._snapshot_states = {}
+        self._line_states = {}
+        self._code_definition_cache = {}
+
+        self._pid = os.getpid()
+        self.db_path = shard_path(self._shard_base, self._pid)
+        self._open_database()
+
+        parent_pid, parent_call_id, parent_session_id, session_name = origin if origin is not None else (None, None, None, None)
+        self.current_session = None
+        if parent_session_id is not None:
+            self.start_session(session_name, metadata={"forked_from": {"pid": parent_pid, "session_id": parent_session_id}})
+        self._record_shard(parent_pid, parent_call_id, parent_session_id,
+                           self.current_session.id if self.current_session is not None else None)
+
+        # multiprocessing workers leave with os._exit(), which skips atexit
+        mp_util = sys.modules.get("multiprocessing.util")
+        if mp_util is not None:
+            mp_util.Finalize(self, self.shutdown, exitpriority=0)
+
     def shutdown(self):
         """Gracefully shut down monitoring"""
+        if self._pid != os.getpid():
+            # Forked without shard_by_process: the database belongs to the parent process
+            return
         logger.info("Starting SpaceTimeMonitor shutdown")
         if self.performance:
             with open("monitoring_performance.json", "w") as f:
                 self.performance_data["line_failed_type"] = [str(t) for t in self.performance_data["line_failed_type"]]
                 self.performance_data["function_failed_type"] = [str(t) for t in self.performance_data["function_failed_type"]]
-                json.dump(self.performance_data, f)
+                json.dump({**self.performance_data, "phases": self._stats.to_dict()}, f)  # type: ignore[union-attr]
+        self.write_stats()
+
+        # Make every captured event durable, whatever the commit policy
+        if self.writer is not None:
+            self.writer.close()
+        else:
+            self.flush()
+
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
 
         if hasattr(self, 'session'):
             try:
                 logger.info("Committing final changes and closing session")
-                if self.in_memory:
+                if self.checkpointer is not None:
+                    # Evicted rows are only on disk: persist the last rows instead of a full backup
+                    self.checkpoint()
+                    with self._db_lock:
+                        self.checkpointer.detach(self.session)
+                    self.session.close()
+                elif self.in_memory:
                     self.export_db()
                     self.session.commit()
                     self.session.close()
@@ -190,12 +530,123 @@ class SpaceTimeMonitor:
                         connection cannot be established.
             Exception: Any exceptions raised during the database backup process.
         """
-        export_db(self.session, self.db_path)
+        if self.checkpointer is not None:
+            # The in-memory database may no longer hold every row (evicted snapshots)
+            self.checkpoint()
+            return
+        self.flush()
+        with self._db_lock:
+            export_db(self.session, self.db_path)
+
+    def checkpoint(self) -> dict[str, int]:
+        """Persist the rows captured since the last checkpoint to db_path (checkpoint mode).
+
+        Returns:
+            Number of rows copied per table and of snapshots evicted from memory
+        """
+        if self.checkpointer is None:
+            raise ValueError("Checkpoints are not enabled, pass checkpoint= to the monitor")
+        self.flush()
+        with self._db_lock:
+            self._commit()
+            return self.checkpointer.checkpoint(self.session)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Make every event captured so far durable.
+
+        In writer mode this waits until the writer thread has committed all
+        submitted events, otherwise it commits the session.
+
+        Args:
+            timeout: Maximum number of seconds to wait for the writer (None waits forever)
+
+        Returns:
+            True if all captured events were committed, False otherwise
+        """
+        if self.writer is not None:
+            return self.writer.flush(timeout)
+        if self.call_tracker is None:
+            return False
+        try:
+            self._commit()
+            return True
+        except Exception:
+            logger.exception("Error committing session during flush")
+            self._rollback()
+            return False
+
+    def commit_stats(self) -> dict[str, int]:
+        """Return the commit policy counters.
+
+        Returns:
+            Dictionary with the number of events written, commits issued, events
+            coalesced into a later commit and events not committed yet. In writer
+            mode the writer counters (submitted, dropped, spilled, persisted) are included.
+        """
+        stats = self.commit_policy.stats()
+        if self.checkpointer is not None:
+            stats.update(self.checkpointer.stats())
+        if self.writer is not None:
+            stats.update({
+                "submitted": self.writer.submitted,
+                "dropped": self.writer.dropped,
+                "spilled": self.writer.spilled,
+                "persisted": self.writer.persisted,
+            })
+        return stats
+
+    def stats(self) -> dict[str, Any]:
+        """Return the measured cost of monitoring.
+
+        Returns:
+            Dictionary with "enabled" (performance=True), "phases" (latency
+            summaries in nanoseconds of every phase, merged under "total" and
+            per function), "counters" (captured, reused and failed values) and
+            "commits" (commit_stats())
+        """
+        if self._stats is None:
+            return {"enabled": False, "phases": {}, "counters": {}, "commits": self.commit_stats()}
+        counters = {name: value for name, value in self.performance_data.items() if isinstance(value, int)}
+        return {"enabled": True, "phases": self._stats.to_dict(), "counters": counters, "commits": self.commit_stats()}
+
+    def write_stats(self, path: str | None = None):
+        """Write the latency histograms to a Prometheus text file (default: stats_textfile)"""
+        path = path or self.stats_textfile
+        if self._stats is None or path is None:
+            return
+        try:
+            self._stats.write_prometheus(path)
+        except OSError as e:
+            logger.error(f"Could not write monitoring stats to {path}: {e}")
+
+    def _commit(self):
+        """Commit the session and reset the pending event count"""
+        if self._stats is not None:
+            t1 = perf_counter_ns()
+        with self._db_lock:
+            self.session.commit()
+        if self._stats is not None:
+            self._stats.record("db_commit", perf_counter_ns() - t1)
+        self.commit_policy.committed()
+
+    def _commit_event(self):
+        """Record a captured event and commit if the commit policy says so"""
+        if self.commit_policy.record():
+            self._commit()
+
+    def _rollback(self):
+        """Roll back the session, discarding every event not committed yet"""
+        self.session.rollback()
+        self.commit_policy.discarded()
+        # Rolled back objects and snapshots are no longer in the database
+        self.object_manager.clear_cache()
+        self._last_snapshots = {}
+        self._snapshot_states = {}
+        self._line_states = {}
 
     def clear_caches(self):
         """Clear all performance caches. Useful for memory management."""
         self._bytecode_cache.clear()
-        self._type_cache.clear()
         self._globals_result_cache.clear()
         self._function_snapshot_counts.clear()
         self._code_definition_cache.clear()
@@ -217,26 +668,34 @@ class SpaceTimeMonitor:
             return None
 
         # Commit any pending changes to ensure data consistency
-        try:
-            self.session.commit()
-        except Exception as e:
-            logger.error(f"Error committing session before starting new monitoring session: {e}")
-            self.session.rollback()
+        self.flush()
 
         # Create a new session
         try:
+            # Anchor the monotonic clock to wall time once per session
+            wall_ns, clock_ns = time_ns(), perf_counter_ns()
             new_session = MonitoringSession(
+                id=self._session_ids.next(),
                 name=name,
                 description=description,
-                start_time=datetime.datetime.now(),
-                session_metadata=metadata or {},
+                start_time=ns_to_datetime(wall_ns),
+                session_metadata={**(metadata or {}), "clock": {"time_ns": wall_ns, "perf_counter_ns": clock_ns}},
             )
 
-            self.session.add(new_session)
-            self.session.commit()
+            with self._db_lock:
+                self.session.add(new_session)
+                self.session.commit()
 
             self.current_session = new_session
+            self._clock_offset_ns = wall_ns - clock_ns
             self.session_function_calls = {}  # Reset the function calls map
+            self._sampling_baseline = {
+                key: (plan.sampler.calls, plan.sampler.recorded)
+                for key, plan in self._original_plans().items() if plan.sampler is not None
+            }
+            self._governor_changes = []
+            if self.governor is not None:
+                self._governor_degraded_at_start = {key[1]: level for key, level in self.governor.degraded.items()}
             # Reset linked list trackers for the new session
             self._current_session_first_call_id = None
             self._current_session_last_call_id = None
@@ -245,9 +704,10 @@ class SpaceTimeMonitor:
             self._current_session_call_count = 0
             self._parent_call_child_counts = {}
             self._function_snapshot_counts = {}
-            # Note: Don't reset bytecode cache or code definition cache as they're static
-            # Only clear type cache for new session (objects may change)
-            self._type_cache = {}
+            self._last_snapshots = {}
+            self._snapshot_states = {}
+            self._line_states = {}
+            # Note: Don't reset bytecode, globals closure or code definition caches as they're static
 
             logger.info(f"Started new monitoring session {new_session.id}: {name}")
             return new_session.id
@@ -270,9 +730,27 @@ class SpaceTimeMonitor:
 
         session_id = self.current_session.id
 
+        # Wait for the writer so that the session's calls are persisted before it is closed
+        self.flush()
+
         try:
             # Update the session with end time
-            setattr(self.current_session, 'end_time', datetime.datetime.now())
+            setattr(self.current_session, 'end_time', ns_to_datetime(perf_counter_ns() + self._clock_offset_ns))
+
+            # Record how the sampled functions were sampled, so that analysis can reweight them
+            metadata = dict(self.current_session.session_metadata or {})
+            sampling = self._sampling_metadata()
+            if sampling:
+                metadata["sampling"] = sampling
+            # Record which functions were captured partially by the governor, and when
+            if self.governor is not None and (self._governor_changes or self._governor_degraded_at_start):
+                metadata["governor"] = {
+                    "budget": self.governor.budget,
+                    "degraded_at_start": self._governor_degraded_at_start,
+                    "changes": self._governor_changes,
+                }
+            if metadata != (self.current_session.session_metadata or {}):
+                self.current_session.session_metadata = metadata
 
             # Set the entry point for the session's call chain
             if self._current_session_first_call_id is not None:
@@ -282,9 +760,11 @@ class SpaceTimeMonitor:
                 logger.warning(f"No first function call recorded for session {session_id}. Entry point not set.")
 
             # Commit the changes including the entry point
-            self.session.commit()
+            with self._db_lock:
+                self.session.commit()
 
             logger.info(f"Ended monitoring session {session_id}")
+            self.write_stats()
 
             # Reset current session and linked list trackers
             self.current_session = None
@@ -296,9 +776,10 @@ class SpaceTimeMonitor:
             self._current_session_call_count = 0
             self._parent_call_child_counts = {}
             self._function_snapshot_counts = {}
-            # Note: Don't reset bytecode cache or code definition cache as they're static
-            # Only clear type cache for new session (objects may change)
-            self._type_cache = {}
+            self._last_snapshots = {}
+            self._snapshot_states = {}
+            self._line_states = {}
+            # Note: Don't reset bytecode, globals closure or code definition caches as they're static
 
             return session_id
 
@@ -308,6 +789,24 @@ class SpaceTimeMonitor:
             self.session.rollback()
             return None
 
+    def _original_plans(self) -> dict[PlanKey, CapturePlan]:
+        """Plans by function key, as configured before the governor changed them"""
+        if not self._governed_plans:
+            return self._capture_plans_by_key
+        return {**self._capture_plans_by_key, **self._governed_plans}
+
+    def _sampling_metadata(self) -> dict[str, dict[str, Any]]:
+        """Sampling parameters and call counts of the sampled functions called during the session"""
+        sampling = {}
+        for key, plan in self._original_plans().items():
+            sampler = plan.sampler
+            if sampler is None:
+                continue
+            calls, recorded = self._sampling_baseline.get(key, (0, 0))
+            if sampler.calls > calls:
+                sampling[key[1]] = {**sampler.describe(), "calls": sampler.calls - calls, "recorded": sampler.recorded - recorded}
+        return sampling
+
     def add_function_call_to_session(self, function_name, call_id):
         """Add a function call to the current session.
 
@@ -325,7 +824,172 @@ class SpaceTimeMonitor:
         # Add the call ID to the list
         self.session_function_calls[function_name].append(call_id)
 
-    def _store_variables(self, variables: dict[str, Any]) -> dict[str, str]:
+    @classmethod
+    def register_plan(cls, plan: CapturePlan):
+        """Register the capture plan of a code object"""
+        previous = cls._capture_plans_by_key.get(plan.key)
+        if previous is not None:
+            # Keep the tracking information registered by other decorators
+            plan.tracking_keys |= previous.tracking_keys
+        cls._capture_plans[plan.code] = plan
+        cls._capture_plans_by_key[plan.key] = plan
+        if previous is not None and previous.allowed_lines is not None and previous.allowed_lines != plan.allowed_lines:
+            # Lines pruned with DISABLE under the old configuration may be captured now
+            sys.monitoring.restart_events()
+
+    @classmethod
+    def set_line_filter(cls, func, lines: list[int] | None = None, use_tag_line: bool = False):
+        """Change which lines of a monitored function are snapshot in line mode.
+
+        Lines that were pruned under the previous configuration are reported
+        again by the interpreter.
+
+        Args:
+            func: A function decorated with pymonitor
+            lines: Line numbers to snapshot (None for every line)
+            use_tag_line: If True, only snapshot lines containing the comment "#tag"
+        """
+        previous = cls._capture_plans.get(func.__code__)
+        if previous is None:
+            raise ValueError(f"Function {func.__name__} is not monitored")
+        cls.register_plan(previous.rebind(func.__code__, previous.func, lines=lines, use_tag_line=use_tag_line))
+
+    def _resolve_plan(self, code: types.CodeType, frame) -> CapturePlan:
+        """Find the plan of a code object that was not compiled by a decorator.
+
+        This happens when a monitored function is reloaded (new code object,
+        same function key) or when events were enabled by other means. The
+        result is cached by code object.
+        """
+        func = frame.f_globals.get(code.co_name) if frame is not None else None
+        if getattr(func, "__code__", None) is not code:
+            func = None
+        previous = self._capture_plans_by_key.get(plan_key(code))
+        plan = previous.rebind(code, func) if previous is not None else CapturePlan(code, func=func)
+        SpaceTimeMonitor._capture_plans[code] = plan
+        return plan
+
+    def _thread_state(self) -> _ThreadState:
+        """Return the monitored calls of the current thread"""
+        try:
+            return self._thread_local.state
+        except AttributeError:
+            state = self._thread_local.state = _ThreadState()
+            self._thread_states[state.thread_id] = state
+            return state
+
+    @property
+    def call_stack(self) -> list[FunctionCall | PendingCall]:
+        """Monitored calls running on the current thread, innermost last"""
+        return self._thread_state().call_stack
+
+    @property
+    def _parent_id_for_next_call(self) -> int | None:
+        return self._thread_state().parent_id_for_next_call
+
+    @_parent_id_for_next_call.setter
+    def _parent_id_for_next_call(self, parent_id: int | None):
+        self._thread_state().parent_id_for_next_call = parent_id
+
+    def _is_running(self, key: PlanKey) -> bool:
+        """Whether a recorded call of a function is running on any thread"""
+        # Copy first, other threads may register their state meanwhile
+        return any(state.active_plan_counts.get(key) for state in self._thread_states.copy().values())
+
+    def _skip_call(self, state: _ThreadState, plan: CapturePlan, code: types.CodeType):
+        """Push a sampled out call: it is popped by its return and its lines are not captured"""
+        state.call_stack.append(_SAMPLED_OUT)
+        state.plan_stack.append(plan)  # Not counted as active, its tracked functions are skipped too
+        # Line events are enabled per code object, for every thread
+        if plan.mode == "line" and code not in self._suspended_line_codes and not self._is_running(plan.key):
+            # No recorded call of the function is running: stop the interpreter from reporting its lines
+            events = sys.monitoring.get_local_events(self.MONITOR_TOOL_ID, code)
+            sys.monitoring.set_local_events(self.MONITOR_TOOL_ID, code, events & ~sys.monitoring.events.LINE)
+            self._suspended_line_codes.add(code)
+
+    def _resume_line_events(self, code: types.CodeType):
+        """Report the lines of a code object again (they take effect in the running frame)"""
+        events = sys.monitoring.get_local_events(self.MONITOR_TOOL_ID, code)
+        sys.monitoring.set_local_events(self.MONITOR_TOOL_ID, code, events | sys.monitoring.events.LINE)
+        self._suspended_line_codes.discard(code)
+
+    def _record_timing(self, event: str, code: types.CodeType, plan: CapturePlan, t1: float):
+        """Record the time spent in a callback, for the performance data and the governor"""
+        t2 = perf_counter()
+        if self._stats is not None:
+            self._stats.record(event, int((t2 - t1) * 1e9), plan.key[1])
+        if self.governor is not None:
+            changes = self.governor.record(plan, t2 - t1, t2)
+            if changes:
+                self._apply_governor_changes(changes)
+
+    def _apply_governor_changes(self, changes: list[tuple[PlanKey, str, str]]):
+        """Switch functions to the capture levels decided by the governor"""
+        for key, old_level, new_level in changes:
+            plan = self._capture_plans_by_key.get(key)
+            if plan is None:
+                continue
+            original = self._governed_plans.setdefault(key, plan)
+            if new_level == original.mode:
+                new_plan = self._governed_plans.pop(key)
+            elif new_level == "function":
+                new_plan = original.rebind(plan.code, plan.func, mode="function")
+            else:
+                # Calls that are not recorded still push a marker, so PY_START and PY_RETURN stay on
+                sampler = Sampler(every=self.governor.sample_every) if new_level == "sampled" else Sampler(probability=0.0)  # type: ignore[union-attr]
+                new_plan = original.rebind(plan.code, plan.func, mode="function", sampler=sampler)
+            self.register_plan(new_plan)
+
+            events = sys.monitoring.get_local_events(self.MONITOR_TOOL_ID, new_plan.code)
+            if new_plan.mode == "line":
+                events |= sys.monitoring.events.LINE
+            else:
+                events &= ~sys.monitoring.events.LINE
+            sys.monitoring.set_local_events(self.MONITOR_TOOL_ID, new_plan.code, events)
+            self._suspended_line_codes.discard(new_plan.code)
+
+            logger.info(f"Governor changed {key[1]} from {old_level} to {new_level} (overhead {self.governor.overhead:.1%})")  # type: ignore[union-attr]
+            self._governor_changes.append({
+                "function": key[1],
+                "from": old_level,
+                "to": new_level,
+                "time": datetime.datetime.now().isoformat(),
+                "overhead": self.governor.overhead,  # type: ignore[union-attr]
+            })
+
+    def _push_plan(self, state: _ThreadState, plan: CapturePlan):
+        state.plan_stack.append(plan)
+        state.active_plan_counts[plan.key] = state.active_plan_counts.get(plan.key, 0) + 1
+
+    def _pop_plan(self, state: _ThreadState) -> CapturePlan:
+        plan = state.plan_stack.pop()
+        state.active_plan_counts[plan.key] -= 1
+        return plan
+
+    def _capture_value(self, value: Any, pending: list[PreparedObject] | None) -> str:
+        """Store a value and return its reference.
+
+        In writer mode the value is only serialized: its payload is appended to
+        ``pending`` (unless it was already submitted) and persisted by the writer.
+        """
+        if pending is None:
+            return self.call_tracker.object_manager.store(value)  # type: ignore
+        ref, prepared = self.object_manager.prepare(value, self._submitted_refs)
+        if prepared is not None:
+            self._submitted_refs.add(ref)
+            pending.append(prepared)
+        return ref
+
+    def _submit(self, pending: list[PreparedObject], record) -> bool:
+        """Hand a record to the writer, forgetting its objects if it gets dropped"""
+        assert self.writer is not None
+        if self.writer.submit(pending, record):
+            return True
+        for prepared in pending:
+            self._submitted_refs.discard(prepared.ref)
+        return False
+
+    def _store_variables(self, variables: dict[str, Any], pending: list[PreparedObject] | None = None) -> dict[str, str]:
         """Store variables and return a dictionary of variable names to object references"""
         refs = {}
         for name, value in variables.items():
@@ -334,7 +998,7 @@ class SpaceTimeMonitor:
                 continue
             try:
                 # Store the value and get its reference
-                ref = self.object_manager.store(value)
+                ref = self.object_manager.store(value) if pending is None else self._capture_value(value, pending)
                 # Always store the reference, not the value
                 refs[name] = ref
             except Exception as e:
@@ -422,7 +1086,16 @@ class SpaceTimeMonitor:
                         current_mtime = None
 
                 # Only store code definition if we have all required info
-                if module_path:
+                if module_path and self.writer is not None:
+                    code_def_id = ObjectManager.code_definition_id(source_code)
+                    self._submit([], CodeDefinitionRecord(
+                        name=code_name,
+                        type='function',
+                        module_path=module_path,
+                        code_content=source_code,
+                        first_line_no=first_line_no
+                    ))
+                elif module_path:
                     # Get code definition ID by storing/retrieving
                     code_def_id = self.call_tracker.object_manager.store_code_definition(
                         name=code_name,
@@ -461,27 +1134,31 @@ class SpaceTimeMonitor:
             return None
 
         try:
-            # Get the function call
+            # Get the function call (from the identity map for calls on the stack)
             call = self.session.get(FunctionCall, call_id)
             if not call:
                 logger.error(f"Function call {call_id} not found during stack snapshot creation")
                 return None
 
             # Find the previous snapshot if any
-            prev_snapshot = None
-            if order_in_call is not None and order_in_call > 0:
+            prev_snapshot = self._last_snapshots.get(call_id)
+            if prev_snapshot is None and order_in_call is not None and order_in_call > 0:
                 prev_snapshot = self.session.query(StackSnapshot).filter(
                     StackSnapshot.function_call_id == call_id,
                     StackSnapshot.order_in_call == order_in_call - 1
                 ).first()
 
-            # Create the new snapshot
+            # Create the new snapshot, its ID is allocated in memory
+            locals_refs, globals_refs, is_keyframe = self._encode_snapshot(call_id, locals_dict, globals_dict)
             snapshot = StackSnapshot(
+                id=self._snapshot_ids.next(),
                 function_call_id=call_id,
                 line_number=line_number,
-                locals_refs=locals_dict,
-                globals_refs=globals_dict,
-                order_in_call=order_in_call
+                timestamp_ns=perf_counter_ns() + self._clock_offset_ns,
+                locals_refs=locals_refs,
+                globals_refs=globals_refs,
+                order_in_call=order_in_call,
+                is_keyframe=is_keyframe
             )
 
             # Set bidirectional link if previous snapshot exists
@@ -494,7 +1171,8 @@ class SpaceTimeMonitor:
             if order_in_call == 0 or not call.first_snapshot_id:
                 call.first_snapshot_id = snapshot.id
 
-            self.session.flush()  # Flush to get the ID
+            self._last_snapshots[call_id] = snapshot
+            self._snapshot_recorded(call_id, locals_dict, globals_dict, is_keyframe)
 
             return snapshot
         except Exception as e:
@@ -502,290 +1180,446 @@ class SpaceTimeMonitor:
             logger.error(traceback.format_exc())
             return None
 
-    def monitor_callback_function_start(self, code: types.CodeType, offset):
-        # Check if recording is enabled
-        logger.info(f"Monitoring function start: {code.co_name}")
-        if not self.is_recording_enabled:
+    def _encode_snapshot(self, call_id: int, locals_refs: dict[str, str],
+                         globals_refs: dict[str, str]) -> tuple[dict[str, str | None], dict[str, str | None], bool]:
+        """Return the refs to store for the next snapshot of a call and whether it is a keyframe"""
+        interval = self.snapshot_keyframe_interval
+        state = self._snapshot_states.get(call_id)
+        if interval is None or state is None or state[2] + 1 >= interval:
+            return locals_refs, globals_refs, True
+        return diff_snapshot_refs(state[0], locals_refs), diff_snapshot_refs(state[1], globals_refs), False
+
+    def _snapshot_recorded(self, call_id: int, locals_refs: dict[str, str], globals_refs: dict[str, str], is_keyframe: bool):
+        """Remember the full state of a recorded snapshot, the base of the next delta"""
+        if self.snapshot_keyframe_interval is None:
             return
-        if self.call_tracker is None:
-            return
-        if self.performance:
-            t1 = perf_counter()
-
-        current_frame = inspect.currentframe()
-        if current_frame is None or current_frame.f_back is None:
-            return
-
-        frame = current_frame.f_back
-        func_name = code.co_name
-        func_obj = frame.f_globals.get(func_name)
-
-        # Check if this is a tracked function and if so,
-        # verify that its tracking function is in our call stack
-        is_tracked_function = False
-        tracking_function_name = None
+        deltas = 0 if is_keyframe else self._snapshot_states[call_id][2] + 1
+        self._snapshot_states[call_id] = (locals_refs, globals_refs, deltas)
 
-        # Check direct attribute on function object
-        if func_obj and func_name in SpaceTimeMonitor._tracked_functions:
-            tracking_function_name = SpaceTimeMonitor._tracked_functions[func_name]["parent_tracking_function"]
-
-        # If we found tracking information, verify it's in our call stack
-        if tracking_function_name:
-            if not self.call_stack:
+    def monitor_callback_function_start(self, code: types.CodeType, offset):
+        with self._capture_lock:
+            # Check if recording is enabled
+            logger.info("Monitoring function start: %s", code.co_name)
+            if not self.is_recording_enabled:
                 return
-
-            for call in self.call_stack:
-                if call.function == tracking_function_name:
-                    is_tracked_function = True
-                    break
-
-            if not is_tracked_function:
+            if self.call_tracker is None:
                 return
+            if self._timed:
+                t1 = perf_counter()
 
+            current_frame = inspect.currentframe()
+            if current_frame is None or current_frame.f_back is None:
+                return
 
-        # Get the function's parameter names from its code object
-        arg_names = code.co_varnames[:code.co_argcount]
+            frame = current_frame.f_back
+            plan = self._capture_plans.get(code) or self._resolve_plan(code, frame)
+            state = self._thread_state()
+            stats = self._stats
+            if stats is not None:
+                stats.function = plan.key[1]
 
-        # Get the values of the arguments from the frame's locals
-        function_locals = {}
-        for arg_name in arg_names:
-            if arg_name in frame.f_locals:
-                function_locals[arg_name] = frame.f_locals[arg_name]
-        # Get used globals
-        globals_used = self.get_used_globals(code, frame.f_globals)
-        # Get ignored variables from the function object itself
-        ignored_variables = []
-        if func_obj and func_name in SpaceTimeMonitor._monitored_functions:
-            ignored_variables = SpaceTimeMonitor._monitored_functions[func_name]["ignore"] or [] # Ensure it's a list
+            # A tracked function is only recorded while one of its tracking functions is running (on the same thread)
+            if plan.tracking_keys and not any(state.active_plan_counts.get(key) for key in plan.tracking_keys):
+                return
 
-        # Get hooks from the function object
-        start_hooks = []
-        if func_obj:
-            # Safely get start_hooks, handling case where function isn't registered
-            if func_name in SpaceTimeMonitor._monitored_functions:
-                start_hooks = SpaceTimeMonitor._monitored_functions[func_name]["start_hooks"] or []
+            if plan.sampler is not None and not plan.sampler.should_record():
+                self._skip_call(state, plan, code)
+                return
+            if code in self._suspended_line_codes:
+                self._resume_line_events(code)
+
+            # Get the values of the arguments from the frame's locals
+            if stats is not None:
+                t_frame = perf_counter_ns()
+            frame_locals = frame.f_locals
+            ignored_variables = plan.ignore
+            if plan.watch is not None:
+                # Only the watched paths are captured
+                function_locals, globals_used = plan.watched_values(frame_locals, frame.f_globals)
             else:
-                # Function not explicitly registered for monitoring, use empty hooks
-                logger.debug(f"Function '{func_name}' not found in _monitored_functions, using empty start_hooks")
-                start_hooks = []
+                function_locals = {}
+                for arg_name in plan.arg_names:
+                    if arg_name in frame_locals and arg_name not in ignored_variables:
+                        function_locals[arg_name] = frame_locals[arg_name]
+            if stats is not None:
+                stats.record("frame_inspection", perf_counter_ns() - t_frame)
+            if plan.watch is None:
+                # Get used globals
+                globals_used = self.get_used_globals(code, frame.f_globals)
+                if ignored_variables:
+                    globals_used = {k: v for k, v in globals_used.items() if k not in ignored_variables}
+
+            # Get cached code definition (performance optimization)
+            code_def_id = self._get_cached_code_definition(plan.func, code.co_name) if plan.func else None
+
+            # Execute start hooks and collect initial metadata
+            start_metadata = {}
+
+            for hook in plan.start_hooks:
+                try:
+                    hook_metadata = hook(self, code, offset)
+                    if isinstance(hook_metadata, dict):
+                        start_metadata.update(hook_metadata)
+                    else:
+                        logger.warning(f"Start hook {hook.__name__} for {code.co_name} did not return a dict.")
+                except Exception as hook_exc:
+                    logger.error(f"Error executing start hook {hook.__name__} for {code.co_name}: {hook_exc}")
+                    logger.error(traceback.format_exc())
 
-        # Filter locals and globals based on the ignore list
-        function_locals = {k: v for k, v in function_locals.items() if k not in ignored_variables}
-        globals_used = {k: v for k, v in globals_used.items() if k not in ignored_variables}
+            # Get the actual file and line number from the code object
+            file_name = code.co_filename
+            line_number = code.co_firstlineno
 
-        # Get cached code definition (performance optimization)
-        code_def_id = self._get_cached_code_definition(func_obj, code.co_name) if func_obj else None
+            # Get function qualname for better tracking
+            function_qualname = code.co_name
+            try:
+                if 'self' in frame.f_locals and hasattr(frame.f_locals['self'], '__class__'):
+                    function_qualname = f"{frame.f_locals['self'].__class__.__name__}.{code.co_name}"
+            except Exception:
+                pass  # Use simple name if extraction fails
 
-        # Execute start hooks and collect initial metadata
-        start_metadata = {}
 
-        for hook in start_hooks:
+            # Create the function call directly (inlined capture_call)
             try:
-                hook_metadata = hook(self, code, offset)
-                if isinstance(hook_metadata, dict):
-                    start_metadata.update(hook_metadata)
+                # Store local and global variables
+                pending = [] if self.writer is not None else None
+                locals_refs = self._store_variables(function_locals, pending)
+                globals_refs = self._store_variables(globals_used, pending)
+
+                # Check if a parent ID was set for replay
+                parent_id = state.parent_id_for_next_call
+                replayed_siblings = None
+                if parent_id is not None:
+                    # Reset the flag immediately after reading it
+                    state.parent_id_for_next_call = None
+                    logger.info(f"Replay detected: Setting parent_call_id to {parent_id} for next call.")
+                    with self._order_lock:
+                        counted = parent_id in self._parent_call_child_counts
+                    if not counted:
+                        # The replayed parent already ended and its counter was dropped
+                        replayed_siblings = self._count_children(parent_id)
+
+                # If we're inside another monitored function (stack isn't empty), get the parent ID
+                if not parent_id:
+                    # Sampled out calls are skipped, the parent is the closest recorded call
+                    parent_id = next((call.id for call in reversed(state.call_stack) if call is not _SAMPLED_OUT), None)
+
+                with self._order_lock:
+                    # Calculate order in session using in-memory counter (performance optimization)
+                    order_in_session = None
+                    if self.current_session is not None:
+                        order_in_session = self._current_session_call_count
+                        self._current_session_call_count += 1
+
+                    # Calculate order within parent function using in-memory counter (performance optimization)
+                    order_in_parent = None
+                    if replayed_siblings is not None:
+                        order_in_parent = replayed_siblings
+                    elif parent_id is not None:
+                        order_in_parent = self._parent_call_child_counts.get(parent_id, 0)
+                        self._parent_call_child_counts[parent_id] = order_in_parent + 1
+
+                # Get the current session ID from the monitor instance, if available
+                current_session_id = None
+                if self.current_session:
+                    current_session_id = self.current_session.id
+
+                if pending is not None:
+                    # Writer mode: hand a record to the writer thread
+                    call_id = self._call_ids.next()
+                    submitted = self._submit(pending, CallStart(
+                        id=call_id,
+                        function=function_qualname,
+                        file=file_name,
+                        line=line_number,
+                        start_ns=perf_counter_ns() + self._clock_offset_ns,
+                        locals_refs=locals_refs,
+                        globals_refs=globals_refs,
+                        code_definition_id=code_def_id,
+                        call_metadata=start_metadata,
+                        parent_call_id=parent_id,
+                        session_id=current_session_id,
+                        order_in_session=order_in_session,
+                        order_in_parent=order_in_parent,
+                        thread_id=state.thread_id,
+                        thread_name=state.thread_name,
+                        task_name=_current_task_name(),
+                        process_id=self._pid
+                    ))
+                    call = PendingCall(call_id, function_qualname, start_metadata, dropped=not submitted)
                 else:
-                    logger.warning(f"Start hook {hook.__name__} for {code.co_name} did not return a dict.")
-            except Exception as hook_exc:
-                logger.error(f"Error executing start hook {hook.__name__} for {code.co_name}: {hook_exc}")
-                logger.error(traceback.format_exc())
-
-        # Get the actual file and line number from the code object
-        file_name = code.co_filename
-        line_number = code.co_firstlineno
-
-        # Get function qualname for better tracking
-        function_qualname = code.co_name
-        try:
-            if 'self' in frame.f_locals and hasattr(frame.f_locals['self'], '__class__'):
-                function_qualname = f"{frame.f_locals['self'].__class__.__name__}.{code.co_name}"
-        except Exception:
-            pass  # Use simple name if extraction fails
-
-
-        # Create the function call directly (inlined capture_call)
-        try:
-            # Store local and global variables
-            locals_refs = self._store_variables(function_locals)
-            globals_refs = self._store_variables(globals_used)
-
-            # Check if a parent ID was set for replay
-            parent_id = self._parent_id_for_next_call
-            if parent_id is not None:
-                # Reset the flag immediately after reading it
-                self._parent_id_for_next_call = None
-                logger.info(f"Replay detected: Setting parent_call_id to {parent_id} for next call.")
-
-            # If we're inside another monitored function (stack isn't empty), get the parent ID
-            if not parent_id and len(self.call_stack) > 0:
-                parent_id = self.call_stack[-1].id
-
-            # Calculate order in session using in-memory counter (performance optimization)
-            order_in_session = None
-            if self.current_session is not None:
-                order_in_session = self._current_session_call_count
-
-            # Calculate order within parent function using in-memory counter (performance optimization)
-            order_in_parent = None
-            if parent_id is not None:
-                order_in_parent = self._parent_call_child_counts.get(parent_id, 0)
-
-            # Get the current session ID from the monitor instance, if available
-            current_session_id = None
-            if self.current_session:
-                current_session_id = self.current_session.id
-
-            # Create function call record directly
-            call = FunctionCall(
-                function=function_qualname,
-                file=file_name,
-                line=line_number,
-                start_time=datetime.datetime.now(),
-                locals_refs=locals_refs,
-                globals_refs=globals_refs,
-                code_definition_id=code_def_id,
-                call_metadata=start_metadata,
-                parent_call_id=parent_id,
-                session_id=current_session_id,
-                order_in_session=order_in_session,
-                order_in_parent=order_in_parent
-            )
-
-            self.session.add(call)
-            self.session.flush()  # Flush to get the ID
-            if call.id is None:
-                logger.error(f"Failed to obtain ID for new FunctionCall for {function_qualname}")
-                self.session.rollback()
-                return
-
-            # Add the FunctionCall object to the stack instead of just the ID
-            self.call_stack.append(call)
+                    # Create function call record directly, its ID is allocated in memory
+                    call = FunctionCall(
+                        id=self._call_ids.next(),
+                        function=function_qualname,
+                        file=file_name,
+                        line=line_number,
+                        start_ns=perf_counter_ns() + self._clock_offset_ns,
+                        locals_refs=locals_refs,
+                        globals_refs=globals_refs,
+                        code_definition_id=code_def_id,
+                        call_metadata=start_metadata,
+                        parent_call_id=parent_id,
+                        session_id=current_session_id,
+                        order_in_session=order_in_session,
+                        order_in_parent=order_in_parent,
+                        thread_id=state.thread_id,
+                        thread_name=state.thread_name,
+                        task_name=_current_task_name(),
+                        process_id=self._pid
+                    )
 
-            # Track the first call in the session as the entry point
-            if self._current_session_first_call_id is None:
-                self._current_session_first_call_id = call.id
-                logger.debug(f"Set first call ID for session to {call.id}")
+                    self.session.add(call)
 
-            # Update the last call ID to the current one
-            self._current_session_last_call_id = call.id
+                # Add the FunctionCall object to the stack instead of just the ID
+                state.call_stack.append(call)
+                self._push_plan(state, plan)
 
-            # If we have an active session, add this function call to it
-            if self.current_session is not None and call.id is not None:
-                self.add_function_call_to_session(function_qualname, call.id)
+                with self._order_lock:
+                    # Track the first call in the session as the entry point
+                    if self._current_session_first_call_id is None:
+                        self._current_session_first_call_id = call.id
+                        logger.debug(f"Set first call ID for session to {call.id}")
 
-            # Increment counters after successful call creation (performance optimization)
-            if self.current_session is not None:
-                self._current_session_call_count += 1
+                    # Update the last call ID to the current one
+                    self._current_session_last_call_id = call.id
 
-            if parent_id is not None:
-                self._parent_call_child_counts[parent_id] = self._parent_call_child_counts.get(parent_id, 0) + 1
+                    # Initialize snapshot counter for this function call
+                    self._function_snapshot_counts[call.id] = 0
 
-            # Initialize snapshot counter for this function call
-            self._function_snapshot_counts[call.id] = 0
+                # If we have an active session, add this function call to it
+                if self.current_session is not None and call.id is not None:
+                    self.add_function_call_to_session(function_qualname, call.id)
 
-        except Exception as e:
-            logger.error(f"Error capturing function call: {e}")
-            logger.error(traceback.format_exc())
-            self.session.rollback()
+            except Exception as e:
+                logger.error(f"Error capturing function call: {e}")
+                logger.error(traceback.format_exc())
+                if self.writer is None:
+                    self._rollback()
 
-        if self.performance:
-            t2 = perf_counter()
-            elapsed = t2 - t1
-            self.performance_data["function_starts"].append((func_name, elapsed))
+            if self._timed:
+                self._record_timing("function_starts", code, plan, t1)
 
 
     def monitor_callback_function_return(self, code: types.CodeType, offset, return_value):
-        # Check if recording is enabled
-        logger.info(f"Monitoring function return: {code.co_name}")
-        if not self.is_recording_enabled:
-            return
-
-        if self.call_tracker is None or not self.call_stack:
-            return
-
-        if self.performance:
-            t1 = perf_counter()
-
-        collected_return_metadata = {}
-        try:
-            # Get the FunctionCall object for this function
-            call = self.call_stack.pop()
+        with self._capture_lock:
+            # Check if recording is enabled
+            logger.info("Monitoring function return: %s", code.co_name)
+            if self.call_tracker is None:
+                return
+            state = self._thread_state()
+            if not state.plan_stack:
+                return
 
-            # Get the function object from the frame
-            frame = inspect.currentframe()
-            if frame is None or frame.f_back is None:
+            # Only returns of recorded calls pop the stack (the start may have been skipped)
+            plan = self._capture_plans.get(code) or self._resolve_plan(code, inspect.currentframe().f_back)  # type: ignore
+            if state.plan_stack[-1].key != plan.key:
+                return
+            if state.call_stack[-1] is _SAMPLED_OUT:
+                state.call_stack.pop()
+                state.plan_stack.pop()
                 return
-            func_obj = frame.f_back.f_globals.get(code.co_name)
-            return_hooks = []
-            if func_obj:
-                # Safely get return_hooks, handling case where function isn't registered
-                if code.co_name in SpaceTimeMonitor._monitored_functions:
-                    return_hooks = SpaceTimeMonitor._monitored_functions[code.co_name]["return_hooks"] or []
-                else:
-                    # Function not explicitly registered for monitoring, use empty hooks
-                    logger.debug(f"Function '{code.co_name}' not found in _monitored_functions, using empty return_hooks")
-                    return_hooks = []
 
-            # Execute return hooks if any
-            for hook in return_hooks:
-                try:
-                    # Pass monitor instance, code object, offset, and return value
-                    hook_metadata = hook(self, code, offset, return_value)
-                    if isinstance(hook_metadata, dict):
-                        # Merge hook metadata, preferring hook's values on conflict
-                        collected_return_metadata.update(hook_metadata)
-                    else:
-                        logger.warning(f"Return hook {hook.__name__} for {code.co_name} did not return a dict.")
-                except Exception as hook_exc:
-                    logger.error(f"Error executing return hook {hook.__name__} for {code.co_name}: {hook_exc}")
-                    logger.error(traceback.format_exc())
+            if self._timed:
+                t1 = perf_counter()
+            if self._stats is not None:
+                self._stats.function = plan.key[1]
 
-            # Inline capture_return functionality - store return value and update call
+            collected_return_metadata = {}
             try:
-                return_ref = self.call_tracker.object_manager.store(return_value)
-                call.return_ref = return_ref
-                call.end_time = datetime.datetime.now()
-
-                # Update metadata with hook results (if any)
-                if collected_return_metadata:
-                    # If there's existing metadata, merge it with the new data
-                    if call.call_metadata:
-                        # Create a new dict to avoid modifying the original
-                        updated_metadata = dict(call.call_metadata)
-                        updated_metadata.update(collected_return_metadata)
-                        call.call_metadata = updated_metadata
-                    else:
-                        call.call_metadata = collected_return_metadata
+                # Get the FunctionCall object for this function
+                call = state.call_stack.pop()
+                self._pop_plan(state)
+                return_hooks = plan.return_hooks
 
-                # Clean up snapshot counter (performance optimization)
-                if call.id in self._function_snapshot_counts:
-                    del self._function_snapshot_counts[call.id]
+                # Execute return hooks if any
+                for hook in return_hooks:
+                    try:
+                        # Pass monitor instance, code object, offset, and return value
+                        hook_metadata = hook(self, code, offset, return_value)
+                        if isinstance(hook_metadata, dict):
+                            # Merge hook metadata, preferring hook's values on conflict
+                            collected_return_metadata.update(hook_metadata)
+                        else:
+                            logger.warning(f"Return hook {hook.__name__} for {code.co_name} did not return a dict.")
+                    except Exception as hook_exc:
+                        logger.error(f"Error executing return hook {hook.__name__} for {code.co_name}: {hook_exc}")
+                        logger.error(traceback.format_exc())
+
+                if isinstance(call, PendingCall):
+                    self._submit_return(call, return_value, collected_return_metadata)
+                    if self._timed:
+                        self._record_timing("function_returns", code, plan, t1)
+                    return
+
+                # Inline capture_return functionality - store return value and update call
+                try:
+                    return_ref = self.call_tracker.object_manager.store(return_value)
+                    call.return_ref = return_ref
+                    call.end_ns = perf_counter_ns() + self._clock_offset_ns
+
+                    # Update metadata with hook results (if any)
+                    if collected_return_metadata:
+                        # If there's existing metadata, merge it with the new data
+                        if call.call_metadata:
+                            # Create a new dict to avoid modifying the original
+                            updated_metadata = dict(call.call_metadata)
+                            updated_metadata.update(collected_return_metadata)
+                            call.call_metadata = updated_metadata
+                        else:
+                            call.call_metadata = collected_return_metadata
+
+                    # Clean up snapshot counter and chain (performance optimization)
+                    self._forget_call(call.id)
+
+                    # Commit the changes (according to the commit policy)
+                    self._commit_event()
 
-                # Commit the changes
-                self.session.commit()
+                except Exception as e:
+                    logger.warning(f"Could not store return value: {e}")
+                    self._rollback()
 
             except Exception as e:
-                logger.warning(f"Could not store return value: {e}")
-                self.session.rollback()
+                logger.error(f"Error capturing function return: {e}")
+                logger.error(traceback.format_exc())
+                self._rollback()
 
+            if self._timed:
+                self._record_timing("function_returns", code, plan, t1)
+
+    def _submit_return(self, call: PendingCall, return_value, return_metadata: dict,
+                       exception: BaseException | None = None):
+        """Writer mode counterpart of the return capture: submit a CallEnd record"""
+        self._forget_call(call.id)
+        if call.dropped:
+            return
+        try:
+            pending: list[PreparedObject] = []
+            if exception is None:
+                return_ref, exception_ref = self._capture_value(return_value, pending), None
+            else:
+                return_ref, exception_ref = None, self._capture_exception(exception, pending)
+            call_metadata = call.call_metadata
+            if return_metadata:
+                call_metadata = {**(call_metadata or {}), **return_metadata}
+            self._submit(pending, CallEnd(
+                id=call.id,
+                end_ns=perf_counter_ns() + self._clock_offset_ns,
+                return_ref=return_ref,
+                call_metadata=call_metadata,
+                exception_ref=exception_ref
+            ))
         except Exception as e:
-            logger.error(f"Error capturing function return: {e}")
-            logger.error(traceback.format_exc())
-            self.session.rollback()
+            logger.warning(f"Could not store return value: {e}", exc_info=True)
 
-        if self.performance:
-            t2 = perf_counter()
-            elapsed = t2 - t1
-            self.performance_data["function_returns"].append((code.co_name, elapsed))
+    def monitor_callback_function_unwind(self, code: types.CodeType, offset, exception):
+        """Callback for frames exited by an exception: close the call with an exception ref
 
-    def _get_accessed_global_names(self, code: types.CodeType, processed_functions=None):
+        PY_UNWIND can only be enabled globally, frames of functions that are not
+        monitored are filtered out first, without taking the capture lock.
+        """
+        state = getattr(self._thread_local, "state", None)
+        if state is None or not state.plan_stack or self.call_tracker is None:
+            return
+        plan = self._capture_plans.get(code)
+        if plan is None or state.plan_stack[-1].key != plan.key:
+            return
+        with self._capture_lock:
+            call = state.call_stack.pop()
+            if call is _SAMPLED_OUT:
+                state.plan_stack.pop()
+                return
+            self._pop_plan(state)
+
+            if self._timed:
+                t1 = perf_counter()
+            if self._stats is not None:
+                self._stats.function = plan.key[1]
+
+            if isinstance(call, PendingCall):
+                self._submit_return(call, None, {}, exception)
+            else:
+                try:
+                    call.exception_ref = self._capture_exception(exception, None)
+                    call.end_ns = perf_counter_ns() + self._clock_offset_ns
+                    self._forget_call(call.id)
+                    self._commit_event()
+                except Exception:
+                    logger.warning("Could not store exception", exc_info=True)
+                    self._rollback()
+
+            if self._timed:
+                self._record_timing("function_returns", code, plan, t1)
+
+    def monitor_callback_function_yield(self, code: types.CodeType, offset, value):
+        """Callback for generator and coroutine suspensions: take the call off the stack until it resumes"""
+        state = getattr(self._thread_local, "state", None)
+        if state is None or not state.plan_stack:
+            return
+        plan = self._capture_plans.get(code)
+        if plan is None or state.plan_stack[-1].key != plan.key:
+            return
+        frame = inspect.currentframe().f_back  # type: ignore[union-attr]
+        call = state.call_stack.pop()
+        plan = state.plan_stack.pop() if call is _SAMPLED_OUT else self._pop_plan(state)
+        self._suspended_calls[id(frame)] = (call, plan)
+
+    def monitor_callback_function_resume(self, code: types.CodeType, offset):
+        """Callback for generator and coroutine resumptions: put the call back on the current thread's stack"""
+        frame = inspect.currentframe().f_back  # type: ignore[union-attr]
+        self._resume_call(code, frame)
+
+    def monitor_callback_function_throw(self, code: types.CodeType, offset, exception):
+        """Callback for exceptions thrown into a generator or coroutine (e.g. by close()), which resume it"""
+        frame = inspect.currentframe().f_back  # type: ignore[union-attr]
+        self._resume_call(code, frame)
+
+    def _resume_call(self, code: types.CodeType, frame):
+        entry = self._suspended_calls.pop(id(frame), None)
+        if entry is None:
+            return
+        call, plan = entry
+        state = self._thread_state()
+        state.call_stack.append(call)
+        if call is _SAMPLED_OUT:
+            state.plan_stack.append(plan)
+            return
+        self._push_plan(state, plan)
+        if code in self._suspended_line_codes:
+            # A sampled out call turned line events off while this one was suspended
+            self._resume_line_events(code)
+
+    def _capture_exception(self, exception: BaseException, pending: list[PreparedObject] | None) -> str:
+        """Store the exception that ended a call, or its repr if it cannot be serialized"""
+        try:
+            return self._capture_value(exception, pending)
+        except Exception:
+            logger.debug("Storing the repr of an exception that cannot be serialized", exc_info=True)
+            return self._capture_value(repr(exception), pending)
+
+    def _forget_call(self, call_id: int):
+        """Drop the per-call state of a call that ended"""
+        with self._order_lock:
+            self._function_snapshot_counts.pop(call_id, None)
+            self._parent_call_child_counts.pop(call_id, None)
+            if self.writer is not None:
+                self._last_snapshot_ids.pop(call_id, None)
+        self._last_snapshots.pop(call_id, None)
+        self._snapshot_states.pop(call_id, None)
+        self._line_states.pop(call_id, None)
+
+    def _count_children(self, call_id: int) -> int:
+        """Count the stored children of a call"""
+        if self.writer is not None:
+            self.writer.flush()
+        with self._db_lock:
+            return self.session.query(FunctionCall).filter(FunctionCall.parent_call_id == call_id).count()
+
+    def _get_accessed_global_names(self, code: types.CodeType):
         """Extract global names accessed by bytecode (static analysis, cached)"""
         if code in self._bytecode_cache:
             return self._bytecode_cache[code]
 
-        if processed_functions is None:
-            processed_functions = set()
-
         accessed_names = set()
 
         # Scan bytecode for LOAD_GLOBAL operations
@@ -808,202 +1642,233 @@ class SpaceTimeMonitor:
         self._bytecode_cache[code] = accessed_names
         return accessed_names
 
-    def _get_object_type_info(self, obj):
-        """Get cached type information for an object"""
-        obj_id = id(obj)
-
-        # Check if we already have type info for this object
-        if obj_id in self._type_cache:
-            return self._type_cache[obj_id]
-
-        # Prevent memory leaks by limiting cache size
-        if len(self._type_cache) >= self._type_cache_max_size:
-            # Clear half the cache (simple LRU approximation)
-            items_to_remove = len(self._type_cache) // 2
-            for _ in range(items_to_remove):
-                self._type_cache.popitem()
-
-        # Determine type info once and cache it
-        type_info = {
-            'is_module': isinstance(obj, types.ModuleType),
-            'is_function': isinstance(obj, types.FunctionType),
-            'should_include': True  # Default to include unless explicitly excluded
-        }
-
-        # If it's a module, don't include it
-        if type_info['is_module']:
-            type_info['should_include'] = False
-
-        self._type_cache[obj_id] = type_info
-        return type_info
+    def get_used_globals(self, code: types.CodeType, globals: dict):
+        """Find the global variables used by a function and the functions it calls
 
-    def get_used_globals(self, code: types.CodeType, globals: dict, processed_functions=None):
-        """Analyze function bytecode to find accessed global variables (optimized version)
+        The transitive closure of global names is computed once per (code object,
+        globals dict) and reused until a global function, module or missing name
+        it depends on is rebound.
 
         Args:
             code: The code object to analyze
             globals: The globals dictionary
-            processed_functions: Set of function names already processed to avoid infinite recursion
 
         Returns:
             Dictionary of global variables used by the function and its called functions
         """
-        if processed_functions is None:
-            processed_functions = set()
-
-        # Step 1: Get the static list of accessed global names (cached)
-        accessed_names = self._get_accessed_global_names(code, processed_functions)
-
-        # Step 2: For each accessed name, get its current value with type caching
-        globals_used = {}
-
-        for name in accessed_names:
-            if name not in globals:
-                continue
-
-            value = globals[name]
-            type_info = self._get_object_type_info(value)
-
-            # Skip modules
-            if type_info['is_module']:
-                continue
+        if self._stats is None:
+            return self._resolve_globals(code, globals)
+        t1 = perf_counter_ns()
+        globals_used = self._resolve_globals(code, globals)
+        self._stats.record("globals_analysis", perf_counter_ns() - t1)
+        return globals_used
 
-            # Handle functions recursively
-            if type_info['is_function']:
-                # Store the function itself if needed
-                # globals_used[name] = value
+    def _resolve_globals(self, code: types.CodeType, globals: dict) -> dict:
+        key = (code, id(globals))
+        closure = self._globals_result_cache.get(key)
+        if closure is not None and closure.globals is globals and closure.is_valid():
+            globals_used = closure.resolve()
+            if globals_used is not None:
+                return globals_used
 
-                # Recursively process function if not already processed
-                if name not in processed_functions:
-                    processed_functions.add(name)
-                    try:
-                        func_code = value.__code__
-                        func_globals = value.__globals__
-                        nested_globals = self.get_used_globals(func_code, func_globals, processed_functions)
-                        globals_used.update(nested_globals)
-                    except AttributeError:
-                        # Handle edge cases where function doesn't have __code__ or __globals__
-                        pass
-                continue
-
-            # Include regular variables
-            if type_info['should_include']:
-                globals_used[name] = value
-
-        return globals_used
+        closure = GlobalsClosure(code, globals, self._get_accessed_global_names)
+        self._globals_result_cache[key] = closure
+        return closure.resolve() or {}
 
     def monitor_callback_line(self, code: types.CodeType, line_number):
         """Callback function for line events"""
-        # Check if recording is enabled
-        logger.info(f"Monitoring line: {code.co_name} at line {line_number}")
-        if not self.is_recording_enabled:
-            return
-
-        if self.call_tracker is None:
-            return
-
-        if self.performance:
-            t1 = perf_counter()
-
-        current_frame = inspect.currentframe()
-        if current_frame is None or current_frame.f_back is None:
-            return
-
-        if (
-            code.co_name in SpaceTimeMonitor._monitored_functions and
-            "lines" in SpaceTimeMonitor._monitored_functions[code.co_name] and
-            SpaceTimeMonitor._monitored_functions[code.co_name]["lines"] is not None and
-            line_number not in SpaceTimeMonitor._monitored_functions[code.co_name]["lines"]
-        ):
-            return
+        with self._capture_lock:
+            current_frame = inspect.currentframe()
+            if current_frame is None or current_frame.f_back is None:
+                return None
 
-        if (
-            code.co_name in SpaceTimeMonitor._monitored_functions and
-            "use_tag_line" in SpaceTimeMonitor._monitored_functions[code.co_name] and
-            SpaceTimeMonitor._monitored_functions[code.co_name]["use_tag_line"] and
-            "#tag" not in linecache.getline(code.co_filename, line_number)
-        ):
-            return
+            # The parent frame should be the actual function being executed
+            frame = current_frame.f_back
+
+            plan = self._capture_plans.get(code) or self._resolve_plan(code, frame)
+            if plan.allowed_lines is not None and line_number not in plan.allowed_lines:
+                # This line is never captured: stop the interpreter from reporting it
+                # (until sys.monitoring.restart_events() is called)
+                return sys.monitoring.DISABLE
+
+            # Check if recording is enabled
+            logger.info("Monitoring line: %s at line %s", code.co_name, line_number)
+            if not self.is_recording_enabled:
+                # Lines run while recording is disabled are not seen, forget what was captured before
+                if self._line_states:
+                    self._line_states.clear()
+                return None
 
-        # The parent frame should be the actual function being executed
-        frame = current_frame.f_back
+            if self.call_tracker is None:
+                return None
 
-        try:
-            # Get the current function call from the stack
-            if not self.call_stack:
-                return
-            current_call = self.call_stack[-1]
-            if code.co_name in self.skip_one_line_snapshot:
-                self.skip_one_line_snapshot.remove(code.co_name)
-                return
-            # Get function's locals and globals
-            function_locals = {}
-            globals_used = {}
+            if self._timed:
+                t1 = perf_counter()
+            stats = self._stats
+            if stats is not None:
+                stats.function = plan.key[1]
 
-            # Capture locals
-            for name, value in frame.f_locals.items():
-                try:
-                    # Skip special variables and functions
-                    if name.startswith('__') or callable(value):
-                        continue
-                    ref = self.call_tracker.object_manager.store(value)
-                    function_locals[name] = ref
-                    if self.performance:
-                        self.performance_data["line_captured_locals"] += 1
-                except Exception as e:
-                    if self.performance:
-                        self.performance_data["line_failed_serialization"] += 1
-                        self.performance_data["line_failed_type"].add(type(value))
-                    #logger.warning(f"Failed to store local variable {name}: {e}")
+            try:
+                # Get the current function call from the stack, it must be a call of this code
+                state = self._thread_state()
+                if not state.plan_stack or state.plan_stack[-1].key != plan.key:
+                    return None
+                current_call = state.call_stack[-1]
+                if code.co_name in self.skip_one_line_snapshot:
+                    self.skip_one_line_snapshot.remove(code.co_name)
+                    self._line_states.pop(current_call.id, None)
+                    return None
+                if isinstance(current_call, PendingCall) and current_call.dropped:
+                    # The call was dropped by the writer or sampled out
+                    return None
+                # Get function's locals and globals
+                function_locals = {}
+                globals_used = {}
+                pending = [] if self.writer is not None else None
+
+                # A value still bound to the object captured at the previous snapshot keeps its ref
+                # if it is immutable, or if the only line run since then cannot mutate objects
+                previous_locals: Bindings = {}
+                previous_globals: Bindings = {}
+                unchanged = False
+                state = self._line_states.get(current_call.id)
+                if state is not None and state[0] is frame:
+                    _, previous_line, previous_locals, previous_globals = state
+                    unchanged = plan.allowed_lines is None and previous_line in plan.pure_lines
+                locals_bindings: Bindings = {}
+                globals_bindings: Bindings = {}
+
+                # Capture locals (or only the watched paths)
+                if stats is not None:
+                    t_frame = perf_counter_ns()
+                if plan.watch is not None:
+                    frame_locals, frame_globals = plan.watched_values(frame.f_locals, frame.f_globals)
+                else:
+                    frame_locals, frame_globals = frame.f_locals, None
+                if stats is not None:
+                    stats.record("frame_inspection", perf_counter_ns() - t_frame)
+                for name, value in frame_locals.items():
+                    try:
+                        # Skip special variables and functions
+                        if name.startswith('__') or callable(value):
+                            continue
+                        binding = previous_locals.get(name)
+                        if binding is not None and binding[0] is value and (unchanged or type(value) in _IMMUTABLE_TYPES):
+                            ref = binding[1]
+                            if self.performance:
+                                self.performance_data["line_reused_refs"] += 1
+                        else:
+                            ref = self._capture_value(value, pending)
+                            if self.performance:
+                                self.performance_data["line_captured_locals"] += 1
+                        function_locals[name] = ref
+                        locals_bindings[name] = (value, ref)
+                    except Exception as e:
+                        if self.performance:
+                            self.performance_data["line_failed_serialization"] += 1
+                            self.performance_data["line_failed_type"].add(type(value))
+                        #logger.warning(f"Failed to store local variable {name}: {e}")
+
+                # Capture used globals
+                if frame_globals is None:
+                    frame_globals = self.get_used_globals(code, frame.f_globals)
+                for name, value in frame_globals.items():
+                    try:
+                        binding = previous_globals.get(name)
+                        if binding is not None and binding[0] is value and (unchanged or type(value) in _IMMUTABLE_TYPES):
+                            ref = binding[1]
+                        else:
+                            ref = self._capture_value(value, pending)
+                        globals_used[name] = ref
+                        globals_bindings[name] = (value, ref)
+                    except Exception as e:
+                        if self.performance:
+                            self.performance_data["line_failed_serialization"] += 1
+                            self.performance_data["line_failed_type"].add(type(value))
+                        #logger.warning(f"Failed to store global variable {name}: {e}")
+
+                if pending is not None:
+                    # The refs of a dropped snapshot were not persisted, they cannot be reused
+                    if self._submit_snapshot(current_call, line_number, function_locals, globals_used, pending):
+                        self._line_states[current_call.id] = (frame, line_number, locals_bindings, globals_bindings)
+                    else:
+                        self._line_states.pop(current_call.id, None)
+                    if self._timed:
+                        self._record_timing("line_events", code, plan, t1)
+                    return None
 
-            # Capture used globals
-            for name, value in self.get_used_globals(code, frame.f_globals).items():
+                # Create a new stack snapshot
                 try:
-                    ref = self.call_tracker.object_manager.store(value)
-                    globals_used[name] = ref
-                except Exception as e:
-                    if self.performance:
-                        self.performance_data["line_failed_serialization"] += 1
-                        self.performance_data["line_failed_type"].add(type(value))
-                    #logger.warning(f"Failed to store global variable {name}: {e}")
-
-            # Create a new stack snapshot
-            try:
-                # Get the current snapshot count using in-memory counter (performance optimization)
-                snapshots_count = self._function_snapshot_counts.get(current_call.id, 0)
+                    # Get the current snapshot count using in-memory counter (performance optimization)
+                    snapshots_count = self._function_snapshot_counts.get(current_call.id, 0)
+
+                    snapshot = self.create_stack_snapshot(
+                        current_call.id,
+                        line_number,
+                        function_locals,
+                        globals_used,
+                        order_in_call=snapshots_count
+                    )
 
-                self.create_stack_snapshot(
-                    current_call.id,
-                    line_number,
-                    function_locals,
-                    globals_used,
-                    order_in_call=snapshots_count
-                )
+                    # Increment the snapshot counter for this function call
+                    self._function_snapshot_counts[current_call.id] = snapshots_count + 1
+                    if snapshot is not None:
+                        self._line_states[current_call.id] = (frame, line_number, locals_bindings, globals_bindings)
+                    else:
+                        self._line_states.pop(current_call.id, None)
 
-                # Increment the snapshot counter for this function call
-                self._function_snapshot_counts[current_call.id] = snapshots_count + 1
+                    # Log for debugging
+                    logger.debug(f"Created stack snapshot for line {line_number} in function {code.co_name}")
 
-                # Log for debugging
-                logger.debug(f"Created stack snapshot for line {line_number} in function {code.co_name}")
+                    # Commit the snapshot (according to the commit policy)
+                    self._commit_event()
 
-                # Commit to ensure the snapshot is saved
-                self.session.commit()
+                except Exception as e:
+                    logger.error(f"Error creating stack snapshot: {e}")
+                    logger.error(traceback.format_exc())
+                    self._rollback()
 
             except Exception as e:
-                logger.error(f"Error creating stack snapshot: {e}")
+                logger.error(f"Error in line monitoring callback: {e}")
                 logger.error(traceback.format_exc())
-                self.session.rollback()
 
-        except Exception as e:
-            logger.error(f"Error in line monitoring callback: {e}")
-            logger.error(traceback.format_exc())
+            if self._timed:
+                self._record_timing("line_events", code, plan, t1)
+            return None
 
-        if self.performance:
-            t2 = perf_counter()
-            elapsed = t2 - t1
-            self.performance_data["line_events"].append((code.co_name, elapsed))
+    def _submit_snapshot(self, call: PendingCall, line_number: int, locals_refs: dict[str, str],
+                         globals_refs: dict[str, str], pending: list[PreparedObject]) -> bool:
+        """Writer mode counterpart of create_stack_snapshot: submit a Snapshot record
 
-def pymonitor(mode="function", ignore=None, start_hooks=None, return_hooks=None, track=None, lines=None, use_tag_line=False):
+        Returns:
+            False if the snapshot was dropped by the writer
+        """
+        snapshot_id = self._snapshot_ids.next()
+        with self._order_lock:
+            snapshots_count = self._function_snapshot_counts.get(call.id, 0)
+            previous_snapshot_id = self._last_snapshot_ids.get(call.id)
+        stored_locals, stored_globals, is_keyframe = self._encode_snapshot(call.id, locals_refs, globals_refs)
+        submitted = self._submit(pending, Snapshot(
+            id=snapshot_id,
+            function_call_id=call.id,
+            line_number=line_number,
+            timestamp_ns=perf_counter_ns() + self._clock_offset_ns,
+            locals_refs=stored_locals,
+            globals_refs=stored_globals,
+            order_in_call=snapshots_count,
+            previous_snapshot_id=previous_snapshot_id,
+            is_keyframe=is_keyframe
+        ))
+        # A dropped snapshot leaves the chain (and the base of the next delta) untouched
+        if submitted:
+            with self._order_lock:
+                self._last_snapshot_ids[call.id] = snapshot_id
+                self._function_snapshot_counts[call.id] = snapshots_count + 1
+            self._snapshot_recorded(call.id, locals_refs, globals_refs, is_keyframe)
+        return submitted
+
+def pymonitor(mode="function", ignore=None, start_hooks=None, return_hooks=None, track=None, lines=None, use_tag_line=False,
+              sample=None, watch=None):
     """
     Unified decorator for monitoring Python function execution.
 
@@ -1021,6 +1886,15 @@ def pymonitor(mode="function", ignore=None, start_hooks=None, return_hooks=None,
             outside a monitored context. Defaults to None.
         lines (list[int], optional): Specific line numbers to monitor within the function if mode is "line". Defaults to None (monitor all lines).
         use_tag_line (bool, optional): If True and mode is "line", only monitor lines containing the comment "#tag". Defaults to False.
+        sample (Sampler | int | float | dict, optional): Only record some calls: every Nth call (int), each call
+            with a probability (float), or a Sampler (or dict of its arguments) combining an interval, a probability,
+            a maximum number of calls per second and a number of first calls always recorded. Sampling counts are
+            stored in the session metadata. Defaults to None (every call is recorded).
+        watch (list[str], optional): Only capture these variables and paths instead of every argument, local and
+            used global, e.g. ["score", "bird_rect.y", "pipes[-1].x"]. A path is a variable name followed by
+            attributes and literal subscripts, it is stored under its text in locals_refs (if the variable is a
+            local) or globals_refs. Paths that cannot be read are left out. Calls recorded this way cannot be
+            replayed with their arguments. Defaults to None (capture everything).
 
     Returns:
         The decorated function with monitoring enabled
@@ -1046,6 +1920,8 @@ def pymonitor(mode="function", ignore=None, start_hooks=None, return_hooks=None,
     # Validate mode parameter
     if mode not in ["function", "line"]:
         raise ValueError(f"Invalid monitoring mode: {mode}. Must be 'function' or 'line'")
+    sampler = Sampler.from_option(sample)
+    watch = compile_watch(watch)
 
     def _decorator(func):
         # Add logging to see which function is being decorated
@@ -1057,15 +1933,27 @@ def pymonitor(mode="function", ignore=None, start_hooks=None, return_hooks=None,
 
         # Set events based on mode
         if mode == "line":
-            events = (sys.monitoring.events.LINE |
-                     sys.monitoring.events.PY_START |
-                     sys.monitoring.events.PY_RETURN)
+            events = sys.monitoring.events.LINE | _CALL_EVENTS
         else:  # mode == "function"
-            events = sys.monitoring.events.PY_START | sys.monitoring.events.PY_RETURN
+            events = _CALL_EVENTS
 
         # Enable monitoring for this function
         sys.monitoring.set_local_events(MONITOR_TOOL_ID, func.__code__, events)
 
+        # Compile the capture plan used by the callbacks
+        plan = CapturePlan.for_function(
+            func,
+            mode=mode,
+            ignore=ignore,
+            start_hooks=start_hooks,
+            return_hooks=return_hooks,
+            lines=lines,
+            use_tag_line=use_tag_line,
+            sampler=sampler,
+            watch=watch,
+        )
+        SpaceTimeMonitor.register_plan(plan)
+
         # Store metadata on the function object
         SpaceTimeMonitor._monitored_functions[func.__name__] = {
             "ignore": ignore,
@@ -1073,7 +1961,9 @@ def pymonitor(mode="function", ignore=None, start_hooks=None, return_hooks=None,
             "return_hooks": return_hooks,
             "tracked_functions": track,
             "lines": lines,  # Specific lines to monitor if in line mode
-            "use_tag_line": use_tag_line  # Whether to only monitor lines with #tag
+            "use_tag_line": use_tag_line,  # Whether to only monitor lines with #tag
+            "sampler": sampler,
+            "watch": watch
         }
 
         # Also enable monitoring for tracked functions
@@ -1095,10 +1985,15 @@ def pymonitor(mode="function", ignore=None, start_hooks=None, return_hooks=None,
                 logger.info(f"Enabling monitoring for tracked function: {tracked_func.__name__} (tracked by {func.__name__})")
 
                 # Use function mode for tracked functions to avoid overhead
-                tracked_events = sys.monitoring.events.PY_START | sys.monitoring.events.PY_RETURN
+                tracked_events = _CALL_EVENTS
                 if not hasattr(tracked_func, '__code__'):
                     logger.warning(f"Tracked function {tracked_func.__name__} has no __code__ attribute, skipping monitoring")
                     continue
+                tracked_plan = SpaceTimeMonitor._capture_plans.get(tracked_func.__code__)
+                if tracked_plan is None:
+                    tracked_plan = CapturePlan.for_function(tracked_func)
+                    SpaceTimeMonitor.register_plan(tracked_plan)
+                tracked_plan.tracking_keys.add(plan.key)
                 sys.monitoring.set_local_events(MONITOR_TOOL_ID, tracked_func.__code__, tracked_events)
 
         return func
@@ -1112,7 +2007,7 @@ def pymonitor(mode="function", ignore=None, start_hooks=None, return_hooks=None,
     return _decorator
 
 
-def function(ignore=None, start_hooks=None, return_hooks=None, track=None):
+def function(ignore=None, start_hooks=None, return_hooks=None, track=None, sample=None, watch=None):
     """
     Decorator for monitoring function execution at function level.
     
@@ -1127,6 +2022,9 @@ def function(ignore=None, start_hooks=None, return_hooks=None, track=None):
             Each function should accept (monitor, code, offset, return_value) and return a dictionary. Defaults to None.
         track (list[callable], optional): Additional functions to track only when they are called within
             this monitored function context. Defaults to None.
+        sample (Sampler | int | float | dict, optional): Only record some calls, see pymonitor. Defaults to None.
+        watch (list[str], optional): Only capture these variables and attribute or item paths, see pymonitor.
+            Defaults to None.
     
     Returns:
         The decorated function with function-level monitoring enabled
@@ -1142,10 +2040,11 @@ def function(ignore=None, start_hooks=None, return_hooks=None, track=None):
             return result
     """
     return pymonitor(mode="function", ignore=ignore, start_hooks=start_hooks, 
-                     return_hooks=return_hooks, track=track)
+                     return_hooks=return_hooks, track=track, sample=sample, watch=watch)
 
 
-def line(ignore=None, start_hooks=None, return_hooks=None, track=None, lines=None, use_tag_line=False):
+def line(ignore=None, start_hooks=None, return_hooks=None, track=None, lines=None, use_tag_line=False, sample=None,
+         watch=None):
     """
     Decorator for monitoring function execution at line level.
     
@@ -1162,6 +2061,9 @@ def line(ignore=None, start_hooks=None, return_hooks=None, track=None, lines=Non
             this monitored function context. Defaults to None.
         lines (list[int], optional): Specific line numbers to monitor within the function. Defaults to None (monitor all lines).
         use_tag_line (bool, optional): If True, only monitor lines containing the comment "#tag". Defaults to False.
+        sample (Sampler | int | float | dict, optional): Only record some calls, see pymonitor. Defaults to None.
+        watch (list[str], optional): Only capture these variables and attribute or item paths, see pymonitor.
+            Defaults to None.
     
     Returns:
         The decorated function with line-level monitoring enabled
@@ -1179,7 +2081,8 @@ def line(ignore=None, start_hooks=None, return_hooks=None, track=None, lines=Non
             pass
     """
     return pymonitor(mode="line", ignore=ignore, start_hooks=start_hooks, 
-                     return_hooks=return_hooks, track=track, lines=lines, use_tag_line=use_tag_line)
+                     return_hooks=return_hooks, track=track, lines=lines, use_tag_line=use_tag_line, sample=sample,
+                     watch=watch)
 
 
 def init_monitoring(*args, **kwargs):
@@ -1188,8 +2091,78 @@ def init_monitoring(*args, **kwargs):
 
     Args:
         db_path (str, optional): Path to the database file. Defaults to "monitoring.db".
-        queue_size (int, optional): Size of the monitoring queue. Defaults to 1000.
-        flush_interval (float, optional): Interval for flushing the queue. Defaults to 1.0.
+        async_writer (bool, optional): If True, callbacks only build event records and a background
+            thread persists them in bulk. Call monitor.flush() to wait for them. Monitored threads
+            capture concurrently in this mode, otherwise they take turns using the database session.
+            Defaults to False.
+        queue_size (int, optional): Size of the writer queue in async_writer mode. Defaults to 1000.
+        backpressure (str, optional): What to do when the writer queue is full: "block" the monitored
+            thread, "drop" the event or "spill" it to a temporary file. Defaults to "block".
+        governor (OverheadGovernor | float | bool, optional): Keep the time spent in monitoring callbacks
+            under a share of wall time (True for 5%, a float for another budget). Hot functions are
+            downgraded from line to function mode, then sampled, then off, and upgraded back when load
+            drops. The changes are recorded in the session metadata. Defaults to None.
+        performance (bool, optional): Measure the cost of monitoring: fixed-memory latency histograms
+            per phase (callbacks, frame inspection, globals analysis, pickling, hashing, database
+            flush and commit) and per function, read with monitor.stats() or /api/monitor-stats.
+            Defaults to False.
+        stats_textfile (str, optional): With performance=True, write the histograms to this
+            Prometheus text file at the end of each session and at shutdown. Defaults to None.
+        checkpoint (CheckpointPolicy | float | dict | bool, optional): Persist the in-memory database
+            to db_path incrementally, from a background thread, instead of a single export at
+            shutdown: every this many seconds (True for 5), or a CheckpointPolicy combining an
+            interval, a number of events and evict_snapshots (delete the persisted snapshots of
+            ended calls from memory, bounding its size). monitor.checkpoint() forces one.
+            Requires in_memory=True. Defaults to None.
+        hash_function (str, optional): Hash of the object pickles giving their references: "md5",
+            "blake2b" or "xxh3" (fastest, requires the xxhash package). Keep the same function for
+            a database, objects stored with another one are not deduplicated. Defaults to "md5".
+        strict (bool, optional): Pickle and hash every captured value. With strict=False the ref of
+            a list, dict or plain object that still holds the same elements (compared by identity)
+            as at its last capture is reused without pickling it. This pays off for values whose
+            pickle is expensive (large strings or bytes, many attributes) and costs about as much as
+            it saves on containers of small numbers (see performance/change_detection.py).
+            Defaults to True.
+        chunking (ChunkPolicy | int | dict | bool, optional): Store the lists, dicts, bytes and
+            numeric numpy arrays that span more than one chunk as content-addressed chunks
+            shared by their versions, so that storing a new version writes only the chunks that
+            changed. True uses chunks of 1024 elements or 64 KiB, an int sets the elements per
+            chunk, a ChunkPolicy or dict sets items and size_bytes. Defaults to None.
+        inline_primitives (int, optional): Largest length of the ints, floats, strs (and of True,
+            False and None) written in the ref maps as tagged literals ("~i:1", "~s:text") instead
+            of being stored as objects. Longer primitives are stored under the hash of their
+            pickle. 0 stores every primitive. Defaults to 64.
+        ref_index (RefIndex | int | dict, optional): Bounds of the in-memory index of stored refs and
+            identities (an int is the number of refs kept), and bloom_capacity to enable a Bloom
+            filter of every stored ref, which skips the lookup of refs evicted from the index.
+            Defaults to 100000 refs and identities, without Bloom filter.
+        append (bool, optional): Start with an empty in-memory database instead of loading db_path,
+            and merge the new rows into db_path at export (keeps startup fast with a large history;
+            queries of the running monitor only see the new rows). Objects of the run get identities
+            of their own, never merged with those of earlier runs. Requires in_memory=True.
+            Defaults to False.
+        capture_budget (CaptureBudget | int | dict, optional): Limits on the captured values: max_bytes,
+            max_length (elements of a container) and max_depth (nesting). Values over budget are
+            stored as a ValueSummary (type, length, shape, numeric statistics, first and last
+            elements, content hash), which reanimation does not restore. An int is a max_bytes.
+            Defaults to None (every value is pickled in full).
+        commit_policy (CommitPolicy | str | int, optional): When captured events are committed:
+            "event" (after every snapshot and return), "session" (only at session boundaries,
+            flush and shutdown), a number of events, or a CommitPolicy combining a count and an
+            interval in milliseconds. Defaults to "event".
+        capture_backend (str, optional): How the writer persists capture rows: "orm" through the
+            SQLAlchemy session or "sqlite" with raw sqlite3 executemany statements. "sqlite"
+            requires async_writer=True. Defaults to "orm".
+        snapshot_keyframe_interval (int, optional): Store line snapshots as deltas of the previous
+            snapshot of the call, with a full keyframe every this many snapshots. Readers
+            (load_snapshot, traces, web API) reconstruct full states. Defaults to None (every
+            snapshot is stored in full).
+        shard_by_process (bool, optional): Write every process to its own database next to db_path
+            (monitoring.<pid>.db) instead of an in-memory copy exported at exit, so that forked
+            workers (os.fork, multiprocessing with the fork start method) are captured too. A forked
+            process continues the current session in its shard; merge_shards(db_path) combines the
+            shards, linking the calls of each child to the call that forked it. Without this option,
+            capture stops in forked processes. Defaults to False.
         pickle_config (PickleConfig, optional): Custom pickle configuration for serializing objects.
             This can include custom reducers for specific types. Defaults to None.
         custom_picklers (list, optional): List of module names to load custom picklers from.
@@ -1221,3 +2194,17 @@ def _cleanup_monitoring():
 
 atexit.register(_cleanup_monitoring)
 
+
+def _before_fork():
+    if SpaceTimeMonitor._instance is not None:
+        SpaceTimeMonitor._instance._before_fork()
+
+
+def _after_fork_in_child():
+    if SpaceTimeMonitor._instance is not None:
+        SpaceTimeMonitor._instance._after_fork_in_child()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_before_fork, after_in_child=_after_fork_in_child)
+
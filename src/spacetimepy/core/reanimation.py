@@ -21,6 +21,7 @@ from .function_call import FunctionCallRepository
 from .models import init_db
 from .monitoring import SpaceTimeMonitor
 from .representation import ObjectManager
+from .summaries import ValueSummary
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -279,9 +280,8 @@ def load_snapshot(
         if not snapshot:
             raise ValueError(f"Snapshot with ID {snapshot_id} not found")
 
-        # Rehydrate the locals and globals dictionaries
-        locals_refs = getattr(snapshot, "locals_refs", {}) if snapshot else {}
-        globals_refs = getattr(snapshot, "globals_refs", {}) if snapshot else {}
+        # Rehydrate the locals and globals dictionaries (delta snapshots are applied to their keyframe)
+        locals_refs, globals_refs = snapshot.get_full_refs(session)
         locals_dict = obj_manager.rehydrate_dict(locals_refs)
         globals_dict = obj_manager.rehydrate_dict(globals_refs)
 
@@ -336,12 +336,12 @@ def load_snapshot_in_frame(
     # Load the snapshot data
     snapshot_data = load_snapshot(snapshot_id, db_path_or_session)
 
-    # Update the frame's locals with the snapshot's locals
-    frame_locals.update(snapshot_data["locals"])
+    # Update the frame's locals with the snapshot's locals (values captured as summaries keep their current value)
+    frame_locals.update(_without_summaries(snapshot_data["locals"]))
 
     # Update the frame's globals with the snapshot's globals
     # Only update globals that don't conflict with builtins or module-level constants
-    for key, value in snapshot_data["globals"].items():
+    for key, value in _without_summaries(snapshot_data["globals"]).items():
         # Skip updating certain globals that might cause issues
         if not (key.startswith("__") and key.endswith("__")):
             frame_globals[key] = value
@@ -1139,6 +1139,10 @@ def _load_execution_data_from_call_info(
 
     locals_refs = call_info.get("locals_refs", {})
     locals_dict = obj_manager.rehydrate_dict(locals_refs)
+    summarized = [name for name, value in locals_dict.items() if isinstance(value, ValueSummary)]
+    if summarized:
+        raise ValueError(f"Cannot replay the call: arguments {', '.join(summarized)} were captured as summaries "
+                         "(over the capture budget)")
 
     args: list[Any] = []
     kwargs: dict[str, Any] = {}
@@ -1205,7 +1209,7 @@ def _load_globals_from_call_info(
         raise ValueError("call_info cannot be None")
 
     globals_refs = call_info.get("globals_refs", {})
-    globals_dict = obj_manager.rehydrate_dict(globals_refs)
+    globals_dict = _without_summaries(obj_manager.rehydrate_dict(globals_refs))
     return {
         k: v
         for k, v in globals_dict.items()
@@ -1214,6 +1218,16 @@ def _load_globals_from_call_info(
     }
 
 
+# Helper function
+def _without_summaries(values: dict[str, Any]) -> dict[str, Any]:
+    """Leave out the values captured as summaries, which cannot be rehydrated"""
+    summarized = [name for name, value in values.items() if isinstance(value, ValueSummary)]
+    if not summarized:
+        return values
+    logger.warning(f"Not restoring {', '.join(summarized)}: captured as summaries (over the capture budget)")
+    return {name: value for name, value in values.items() if name not in summarized}
+
+
 # Helper function
 def _inject_globals(module: Any, function: Callable, globals_dict: dict[str, Any]):
     """Injects globals into module and function context."""
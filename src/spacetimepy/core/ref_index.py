@@ -0,0 +1,177 @@
+"""
+In-memory index of the objects already stored.
+
+The object manager and the sqlite capture store consult a RefIndex before
+touching the database: a value stored recently costs no query, and a new
+version of a known object only costs its inserts. The index is written
+through, every stored ref and identity is added as it is inserted.
+
+Refs and identities are kept in LRU maps of bounded size. The index is shared
+by the monitored threads, which check refs, and the writer thread, which adds
+them: every access takes its lock. A ref missing
+from them may still be in the database (evicted, or stored by an earlier
+run) and is looked up, unless an optional Bloom filter of every stored ref
+says it was never stored.
+"""
+
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+from typing import Any
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .models import StoredObject
+
+
+class BloomFilter:
+    """Set membership with false positives but no false negatives, in fixed memory.
+
+    Args:
+        capacity: Number of items for which the false positive rate holds
+        error_rate: Probability that an item never added is reported as present
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        if capacity < 1:
+            raise ValueError(f"Invalid Bloom filter capacity: {capacity}. Must be at least 1")
+        if not 0 < error_rate < 1:
+            raise ValueError(f"Invalid Bloom filter error rate: {error_rate}. Must be between 0 and 1")
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RefIndex:
+    """Refs and identities known to be stored, bounded by LRU eviction.
+
+    Args:
+        max_refs: Number of refs kept
+        max_identities: Number of identities kept, with their latest version
+        bloom_capacity: Expected number of stored refs, enables the Bloom filter of cold refs
+        bloom_error_rate: False positive rate of the Bloom filter (a false positive costs a lookup)
+    """
+
+    def __init__(self, max_refs: int = 100_000, max_identities: int = 100_000,
+                 bloom_capacity: int | None = None, bloom_error_rate: float = 0.01):
+        if max_refs < 1 or max_identities < 1:
+            raise ValueError("The ref index must keep at least one ref and one identity")
+        self.max_refs = max_refs
+        self.max_identities = max_identities
+        self._refs: OrderedDict[str, None] = OrderedDict()
+        # Dict[identity_hash, (identity ID, latest version number or None if unknown)]
+        self._identities: OrderedDict[str, tuple[int, int | None]] = OrderedDict()
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.bloom = BloomFilter(bloom_capacity, bloom_error_rate) if bloom_capacity is not None else None
+        self._lock = threading.Lock()  # Monitored threads and the writer thread use the index
+
+    @classmethod
+    def from_option(cls, option: "RefIndex | int | dict[str, Any] | None") -> "RefIndex":
+        """Build an index from the ref_index option of the monitor
+
+        Args:
+            option: A RefIndex, an int (max_refs), a dict of RefIndex arguments or None (defaults)
+        """
+        if option is None:
+            return cls()
+        if isinstance(option, RefIndex):
+            return option
+        if isinstance(option, dict):
+            return cls(**option)
+        if isinstance(option, int) and not isinstance(option, bool):
+            return cls(max_refs=option)
+        raise ValueError(f"Invalid ref index: {option!r}")
+
+    def load(self, session: Session):
+        """Add the refs already in the database to the Bloom filter (nothing to do without one)"""
+        if self.bloom is None:
+            return
+        refs = session.execute(select(StoredObject.id)).scalars().all()
+        with self._lock:
+            for ref in refs:
+                self.bloom.add(ref)
+
+    def __contains__(self, ref: str) -> bool:
+        """Whether a ref is known to be stored"""
+        with self._lock:
+            if ref in self._refs:
+                self._refs.move_to_end(ref)
+                return True
+            return False
+
+    def __len__(self) -> int:
+        return len(self._refs)
+
+    def may_be_stored(self, ref: str) -> bool:
+        """Whether a ref missing from the index has to be looked up in the database"""
+        return self.bloom is None or ref in self.bloom
+
+    def add(self, ref: str):
+        """Record a stored ref"""
+        with self._lock:
+            self._refs[ref] = None
+            self._refs.move_to_end(ref)
+            if len(self._refs) > self.max_refs:
+                self._refs.popitem(last=False)
+            if self.bloom is not None:
+                self.bloom.add(ref)
+
+    def discard(self, ref: str):
+        """Forget a ref that turned out not to be stored"""
+        with self._lock:
+            self._refs.pop(ref, None)
+
+    def identity(self, identity_hash: str) -> tuple[int, int] | None:
+        """Return the (ID, latest version) of a known identity, or None"""
+        with self._lock:
+            entry = self._identities.get(identity_hash)
+            if entry is not None:
+                self._identities.move_to_end(identity_hash)
+            return entry
+
+    def set_identity(self, identity_hash: str, identity_id: int, latest_version: int):
+        """Record the ID and latest version of an identity"""
+        with self._lock:
+            self._identities[identity_hash] = (identity_id, latest_version)
+            self._identities.move_to_end(identity_hash)
+            if len(self._identities) > self.max_identities:
+                self._identities.popitem(last=False)
+
+    def clear(self):
+        """Forget the refs and identities, e.g. after a rollback.
+
+        The Bloom filter is kept: refs rolled back are only false positives.
+        """
+        with self._lock:
+            self._refs.clear()
+            self._identities.clear()
+
+    def reset(self, session: Session):
+        """Empty the index, Bloom filter included, and load the refs of another database"""
+        self.clear()
+        if self.bloom_capacity is not None:
+            self.bloom = BloomFilter(self.bloom_capacity, self.bloom_error_rate)
+        self.load(session)
+
+    def after_fork(self):
+        """Replace the lock in a forked process (it may have been held by another thread)"""
+        self._lock = threading.Lock()
@@ -6,15 +6,31 @@ import io
 import logging
 import pickle
 import sys
-from collections.abc import Mapping, Sequence
+import time
+from collections.abc import Callable, Container, Mapping, Sequence
 from enum import Enum
 from pathlib import Path
-from typing import Any, TypeVar
+from typing import TYPE_CHECKING, Any, NamedTuple, TypeVar
 
+from sqlalchemy import func
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 
-from .models import CodeDefinition, CodeObjectLink, ObjectIdentity, StoredObject
+from .chunking import ChunkManifest, ChunkPolicy
+from .models import (
+    CodeDefinition,
+    CodeObjectLink,
+    IdAllocator,
+    ObjectChunk,
+    ObjectIdentity,
+    StoredObject,
+)
+from .ref_index import RefIndex
+from .summaries import CaptureBudget, ValueSummary
+
+if TYPE_CHECKING:
+    from .change_detection import ChangeDetector
+    from .stats import MonitorStats
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -24,9 +40,95 @@ class ObjectType(Enum):
     LIST = "list"
     DICT = "dict"
     CUSTOM = "custom"
+    SUMMARY = "summary"
+    CHUNKED = "chunked"
 
 T = TypeVar('T')
 
+# Content hashes of pickles, by name: the hex digest is the reference of a stored object.
+# References of one database should come from a single function for objects to be deduplicated.
+HASH_FUNCTIONS: dict[str, Callable[[bytes], str]] = {
+    "md5": lambda data: hashlib.md5(data).hexdigest(),
+    "blake2b": lambda data: hashlib.blake2b(data, digest_size=16).hexdigest(),
+}
+try:
+    import xxhash  # Optional: fast non-cryptographic 128-bit hash
+    HASH_FUNCTIONS["xxh3"] = xxhash.xxh3_128_hexdigest
+except ImportError:
+    pass
+
+
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER for IN (...) lookups of chunks
+_CHUNK_LOOKUP_SIZE = 500
+
+
+# Small primitives are not stored as objects: their ref is a tagged literal of the value.
+# Hashes never start with the prefix, and primitives too large to be inlined are stored under a hash.
+INLINE_PREFIX = "~"
+INLINE_LIMIT = 64  # Default largest length of an inlined literal
+_INLINE_TYPES = {"i": (int, int), "f": (float, float), "s": (str, str)}  # Dict[tag, (type, decoder)]
+
+
+def inline_ref(value: Any, limit: int = INLINE_LIMIT) -> str | None:
+    """Return the inline ref of an int, float, bool, str or None, or None if it is too large to inline
+
+    Args:
+        value: The value
+        limit: Largest length of the literal of the value
+    """
+    cls = type(value)
+    if value is None:
+        return "~n"
+    if cls is bool:
+        return "~b:1" if value else "~b:0"
+    if cls is int:
+        if value.bit_length() > limit * 4:  # More than limit digits, don't format it
+            return None
+        literal = str(value)
+    elif cls is float:
+        literal = repr(value)  # Round-trips exactly
+    elif cls is str:
+        literal = value
+    else:
+        return None
+    if len(literal) > limit:
+        return None
+    return f"~{'i' if cls is int else 'f' if cls is float else 's'}:{literal}"
+
+
+def is_inline_ref(ref: str | None) -> bool:
+    """Whether a ref is an inlined primitive"""
+    return ref is not None and ref.startswith(INLINE_PREFIX)
+
+
+def decode_inline_ref(ref: str) -> tuple[Any, str]:
+    """Return the value of an inline ref and its type name
+
+    Raises:
+        ValueError: If the ref is not a valid inline ref
+    """
+    if ref == "~n":
+        return None, "NoneType"
+    tag, separator, literal = ref[1:].partition(":")
+    if separator:
+        if tag == "b" and literal in ("0", "1"):
+            return literal == "1", "bool"
+        if tag in _INLINE_TYPES:
+            cls, decode = _INLINE_TYPES[tag]
+            return decode(literal), cls.__name__
+    raise ValueError(f"Invalid inline ref: {ref!r}")
+
+
+def content_hasher(name: str) -> Callable[[bytes], str]:
+    """Return the hash function registered under a name ("md5", "blake2b" or "xxh3")"""
+    hasher = HASH_FUNCTIONS.get(name)
+    if hasher is None:
+        if name == "xxh3":
+            raise ValueError("The xxh3 hash function requires the xxhash package")
+        raise ValueError(f"Unknown hash function: {name!r}. Must be one of {sorted(HASH_FUNCTIONS)}")
+    return hasher
+
+
 class PickleConfig:
     """Configuration for custom pickling behavior"""
     def __init__(self, dispatch_table=None, custom_picklers=None):
@@ -173,6 +275,8 @@ class Object:
         self.value = value
         self.type = self._get_type()
         self._hash = None
+        self.data: bytes | None = None  # Pickle the reference was computed from, reused for storage
+        self.size: int | None = None  # Size of the pickle, when the object manager measured it
         self.pickle_config = pickle_config or PickleConfig()
 
     def _get_type(self) -> ObjectType:
@@ -220,10 +324,8 @@ class Object:
     def ref(self) -> str:
         """Return a reference to the object"""
         if self._hash is None:
-            if self.type == ObjectType.PRIMITIVE:
-                self._hash = str(self.value)
-            else:
-                self._hash = hashlib.md5(self.pickle_config.dumps(self.value)).hexdigest() # type: ignore
+            self.data = self.pickle_config.dumps(self.value)
+            self._hash = hashlib.md5(self.data).hexdigest() # type: ignore
         return self._hash
 
 class Primitive(Object):
@@ -254,6 +356,37 @@ class CustomClass(Object):
         if isinstance(value, int | float | bool | str | type(None) | list | dict):
             raise TypeError("CustomClass objects cannot store primitive or structured types")
 
+class Summary(Object):
+    """Represent a value over the capture budget by its ValueSummary"""
+    def __init__(self, summary: ValueSummary, source: Any, pickle_config: PickleConfig | None = None):
+        super().__init__(summary, pickle_config)
+        self.source = source  # The summarized value, whose id is the identity of the object
+
+    def _get_type(self) -> ObjectType:
+        return ObjectType.SUMMARY
+
+class Chunked(Object):
+    """Represent a value stored in chunks by its ChunkManifest"""
+    def __init__(self, manifest: ChunkManifest, payloads: dict[str, bytes], source: Any,
+                 pickle_config: PickleConfig | None = None):
+        super().__init__(manifest, pickle_config)
+        self.payloads = payloads  # Dict[chunk ref, chunk data]
+        self.source = source  # The chunked value, whose id is the identity of the object
+
+    def _get_type(self) -> ObjectType:
+        return ObjectType.CHUNKED
+
+class PreparedObject(NamedTuple):
+    """An object serialized for storage but not yet written to the database"""
+    ref: str
+    identity_hash: str
+    type_name: str
+    is_primitive: bool
+    primitive_value: str | None
+    pickle_data: bytes | None
+    value_class: type | None  # Class whose definition should be linked to the object
+    chunks: tuple[tuple[str, bytes], ...] = ()  # (ref, data) of the chunks of a chunked object
+
 class ObjectManager:
     """Manage objects in the program"""
     def __init__(self, session: Session, pickle_config: PickleConfig | None = None):
@@ -267,12 +400,37 @@ class ObjectManager:
             logger.warning("CodeManager/ClassLoader not available, code tracking disabled")
             self.code_manager = None
             self.class_loader = None
-        self._obj_cache = []
+        # Refs and identities already stored, so that storing them again costs no query
+        self.index = RefIndex()
+        # Optional splitting of large containers into content-addressed chunks, and the chunks already stored
+        self.chunking: ChunkPolicy | None = None
+        self.chunk_index = RefIndex()
+        # Optional in-memory allocator for identity IDs, avoids a flush per new identity
+        self.identity_ids: IdAllocator | None = None
+        # Optional latency histograms of pickling, hashing and storing (performance mode)
+        self.stats: MonitorStats | None = None
+        # Optional limits on the values pickled, larger values are stored as summaries
+        self.budget: CaptureBudget | None = None
+        # Hash of the pickles giving the references of objects (see content_hasher)
+        self.hasher: Callable[[bytes], str] = HASH_FUNCTIONS["md5"]
+        # Largest literal of the primitives inlined in their refs instead of stored (0: store every primitive)
+        self.inline_limit = INLINE_LIMIT
+        # Optional reuse of the refs of unchanged values without pickling them (None: always pickle and hash)
+        self.changes: ChangeDetector | None = None
+
+    def clear_cache(self):
+        """Forget which objects were stored, e.g. after the session was rolled back"""
+        self.index.clear()
+        self.chunk_index.clear()
+        if self.changes is not None:
+            self.changes.clear()
 
     def _get_identity(self, obj: Object) -> str:
         """Get the identity of an object (independent of its state)"""
         if obj.type == ObjectType.PRIMITIVE:
-            return obj.ref()  # For primitives, ref is the identity
+            return self._ref(obj)  # For primitives, ref is the identity
+        if isinstance(obj, Summary | Chunked):
+            return str(id(obj.source))
         # For non-primitives, identity is based on object id
         return str(id(obj.value))
 
@@ -289,26 +447,80 @@ class ObjectManager:
             logger.debug(f"Could not get module path for object {stored_obj.id}: {e}")
         return None
 
-    def _store_object(self, obj: Object) -> StoredObject:
-        """Store an object in the database"""
-        ref = obj.ref()
-
-        # Check if object already exists
-        stored_obj = self.session.query(StoredObject).filter(StoredObject.id == ref).first()
-        if stored_obj:
-            return stored_obj
-
-        # Get or create an identity for the object
+    def _wrap(self, value: Any) -> Object:
+        """Wrap a raw value in the matching Object representation (a Summary if it is over budget)"""
+        if self.budget is not None and not isinstance(value, int | float | bool | type(None)):
+            reason = self.budget.check(value)
+            if reason is not None:
+                return Summary(self.budget.summarize(value, reason), value, pickle_config=self.pickle_config)
+        if self.chunking is not None:
+            split = self.chunking.split(value, lambda chunk: self._dumps(chunk, None), self.hasher)
+            if split is not None:
+                return Chunked(*split, value, pickle_config=self.pickle_config)
+        if isinstance(value, int | float | bool | str | type(None)):
+            return Primitive(value, pickle_config=self.pickle_config)
+        if isinstance(value, list):
+            return List(value, pickle_config=self.pickle_config)
+        if isinstance(value, dict):
+            return DictObject(value, pickle_config=self.pickle_config)
+        return CustomClass(value, pickle_config=self.pickle_config)
+
+    def _ref(self, obj: Object) -> str:
+        """Return the reference of an object, the hash of its pickle (timed in performance mode).
+
+        The pickle is kept on the object so that storing it does not pickle the value again.
+        Primitives are hashed too: the pickle tells 1, 1.0, True and "1" apart.
+        """
+        if obj._hash is not None:
+            return obj._hash
+        if self.stats is None:
+            obj.data = self.pickle_config.dumps(obj.value)
+            obj._hash = self.hasher(obj.data)  # type: ignore[arg-type]
+        else:
+            t1 = time.perf_counter_ns()
+            obj.data = self.pickle_config.dumps(obj.value)
+            t2 = time.perf_counter_ns()
+            obj._hash = self.hasher(obj.data)  # type: ignore[arg-type]
+            self.stats.record("pickling", t2 - t1)
+            self.stats.record("hashing", time.perf_counter_ns() - t2)
+        obj.size = len(obj.data) if obj.data is not None else None
+        return obj._hash  # type: ignore[return-value]
+
+    def _wrap_and_ref(self, value: Any) -> tuple[Object, str]:
+        """Wrap a value and compute its reference, replacing it by a summary if its pickle is over budget"""
+        obj = self._wrap(value)
+        ref = self._ref(obj)
+        max_bytes = self.budget.max_bytes if self.budget is not None else None
+        if max_bytes is not None and obj.type != ObjectType.SUMMARY and obj.size is not None and obj.size > max_bytes:
+            summary = self.budget.summarize(value, "bytes", content_hash=ref, size_bytes=obj.size)  # type: ignore[union-attr]
+            obj = Summary(summary, value, pickle_config=self.pickle_config)
+            ref = self._ref(obj)
+        return obj, ref
+
+    def _dumps(self, value: Any, correct_module_path: str | None) -> bytes | None:
+        """Pickle the payload of an object, timing it in performance mode"""
+        if self.stats is None:
+            return self.pickle_config.dumps(value, correct_module_path)
+        t1 = time.perf_counter_ns()
+        data = self.pickle_config.dumps(value, correct_module_path)
+        self.stats.record("pickling", time.perf_counter_ns() - t1)
+        return data
+
+    def _prepare_object(self, obj: Object) -> PreparedObject:
+        """Serialize an object into a PreparedObject without touching the database"""
+        ref = self._ref(obj)
         identity_hash = self._get_identity(obj)
-        identity = self.session.query(ObjectIdentity).filter(ObjectIdentity.identity_hash == identity_hash).first()
 
-        if not identity:
-            identity = ObjectIdentity(
+        if obj.type == ObjectType.PRIMITIVE:
+            return PreparedObject(
+                ref=ref,
                 identity_hash=identity_hash,
-                name=type(obj.value).__name__
+                type_name=type(obj.value).__name__,  # Store actual type name (int, float, etc.)
+                is_primitive=True,
+                primitive_value=str(obj.value),
+                pickle_data=None,
+                value_class=None,
             )
-            self.session.add(identity)
-            self.session.flush()  # Ensure identity gets an ID
 
         # For custom objects, determine the correct module path for consistent storage
         correct_module_path = None
@@ -323,47 +535,73 @@ class ObjectManager:
                 else:
                     correct_module_path = cls.__module__
 
-        # Create new stored object
-        if obj.type == ObjectType.PRIMITIVE:
-            stored_obj = StoredObject(
-                id=ref,
-                identity_id=identity.id,
-                version_number=1,  # First version
-                type_name=type(obj.value).__name__,  # Store actual type name (int, float, etc.)
-                is_primitive=True,
-                primitive_value=str(obj.value)
-            )
+        if obj.type in (ObjectType.SUMMARY, ObjectType.CHUNKED):
+            correct_module_path = type(obj.value).__module__
+
+        # Get appropriate type name
+        if obj.type == ObjectType.LIST:
+            actual_type_name = 'list'
+        elif obj.type == ObjectType.DICT:
+            actual_type_name = 'dict'
+        elif isinstance(obj, Chunked):
+            actual_type_name = type(obj.source).__name__
         else:
-            # Get appropriate type name
-            if obj.type == ObjectType.LIST:
-                actual_type_name = 'list'
-            elif obj.type == ObjectType.DICT:
-                actual_type_name = 'dict'
-            else:
-                # For custom types, get the actual class name
-                actual_type_name = obj.value.__class__.__name__
-
-            # Use the correct module path for pickling if available
-            pickle_data = self.pickle_config.dumps(obj.value, correct_module_path)
-
-            stored_obj = StoredObject(
-                id=ref,
-                identity_id=identity.id,
-                version_number=1,  # First version
-                type_name=actual_type_name,  # Use the actual class name instead of our representation type
-                is_primitive=False,
-                pickle_data=pickle_data
-            )
+            # For custom types, get the actual class name
+            actual_type_name = obj.value.__class__.__name__
+
+        # The pickle hashed for the reference is stored, unless the class must be pickled under another module
+        if obj.data is not None and correct_module_path in (None, type(obj.value).__module__):
+            pickle_data = obj.data
+        else:
+            pickle_data = self._dumps(obj.value, correct_module_path)
+
+        return PreparedObject(
+            ref=ref,
+            identity_hash=identity_hash,
+            type_name=actual_type_name,  # Use the actual class name instead of our representation type
+            is_primitive=False,
+            primitive_value=None,
+            pickle_data=pickle_data,
+            value_class=type(obj.value) if obj.type == ObjectType.CUSTOM else None,
+            chunks=tuple(obj.payloads.items()) if isinstance(obj, Chunked) else (),
+        )
+
+    def _store_object(self, prepared: PreparedObject) -> StoredObject | None:
+        """Insert a prepared object as the next version of its identity (None if it is already stored)"""
+        ref = prepared.ref
 
-        # Add to session
+        # Refs missing from the index may have been evicted or stored by an earlier run
+        if self.index.may_be_stored(ref) and self.session.get(StoredObject, ref) is not None:
+            self.index.add(ref)
+            return None
+
+        if prepared.chunks:
+            self._store_chunks(prepared.chunks)
+        identity_id, latest_version = self._get_or_create_identity(prepared)
+        stored_obj = StoredObject(
+            id=ref,
+            identity_id=identity_id,
+            version_number=latest_version + 1,
+            type_name=prepared.type_name,
+            is_primitive=prepared.is_primitive,
+            primitive_value=prepared.primitive_value,
+            pickle_data=prepared.pickle_data
+        )
         self.session.add(stored_obj)
-        self.session.flush()
+        try:
+            self.session.flush()
+        except SQLAlchemyError as e:
+            logger.warning(f"Error storing object: {e}")
+            self.session.rollback()
+            self.clear_cache()
+            raise
+        self.index.add(ref)
+        self.index.set_identity(prepared.identity_hash, identity_id, latest_version + 1)
 
         # If it's a custom class and we have a code manager, store the class definition
-        if (obj.type == ObjectType.CUSTOM and self.code_manager is not None and
-            not isinstance(obj.value, int | float | bool | str | list | dict | type(None))):
+        if prepared.value_class is not None and self.code_manager is not None:
             try:
-                code_ref = self.code_manager.store_class(type(obj.value))
+                code_ref = self.code_manager.store_class(prepared.value_class)
                 if code_ref:
                     self.code_manager.link_object(ref, code_ref)
             except Exception as e:
@@ -371,10 +609,62 @@ class ObjectManager:
 
         return stored_obj
 
+    def _store_chunks(self, chunks: tuple[tuple[str, bytes], ...]):
+        """Add the chunks of an object that are not stored yet (flushed with the object)"""
+        new_chunks = {ref: data for ref, data in chunks if ref not in self.chunk_index}
+        refs = list(new_chunks)
+        for start in range(0, len(refs), _CHUNK_LOOKUP_SIZE):
+            batch = refs[start:start + _CHUNK_LOOKUP_SIZE]
+            for (ref,) in self.session.query(ObjectChunk.id).filter(ObjectChunk.id.in_(batch)):
+                del new_chunks[ref]
+        self.session.add_all(ObjectChunk(id=ref, data=data) for ref, data in new_chunks.items())
+        for ref in refs:
+            self.chunk_index.add(ref)
+
+    def _assemble(self, manifest: ChunkManifest) -> Any:
+        """Rebuild a chunked value from its stored chunks"""
+        refs = list(dict.fromkeys(manifest.chunks))
+        payloads: dict[str, bytes] = {}
+        for start in range(0, len(refs), _CHUNK_LOOKUP_SIZE):
+            batch = refs[start:start + _CHUNK_LOOKUP_SIZE]
+            payloads.update(self.session.query(ObjectChunk.id, ObjectChunk.data).filter(ObjectChunk.id.in_(batch)))
+        missing = [ref for ref in refs if ref not in payloads]
+        if missing:
+            raise ValueError(f"Missing {len(missing)} chunks of a {manifest.kind}, first: {missing[0]}")
+        return manifest.assemble([payloads[ref] for ref in manifest.chunks], self.pickle_config.loads)
+
+    def _get_or_create_identity(self, prepared: PreparedObject) -> tuple[int, int]:
+        """Return the ID and latest version number (0 if none) of the identity of an object"""
+        entry = self.index.identity(prepared.identity_hash)
+        if entry is not None:
+            return entry
+        row = self.session.query(ObjectIdentity.id, func.max(StoredObject.version_number)).outerjoin(
+            StoredObject, StoredObject.identity_id == ObjectIdentity.id
+        ).filter(ObjectIdentity.identity_hash == prepared.identity_hash).group_by(ObjectIdentity.id).first()
+        if row is not None:
+            return row[0], row[1] or 0
+
+        identity = ObjectIdentity(
+            identity_hash=prepared.identity_hash,
+            name=prepared.type_name
+        )
+        if self.identity_ids is not None:
+            identity.id = self.identity_ids.next()
+            self.session.add(identity)
+        else:
+            self.session.add(identity)
+            self.session.flush()  # Ensure identity gets an ID
+        return identity.id, 0
+
+    @staticmethod
+    def code_definition_id(code_content: str) -> str:
+        """Return the ID under which a code definition is stored (hash of its content)"""
+        return hashlib.md5(code_content.encode()).hexdigest()
+
     def store_code_definition(self, name: str, type: str, module_path: str, code_content: str, first_line_no: int | None = None) -> str:
         """Store a code definition and return its ID"""
         # Create a hash of the code content as the ID
-        code_hash = hashlib.md5(code_content.encode()).hexdigest()
+        code_hash = self.code_definition_id(code_content)
 
         # Check if definition already exists
         definition = self.session.query(CodeDefinition).filter_by(id=code_hash).first()
@@ -394,92 +684,78 @@ class ObjectManager:
         self.session.flush()
         return code_hash
 
-    def store(self, value: Any) -> str:
-        """Store an object and return its reference"""
-        # Create appropriate Object instance
-        if isinstance(value, int | float | bool | str | type(None)):
-            obj = Primitive(value, pickle_config=self.pickle_config)
-        elif isinstance(value, list):
-            obj = List(value, pickle_config=self.pickle_config)
-        elif isinstance(value, dict):
-            obj = DictObject(value, pickle_config=self.pickle_config)
-        else:
-            obj = CustomClass(value, pickle_config=self.pickle_config)
+    def prepare(self, value: Any, known_refs: Container[str] | None = None) -> tuple[str, PreparedObject | None]:
+        """Serialize a value without touching the database.
 
-        ref = obj.ref()
+        This is the part of store() that has to run while the value is still in
+        the captured state. The result can be persisted later, possibly from
+        another thread, with store_prepared().
 
-        if ref in self._obj_cache:
-            return ref
-
-        identity = self._get_identity(obj)
-
-        # Store the object
-        stored_obj = self._store_object(obj)
-
-        # Handle versioning for non-primitive types
-        if obj.type != ObjectType.PRIMITIVE:
-            # Get or create identity record
-            identity_record = self.session.query(ObjectIdentity).filter(
-                ObjectIdentity.identity_hash == identity
-            ).first()
+        Args:
+            value: The value to serialize
+            known_refs: References already handed over for storage. If the value's
+                reference is in it, the payload is not serialized again.
 
-            if not identity_record:
-                identity_record = ObjectIdentity(
-                    identity_hash=identity,
-                    creation_time=datetime.datetime.now()
-                )
-                self.session.add(identity_record)
-                try:
-                    self.session.flush()
-                except SQLAlchemyError as e:
-                    logger.warning(f"Error creating identity: {e}")
-                    self.session.rollback()
-                    identity_record = self.session.query(ObjectIdentity).filter(
-                        ObjectIdentity.identity_hash == identity
-                    ).first()
-                    if not identity_record:
-                        raise
-
-            # Check if this exact state already exists in the version history
-            existing_version = self.session.query(StoredObject).filter(
-                StoredObject.identity_id == identity_record.id,
-                StoredObject.id == stored_obj.id
-            ).first()
+        Returns:
+            A tuple (ref, prepared) where prepared is None for known references
+        """
+        if self.inline_limit:
+            ref = inline_ref(value, self.inline_limit)
+            if ref is not None:
+                return ref, None
+        # Without known refs the value is serialized anyway, fingerprinting it would only add cost
+        changes = self.changes if known_refs is not None else None
+        fingerprint = None
+        if changes is not None:
+            ref, fingerprint = changes.check(value)
+            if ref is not None and ref in known_refs:  # type: ignore[operator]
+                return ref, None
+        obj, ref = self._wrap_and_ref(value)
+        if changes is not None:
+            changes.remember(value, ref, fingerprint)
+        if known_refs is not None and ref in known_refs:
+            return ref, None
+        return ref, self._prepare_object(obj)
 
-            if existing_version:
-                # This exact state already exists, return its reference
-                if ref not in self._obj_cache:
-                    self._obj_cache.append(ref)
+    def store(self, value: Any) -> str:
+        """Store an object and return its reference"""
+        if self.inline_limit:
+            ref = inline_ref(value, self.inline_limit)
+            if ref is not None:
+                return ref  # Nothing to store
+        fingerprint = None
+        if self.changes is not None:
+            # An unchanged value that is still stored is not pickled again
+            ref, fingerprint = self.changes.check(value)
+            if ref is not None and ref in self.index:
                 return ref
+        obj, ref = self._wrap_and_ref(value)
+        if self.changes is not None:
+            self.changes.remember(value, ref, fingerprint)
 
-            # Get latest version number
-            latest_version = self.session.query(StoredObject).filter(
-                StoredObject.identity_id == identity_record.id
-            ).order_by(StoredObject.version_number.desc()).first()
-
-            # No need to create a version record, as StoredObject now includes versioning
-            # Just set the version number on the stored_obj
-            new_version_num = 1
-            if latest_version:
-                new_version_num = latest_version.version_number + 1
-            setattr(stored_obj, 'version_number', new_version_num)
-
-            try:
-                self.session.flush()
-            except SQLAlchemyError as e:
-                logger.warning(f"Error creating version: {e}")
-                self.session.rollback()
-                raise
-
-        if ref not in self._obj_cache:
-            self._obj_cache.append(ref)
+        if ref in self.index:
+            return ref
 
+        prepared = self._prepare_object(obj)
+        if self.stats is None:
+            return self.store_prepared(prepared)
+        t1 = time.perf_counter_ns()
+        ref = self.store_prepared(prepared)
+        self.stats.record("db_flush", time.perf_counter_ns() - t1)
         return ref
 
+    def store_prepared(self, prepared: PreparedObject) -> str:
+        """Persist an object previously serialized with prepare() and return its reference"""
+        if prepared.ref not in self.index:
+            self._store_object(prepared)
+        return prepared.ref
+
     def get(self, ref: str) -> tuple[Any, str]:
         """Get an object by its reference"""
         if ref == "<unserializable>":
             return "<unserializable>", "unserializable"
+        if is_inline_ref(ref):
+            return decode_inline_ref(ref)
         stored_obj = self.session.query(StoredObject).filter(StoredObject.id == ref).first()
         if not stored_obj:
             return None, "None"
@@ -502,7 +778,10 @@ class ObjectManager:
             correct_module_path = self._get_correct_module_path_for_object(stored_obj)
 
             # Use the module path fixing unpickler
-            return self.pickle_config.loads(stored_obj.pickle_data, correct_module_path), stored_obj.type_name # type: ignore
+            value = self.pickle_config.loads(stored_obj.pickle_data, correct_module_path) # type: ignore
+            if isinstance(value, ChunkManifest):
+                value = self._assemble(value)
+            return value, stored_obj.type_name
         except (ImportError, AttributeError, ModuleNotFoundError) as e:
             # First try to load the class using the stored code if available
             if self.class_loader is not None and self.code_manager is not None:
@@ -575,6 +854,8 @@ class ObjectManager:
 
     def get_without_pickle(self, ref: str) -> Any | None:
         """Get an object by its reference without unpickling"""
+        if is_inline_ref(ref):
+            return decode_inline_ref(ref)
         stored_obj = self.session.query(StoredObject).filter(StoredObject.id == ref).first()
         if not stored_obj:
             return None
@@ -600,6 +881,8 @@ class ObjectManager:
 
     def next_ref(self, ref: str) -> str | None:
         """Get the next version of an object"""
+        if is_inline_ref(ref):
+            return None  # Primitives have a single version
         try:
             # Get the current version
             current_version = self.session.query(StoredObject).filter(
@@ -622,6 +905,8 @@ class ObjectManager:
 
     def get_history(self, ref: str) -> list:
         """Get the history of an object (all versions)"""
+        if is_inline_ref(ref):
+            return [ref]
         try:
             # Get the current version
             version = self.session.query(StoredObject).filter(
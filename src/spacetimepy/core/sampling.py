@@ -0,0 +1,116 @@
+"""
+Call sampling for high-frequency monitored functions.
+
+A Sampler decides, at each call start, whether the call is recorded. Calls
+that are sampled out are not captured at all: the monitor only keeps a marker
+on its call stack and, in line mode, turns line events off for the function
+until the next recorded call.
+"""
+
+import random
+import threading
+import time
+from typing import Any
+
+
+class Sampler:
+    """Decide which calls of a monitored function are recorded.
+
+    The first ``first`` calls are always recorded. After them, a call is
+    recorded if it passes every configured criterion.
+
+    Args:
+        every: Record one call out of every this many
+        probability: Record each call with this probability
+        max_per_second: Record at most this many calls per second
+        first: Number of calls always recorded before sampling starts
+        seed: Seed of the random generator used with probability
+    """
+
+    def __init__(self, every: int | None = None, probability: float | None = None,
+                 max_per_second: float | None = None, first: int = 0, seed: int | None = None):
+        if every is not None and every < 1:
+            raise ValueError(f"Invalid sampling interval: {every}. Must be at least 1")
+        if probability is not None and not 0 <= probability <= 1:
+            raise ValueError(f"Invalid sampling probability: {probability}. Must be between 0 and 1")
+        if max_per_second is not None and max_per_second <= 0:
+            raise ValueError(f"Invalid sampling rate: {max_per_second}. Must be positive")
+        if first < 0:
+            raise ValueError(f"Invalid number of first calls: {first}. Must be positive")
+
+        self.every = every
+        self.probability = probability
+        self.max_per_second = max_per_second
+        self.first = first
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()  # Calls of every monitored thread are counted
+
+        self._window_start = 0.0
+        self._window_count = 0
+
+        # Counters
+        self.calls = 0
+        self.recorded = 0
+
+    @classmethod
+    def from_option(cls, option: "Sampler | int | float | dict[str, Any] | None") -> "Sampler | None":
+        """Build a sampler from the sample option of the decorators
+
+        Args:
+            option: A Sampler, an int (record every Nth call), a float (probability)
+                or a dict of Sampler arguments
+
+        Returns:
+            The matching Sampler, or None if option is None
+        """
+        if option is None or isinstance(option, Sampler):
+            return option
+        if isinstance(option, dict):
+            return cls(**option)
+        if isinstance(option, int) and not isinstance(option, bool):
+            return cls(every=option)
+        if isinstance(option, float):
+            return cls(probability=option)
+        raise ValueError(f"Invalid sampling option: {option!r}. Must be a Sampler, an int, a float or a dict")
+
+    def should_record(self) -> bool:
+        """Count a call and return whether it is recorded"""
+        with self._lock:
+            self.calls += 1
+            if self.calls > self.first and not self._sampled_in(self.calls - self.first):
+                return False
+            self.recorded += 1
+            return True
+
+    def after_fork(self):
+        """Replace the lock in a forked process (it may have been held by another thread)"""
+        self._lock = threading.Lock()
+
+    def _sampled_in(self, position: int) -> bool:
+        if self.every is not None and (position - 1) % self.every:
+            return False
+        if self.probability is not None and self._random.random() >= self.probability:
+            return False
+        if self.max_per_second is not None:
+            now = time.monotonic()
+            if now - self._window_start >= 1:
+                self._window_start = now
+                self._window_count = 0
+            if self._window_count >= self.max_per_second:
+                return False
+            self._window_count += 1
+        return True
+
+    def describe(self) -> dict[str, Any]:
+        """Return the sampling parameters that are set"""
+        parameters = {
+            "every": self.every,
+            "probability": self.probability,
+            "max_per_second": self.max_per_second,
+            "first": self.first or None,
+        }
+        return {name: value for name, value in parameters.items() if value is not None}
+
+    def __repr__(self):
+        parameters = ", ".join(f"{name}={value!r}" for name, value in self.describe().items())
+        return f"Sampler({parameters})"
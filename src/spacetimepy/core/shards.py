@@ -0,0 +1,250 @@
+"""
+Per-process shard databases.
+
+With ``shard_by_process=True`` every monitored process writes to its own
+database, named after the configured one and the process id
+(``monitoring.db`` -> ``monitoring.<pid>.db``). A forked process records in a
+``process_shards`` row the process, call and session it was forked from.
+
+merge_shards combines the shards into one database. Rows are copied with set
+based ``INSERT ... SELECT`` statements between attached databases: integer IDs
+(calls, snapshots, sessions, object identities) are shifted past the rows
+already merged, content addressed rows (stored objects, code definitions) are
+deduplicated, the sessions continued by forked processes are folded into the
+session of their parent and the top-level calls of a forked process become
+children of the call that forked it.
+
+Object identities are memory addresses, only meaningful within a process and
+the processes forked from it: identity hashes are prefixed with the process
+id of the root of the fork tree, so that unrelated processes never share an
+identity. The versions of a shared identity are numbered after the versions
+already merged.
+"""
+
+import glob
+import logging
+import os
+import re
+import sqlite3
+from typing import Any
+
+from .checkpoint import create_schema
+
+logger = logging.getLogger(__name__)
+
+
+def shard_path(db_path: str, pid: int) -> str:
+    """Return the path of the shard written by a process"""
+    root, ext = os.path.splitext(db_path)
+    return f"{root}.{pid}{ext}"
+
+
+def find_shards(db_path: str) -> list[str]:
+    """Return the paths of the existing shards of a database, sorted by process id"""
+    root, ext = os.path.splitext(db_path)
+    pattern = re.compile(re.escape(root) + r"\.(\d+)" + re.escape(ext) + "$")
+    shards = []
+    for path in glob.glob(glob.escape(root) + ".*" + glob.escape(ext)):
+        match = pattern.match(path)
+        if match:
+            shards.append((int(match.group(1)), path))
+    return [path for _, path in sorted(shards)]
+
+
+def _columns(conn: sqlite3.Connection, schema: str, table: str) -> list[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def _copy_rows(conn: sqlite3.Connection, table: str, expressions: dict[str, str],
+               params: dict[str, Any], where: str = "", verb: str = "INSERT") -> int:
+    """Copy the rows of a table from the attached shard into the main database.
+
+    Columns are copied as is unless an SQL expression is given for them;
+    columns the shard does not have (older version) are left NULL.
+    """
+    shard_columns = set(_columns(conn, "shard", table))
+    columns = [column for column in _columns(conn, "main", table)
+               if column in expressions or column in shard_columns]
+    select = ", ".join(expressions.get(column, column) for column in columns)
+    cursor = conn.execute(
+        f"{verb} INTO main.{table} ({', '.join(columns)}) SELECT {select} FROM shard.{table} {where}", params
+    )
+    return cursor.rowcount
+
+
+def _max_id(conn: sqlite3.Connection, table: str) -> int:
+    return conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM main.{table}").fetchone()[0]
+
+
+def _read_process(path: str) -> dict[str, Any]:
+    conn = sqlite3.connect(path)
+    try:
+        row = conn.execute(
+            "SELECT pid, parent_pid, parent_call_id, parent_session_id, session_id, start_time "
+            "FROM process_shards ORDER BY id LIMIT 1"
+        ).fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    finally:
+        conn.close()
+    if row is None:
+        return {"path": path, "pid": None, "parent_pid": None, "parent_call_id": None,
+                "parent_session_id": None, "session_id": None, "start_time": ""}
+    keys = ("pid", "parent_pid", "parent_call_id", "parent_session_id", "session_id", "start_time")
+    return {"path": path, **dict(zip(keys, row))}
+
+
+def _parents_first(processes: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Order shards so that every forked process comes after the process it was forked from"""
+    remaining = sorted(processes, key=lambda process: process["start_time"] or "")
+    ordered: list[dict[str, Any]] = []
+    pids = {process["pid"] for process in processes}
+    merged: set[int] = set()
+    while remaining:
+        ready = [p for p in remaining if p["parent_pid"] not in pids or p["parent_pid"] in merged]
+        if not ready:
+            # A cycle of reused process ids: merge in start order
+            ready = remaining[:1]
+        for process in ready:
+            remaining.remove(process)
+            ordered.append(process)
+            merged.add(process["pid"])
+    return ordered
+
+
+def merge_shards(db_path: str, shards: list[str] | None = None, remove: bool = False) -> dict[str, int]:
+    """Merge the per-process shards of a database into it.
+
+    Args:
+        db_path: Database the shards belong to, and that receives the merged rows
+            (rows it already has are kept)
+        shards: Paths of the shards to merge (default: every shard of db_path)
+        remove: Delete the shard files once merged
+
+    Returns:
+        Number of shards merged and of calls, snapshots, objects and sessions added
+    """
+    if shards is None:
+        shards = find_shards(db_path)
+    # Create the schema of the merged database
+    create_schema(db_path)
+
+    stats = {"shards": 0, "calls": 0, "snapshots": 0, "objects": 0, "sessions": 0}
+    # Per process: (call ID offset, session ID offset, continued session, merged session it maps to, identity scope)
+    mappings: dict[int, tuple[int, int, int | None, int | None, str]] = {}
+    linked_sessions: set[int] = set()
+    linked_parents: set[int] = set()
+
+    conn = sqlite3.connect(db_path)
+    try:
+        for process in _parents_first([_read_process(path) for path in shards]):
+            conn.execute("ATTACH DATABASE ? AS shard", (process["path"],))
+            try:
+                with conn:
+                    call_offset = _max_id(conn, "function_calls")
+                    snapshot_offset = _max_id(conn, "stack_snapshots")
+                    session_offset = _max_id(conn, "monitoring_sessions")
+                    identity_offset = _max_id(conn, "object_identities")
+                    link_offset = _max_id(conn, "code_object_links")
+                    shard_offset = _max_id(conn, "process_shards")
+
+                    # Link the process to the call and session it was forked from
+                    parent = mappings.get(process["parent_pid"])
+                    root_parent = continued = target = None
+                    # Forked processes share the identities of their parent, other processes have their own
+                    scope = str(process["pid"] if process["pid"] is not None else process["path"])
+                    if parent is not None:
+                        parent_call_offset, parent_session_offset, parent_continued, parent_target, scope = parent
+                        if process["parent_call_id"] is not None:
+                            root_parent = process["parent_call_id"] + parent_call_offset
+                            linked_parents.add(root_parent)
+                        if process["parent_session_id"] is not None and process["session_id"] is not None:
+                            continued = process["session_id"]
+                            if process["parent_session_id"] == parent_continued:
+                                target = parent_target
+                            else:
+                                target = process["parent_session_id"] + parent_session_offset
+                            linked_sessions.add(target)  # type: ignore[arg-type]
+                    if process["pid"] is not None:
+                        mappings[process["pid"]] = (call_offset, session_offset, continued, target, scope)
+
+                    params = {
+                        "calls": call_offset, "snapshots": snapshot_offset, "sessions": session_offset,
+                        "identities": identity_offset, "links": link_offset, "shards": shard_offset, "pid": process["pid"],
+                        "root_parent": root_parent, "continued": continued, "target": target, "scope": f"{scope}:",
+                    }
+                    session_id = "CASE WHEN session_id = :continued THEN :target ELSE session_id + :sessions END"
+
+                    # Content addressed rows are shared by the processes
+                    _copy_rows(conn, "code_definitions", {}, params, verb="INSERT OR IGNORE")
+                    _copy_rows(conn, "object_identities", {
+                        "id": "id + :identities",
+                        "identity_hash": ":scope || identity_hash",
+                    }, params, verb="INSERT OR IGNORE")
+                    if _columns(conn, "shard", "object_chunks"):  # Shards of older versions have no chunks
+                        _copy_rows(conn, "object_chunks", {}, params, verb="INSERT OR IGNORE")
+                    identity_id = ("(SELECT m.id FROM main.object_identities m JOIN shard.object_identities s "
+                                   "ON m.identity_hash = :scope || s.identity_hash WHERE s.id = stored_objects.identity_id)")
+                    stats["objects"] += _copy_rows(conn, "stored_objects", {
+                        "identity_id": identity_id,
+                        "version_number": f"version_number + (SELECT COALESCE(MAX(v.version_number), 0) "
+                                          f"FROM main.stored_objects v WHERE v.identity_id = {identity_id})",
+                    }, params, verb="INSERT OR IGNORE")
+                    _copy_rows(conn, "code_object_links", {"id": "id + :links"}, params, where=(
+                        "WHERE NOT EXISTS (SELECT 1 FROM main.code_object_links m WHERE m.object_id = code_object_links.object_id "
+                        "AND m.definition_id = code_object_links.definition_id)"
+                    ))
+
+                    stats["sessions"] += _copy_rows(conn, "monitoring_sessions", {"id": "id + :sessions"}, params,
+                                                    where="WHERE id IS NOT :continued")
+                    stats["calls"] += _copy_rows(conn, "function_calls", {
+                        "id": "id + :calls",
+                        "parent_call_id": "CASE WHEN parent_call_id IS NULL THEN :root_parent ELSE parent_call_id + :calls END",
+                        "session_id": session_id,
+                        "first_snapshot_id": "first_snapshot_id + :snapshots",
+                        "process_id": "COALESCE(process_id, :pid)",
+                    }, params)
+                    stats["snapshots"] += _copy_rows(conn, "stack_snapshots", {
+                        "id": "id + :snapshots",
+                        "function_call_id": "function_call_id + :calls",
+                        "next_snapshot_id": "next_snapshot_id + :snapshots",
+                    }, params)
+                    _copy_rows(conn, "process_shards", {
+                        "id": "id + :shards",
+                        "parent_call_id": ":root_parent",
+                        "parent_session_id": ":target",
+                        "session_id": session_id,
+                    }, params)
+            finally:
+                conn.execute("DETACH DATABASE shard")
+            stats["shards"] += 1
+            logger.info(f"Merged shard {process['path']}")
+
+        # Calls of the forked processes were appended: order them by start time
+        with conn:
+            for session in linked_sessions:
+                _renumber(conn, "order_in_session", "session_id = ?", session)
+            for call in linked_parents:
+                _renumber(conn, "order_in_parent", "parent_call_id = ?", call)
+    finally:
+        conn.close()
+
+    if remove:
+        for path in shards:
+            os.remove(path)
+    return stats
+
+
+def _renumber(conn: sqlite3.Connection, column: str, where: str, value: int):
+    conn.execute("CREATE TEMP TABLE merged_order (id INTEGER PRIMARY KEY, position INTEGER)")
+    try:
+        conn.execute(
+            f"INSERT INTO merged_order SELECT id, ROW_NUMBER() OVER (ORDER BY start_ns, id) - 1 "
+            f"FROM function_calls WHERE {where}", (value,)
+        )
+        conn.execute(
+            f"UPDATE function_calls SET {column} = (SELECT position FROM merged_order WHERE merged_order.id = function_calls.id) "
+            f"WHERE {where}", (value,)
+        )
+    finally:
+        conn.execute("DROP TABLE merged_order")
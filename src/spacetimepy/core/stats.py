@@ -0,0 +1,193 @@
+"""
+Self-instrumentation of the monitor.
+
+With ``performance=True`` the monitor measures the cost of monitoring itself.
+Durations are recorded in LatencyHistograms, log-linear histograms in the
+style of HDR histograms: memory is fixed whatever the number of events, and
+percentiles are accurate to a few percent. MonitorStats keeps one histogram
+per phase (callbacks, frame inspection, globals analysis, pickling, hashing,
+database flush and commit) and per function, and renders them as a dict or in
+the Prometheus text exposition format.
+"""
+
+import os
+import threading
+from typing import Any
+
+# Phases measured by the monitor, its object manager and its writer
+CALLBACK_PHASES = ("function_starts", "function_returns", "line_events")
+PHASES = CALLBACK_PHASES + ("frame_inspection", "globals_analysis", "pickling", "hashing", "db_flush", "db_commit")
+
+# Label of the durations not attributed to a function (e.g. commits of the writer thread)
+ALL_FUNCTIONS = "*"
+
+SUMMARY_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class LatencyHistogram:
+    """Fixed-memory histogram of durations in nanoseconds.
+
+    Every power of two is split into SUB_BUCKETS buckets of equal width, so
+    that a value is known to within 1/SUB_BUCKETS of itself. Values of
+    2**MAX_EXPONENT ns (about 18 minutes) and more are counted in the last bucket.
+    """
+
+    SUB_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BITS
+    MAX_EXPONENT = 40
+
+    __slots__ = ("count", "counts", "max", "min", "total")
+
+    def __init__(self):
+        self.counts = [0] * ((self.MAX_EXPONENT - self.SUB_BITS + 1) * self.SUB_BUCKETS)
+        self.count = 0
+        self.total = 0
+        self.min: int | None = None
+        self.max: int | None = None
+
+    @classmethod
+    def bucket_index(cls, value: int) -> int:
+        """Return the index of the bucket counting a value"""
+        if value < cls.SUB_BUCKETS:
+            return max(value, 0)
+        shift = value.bit_length() - cls.SUB_BITS - 1
+        index = (shift + 1) * cls.SUB_BUCKETS + (value >> shift) - cls.SUB_BUCKETS
+        return min(index, (cls.MAX_EXPONENT - cls.SUB_BITS + 1) * cls.SUB_BUCKETS - 1)
+
+    @classmethod
+    def bucket_range(cls, index: int) -> tuple[int, int]:
+        """Return the lowest and highest values counted in a bucket"""
+        if index < cls.SUB_BUCKETS:
+            return index, index
+        shift = index // cls.SUB_BUCKETS - 1
+        low = (cls.SUB_BUCKETS + index % cls.SUB_BUCKETS) << shift
+        return low, low + (1 << shift) - 1
+
+    def record(self, value: int):
+        """Count a duration in nanoseconds"""
+        self.counts[self.bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, quantile: float) -> int | None:
+        """Return the value below which a share of the durations falls (None if empty)"""
+        if not self.count:
+            return None
+        rank = max(1, round(quantile * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                low, high = self.bucket_range(index)
+                # Middle of the bucket, within the values actually seen
+                return min(max((low + high) // 2, self.min), self.max)  # type: ignore[type-var]
+        return self.max
+
+    def summary(self) -> dict[str, Any]:
+        """Return the count, total, extremes, mean and main percentiles, in nanoseconds"""
+        summary: dict[str, Any] = {
+            "count": self.count,
+            "total_ns": self.total,
+            "min_ns": self.min,
+            "max_ns": self.max,
+            "mean_ns": self.total / self.count if self.count else None,
+        }
+        for quantile in SUMMARY_QUANTILES:
+            summary[f"p{quantile * 100:g}_ns"] = self.percentile(quantile)
+        return summary
+
+
+class MonitorStats:
+    """Latency histograms of the monitor, per phase and per function.
+
+    Durations recorded without a function are attributed to the function of
+    the callback running on the same thread (see ``function``), or to
+    ALL_FUNCTIONS outside callbacks.
+    """
+
+    def __init__(self):
+        self._histograms: dict[tuple[str, str], LatencyHistogram] = {}
+        self._lock = threading.Lock()  # Callbacks of every thread and the writer thread record durations
+        self._local = threading.local()
+
+    @property
+    def function(self) -> str:
+        """Function whose callback is running on the current thread"""
+        return getattr(self._local, "function", ALL_FUNCTIONS)
+
+    @function.setter
+    def function(self, name: str):
+        self._local.function = name
+
+    def record(self, phase: str, duration_ns: int, function: str | None = None):
+        """Record the duration of a phase"""
+        key = (phase, function if function is not None else self.function)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = LatencyHistogram()
+            histogram.record(duration_ns)
+
+    def histogram(self, phase: str, function: str | None = None) -> LatencyHistogram:
+        """Return the histogram of a phase, for one function or merged across functions"""
+        with self._lock:
+            if function is not None:
+                return self._histograms.get((phase, function)) or LatencyHistogram()
+            merged = LatencyHistogram()
+            for (histogram_phase, _), histogram in self._histograms.items():
+                if histogram_phase != phase or not histogram.count:
+                    continue
+                merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts, strict=True)]
+                merged.count += histogram.count
+                merged.total += histogram.total
+                merged.min = histogram.min if merged.min is None else min(merged.min, histogram.min)  # type: ignore[type-var]
+                merged.max = histogram.max if merged.max is None else max(merged.max, histogram.max)  # type: ignore[type-var]
+            return merged
+
+    def to_dict(self) -> dict[str, Any]:
+        """Return the summaries of every phase: merged under "total" and per function"""
+        with self._lock:
+            keys = sorted(self._histograms)
+        phases: dict[str, Any] = {}
+        for phase, function in keys:
+            entry = phases.setdefault(phase, {"functions": {}})
+            entry["functions"][function] = self.histogram(phase, function).summary()
+        for phase, entry in phases.items():
+            entry["total"] = self.histogram(phase).summary()
+        return phases
+
+    def to_prometheus(self, prefix: str = "spacetimepy") -> str:
+        """Render the histograms as Prometheus summaries (seconds), one series per phase and function"""
+        with self._lock:
+            keys = sorted(self._histograms)
+        name = f"{prefix}_monitor_phase_seconds"
+        lines = [f"# HELP {name} Time spent by the monitor, per phase and monitored function",
+                 f"# TYPE {name} summary"]
+        for phase, function in keys:
+            histogram = self.histogram(phase, function)
+            labels = f'phase="{phase}",function="{_escape_label(function)}"'
+            for quantile in SUMMARY_QUANTILES:
+                value = histogram.percentile(quantile)
+                lines.append(f'{name}{{{labels},quantile="{quantile:g}"}} {_seconds(value)}')
+            lines.append(f"{name}_sum{{{labels}}} {_seconds(histogram.total)}")
+            lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str, prefix: str = "spacetimepy"):
+        """Write the Prometheus text file atomically (for the node exporter textfile collector)"""
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            f.write(self.to_prometheus(prefix))
+        os.replace(temporary, path)
+
+
+def _seconds(value: int | None) -> str:
+    return "NaN" if value is None else repr(value / 1e9)
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,300 @@
+"""
+Size- and depth-bounded object capture.
+
+A CaptureBudget limits what the object manager pickles: values that are too
+large (in bytes), too long (number of elements) or too deeply nested are
+stored as a ValueSummary instead. The budget is checked before pickling from
+cheap properties of the value (length, nbytes, nesting); the byte budget is
+checked again on the pickle, before it is written.
+
+A summary keeps the type, length, shape, numeric statistics, the first and
+last elements and a content hash of the value. A rejected value is never
+pickled: the hash covers the buffer of strings, bytes and arrays, and
+otherwise what the summary holds and a sample of the elements. It cannot be turned back into
+the value: reanimation refuses to pass summaries as arguments and does not
+inject them as globals.
+"""
+
+import contextlib
+import hashlib
+import itertools
+import math
+import reprlib
+from collections import deque
+from typing import Any
+
+# Containers whose length and nesting are checked before pickling
+_CONTAINERS = (list, tuple, set, frozenset, dict, deque)
+# Values whose size in bytes is their length
+_BUFFERS = (str, bytes, bytearray)
+# Elements of a container hashed in the content hash of its summary
+_SAMPLES = 64
+
+_repr = reprlib.Repr()
+_repr.maxstring = 60
+_repr.maxother = 60
+
+
+class ValueSummary:
+    """Compact, non-rehydratable description of a value that exceeded the capture budget.
+
+    Args:
+        type_name: Qualified name of the type of the value
+        reason: Budget exceeded: "bytes", "length" or "depth"
+        length: Number of elements (None if the value has no length)
+        shape: Shape of array-likes
+        dtype: Element type of array-likes
+        size_bytes: Size of the value in bytes, if known
+        minimum, maximum, mean: Statistics of numeric values
+        head, tail: Reprs of the first and last elements
+        preview: Short repr of the whole value
+        content_hash: Hash of the content of the value (None if it could not be hashed)
+    """
+
+    rehydratable = False  # The value cannot be rebuilt from its summary
+
+    def __init__(self, type_name: str, reason: str, length: int | None = None, shape: tuple | None = None,
+                 dtype: str | None = None, size_bytes: int | None = None, minimum: float | None = None,
+                 maximum: float | None = None, mean: float | None = None, head: list[str] | None = None,
+                 tail: list[str] | None = None, preview: str | None = None, content_hash: str | None = None):
+        self.type_name = type_name
+        self.reason = reason
+        self.length = length
+        self.shape = shape
+        self.dtype = dtype
+        self.size_bytes = size_bytes
+        self.minimum = minimum
+        self.maximum = maximum
+        self.mean = mean
+        self.head = head or []
+        self.tail = tail or []
+        self.preview = preview
+        self.content_hash = content_hash
+
+    def to_dict(self) -> dict[str, Any]:
+        """Return the summary as a dictionary"""
+        return {"summary": True, **self.__dict__}
+
+    def __eq__(self, other):
+        return isinstance(other, ValueSummary) and self.__dict__ == other.__dict__
+
+    def __hash__(self):
+        return hash((self.type_name, self.content_hash))
+
+    def __repr__(self):
+        details = [f"{self.reason} over budget"]
+        if self.length is not None:
+            details.append(f"length={self.length}")
+        if self.shape is not None:
+            details.append(f"shape={self.shape}")
+        return f"<summary of {self.type_name}: {', '.join(details)}>"
+
+
+class CaptureBudget:
+    """Limits on the values pickled by the object manager.
+
+    Args:
+        max_bytes: Largest size in bytes of a value (estimated before pickling, then measured on the pickle)
+        max_length: Largest number of elements of a container, string excluded
+        max_depth: Deepest nesting of containers and object attributes (a flat list has depth 1)
+        items: Number of first and last elements kept in summaries
+    """
+
+    def __init__(self, max_bytes: int | None = None, max_length: int | None = None,
+                 max_depth: int | None = None, items: int = 3):
+        for name, limit in (("max_bytes", max_bytes), ("max_length", max_length), ("max_depth", max_depth)):
+            if limit is not None and limit < 1:
+                raise ValueError(f"Invalid capture budget {name}: {limit}. Must be at least 1")
+        if items < 0:
+            raise ValueError(f"Invalid number of summary items: {items}. Must be positive")
+        self.max_bytes = max_bytes
+        self.max_length = max_length
+        self.max_depth = max_depth
+        self.items = items
+
+    @classmethod
+    def from_option(cls, option: "CaptureBudget | int | dict[str, Any] | None") -> "CaptureBudget | None":
+        """Build a budget from the capture_budget option of the monitor
+
+        Args:
+            option: A CaptureBudget, an int (max_bytes) or a dict of CaptureBudget arguments
+        """
+        if option is None or isinstance(option, CaptureBudget):
+            return option
+        if isinstance(option, dict):
+            return cls(**option)
+        if isinstance(option, int) and not isinstance(option, bool):
+            return cls(max_bytes=option)
+        raise ValueError(f"Invalid capture budget: {option!r}")
+
+    def check(self, value: Any) -> str | None:
+        """Return the budget a value exceeds before pickling it ("bytes", "length" or "depth"), or None"""
+        if self.max_bytes is not None:
+            size = estimated_bytes(value)
+            if size is not None and size > self.max_bytes:
+                return "bytes"
+        if self.max_length is None and self.max_depth is None:
+            return None
+        return self._check_shape(value, 0, set())
+
+    def _check_shape(self, value: Any, depth: int, visited: set[int]) -> str | None:
+        if isinstance(value, _BUFFERS):
+            return None
+        if isinstance(value, _CONTAINERS):
+            children = value.values() if isinstance(value, dict) else value
+        elif hasattr(value, "shape"):
+            # Array-likes are bounded by their length and their size in bytes
+            length = _length(value)
+            if self.max_length is not None and length is not None and length > self.max_length:
+                return "length"
+            return None
+        elif hasattr(value, "__dict__") and not isinstance(value, type):
+            children = vars(value).values()
+        else:
+            return None
+
+        if id(value) in visited:
+            return None
+        visited.add(id(value))
+        if self.max_length is not None and len(children) > self.max_length:  # type: ignore[arg-type]
+            return "length"
+        if self.max_depth is not None and depth + 1 > self.max_depth:
+            return "depth"
+        for child in children:
+            reason = self._check_shape(child, depth + 1, visited)
+            if reason is not None:
+                return reason
+        return None
+
+    def summarize(self, value: Any, reason: str, content_hash: str | None = None,
+                  size_bytes: int | None = None) -> ValueSummary:
+        """Describe a value that exceeded the budget
+
+        Args:
+            value: The value
+            reason: Budget exceeded
+            content_hash: Hash of the pickle of the value, if it was already pickled
+            size_bytes: Size of the pickle of the value, if it was already pickled
+        """
+        summary = ValueSummary(
+            type_name=f"{type(value).__module__}.{type(value).__qualname__}",
+            reason=reason,
+            length=_length(value),
+            size_bytes=size_bytes if size_bytes is not None else estimated_bytes(value),
+            content_hash=content_hash,
+        )
+        shape = getattr(value, "shape", None)
+        if isinstance(shape, tuple):
+            summary.shape = shape
+        dtype = getattr(value, "dtype", None)
+        if dtype is not None:
+            summary.dtype = str(dtype)
+        with contextlib.suppress(Exception):
+            summary.minimum, summary.maximum, summary.mean = _numeric_stats(value)
+        with contextlib.suppress(Exception):
+            summary.head, summary.tail = self._ends(value)
+        summary.preview = f"<{summary.type_name}>"
+        with contextlib.suppress(Exception):
+            summary.preview = _repr.repr(value)
+        if summary.content_hash is None:
+            summary.content_hash = _content_hash(value, summary)
+        return summary
+
+    def _ends(self, value: Any) -> tuple[list[str], list[str]]:
+        """Return the reprs of the first and last elements of a value"""
+        n = self.items
+        if not n:
+            return [], []
+        if isinstance(value, dict):
+            head = list(itertools.islice(value.items(), n))
+            tail = list(itertools.islice(reversed(value.items()), n))[::-1]
+            return [_repr.repr(item) for item in head], [_repr.repr(item) for item in tail]
+        if isinstance(value, _BUFFERS):
+            width = n * 20
+            return [_repr.repr(value[:width])], [_repr.repr(value[-width:])]
+        if isinstance(value, list | tuple | deque):
+            return [_repr.repr(item) for item in itertools.islice(value, n)], \
+                [_repr.repr(item) for item in list(itertools.islice(reversed(value), n))[::-1]]
+        if isinstance(value, set | frozenset):
+            return [_repr.repr(item) for item in itertools.islice(value, n)], []
+        if hasattr(value, "shape") and hasattr(value, "tolist"):
+            return [_repr.repr(item) for item in value[:n].tolist()], [_repr.repr(item) for item in value[-n:].tolist()]
+        return [], []
+
+
+def estimated_bytes(value: Any) -> int | None:
+    """Return the size in bytes of a value without pickling it, if it is cheap to know"""
+    if isinstance(value, _BUFFERS):
+        return len(value)
+    if isinstance(value, memoryview):
+        return value.nbytes
+    if isinstance(value, _CONTAINERS) or not hasattr(value, "shape"):
+        return None
+    with contextlib.suppress(Exception):
+        nbytes = getattr(value, "nbytes", None)
+        if isinstance(nbytes, int):
+            return nbytes
+        # pandas objects
+        usage = value.memory_usage(deep=False)
+        return int(usage.sum()) if hasattr(usage, "sum") else int(usage)
+    return None
+
+
+def _length(value: Any) -> int | None:
+    with contextlib.suppress(Exception):
+        return len(value)
+    return None
+
+
+def _content_hash(value: Any, summary: ValueSummary) -> str | None:
+    """Hash the content of a value without pickling it.
+
+    Strings, bytes and arrays hash their buffer. Other values hash the fields
+    of their summary and the reprs of up to _SAMPLES elements spread over the
+    value: values that only differ in elements outside the sample share a hash,
+    as they share everything else in their summary.
+    """
+    with contextlib.suppress(Exception):
+        if isinstance(value, str):
+            return hashlib.md5(value.encode("utf-8", "surrogatepass")).hexdigest()
+        if isinstance(value, bytes | bytearray | memoryview):
+            return hashlib.md5(value).hexdigest()
+        if hasattr(value, "shape"):
+            with contextlib.suppress(TypeError, ValueError):
+                return hashlib.md5(memoryview(value)).hexdigest()
+        fields = {name: field for name, field in summary.__dict__.items() if name != "content_hash"}
+        hasher = hashlib.md5(repr(sorted(fields.items())).encode("utf-8", "surrogatepass"))
+        for element in _sample(value):
+            hasher.update(_repr.repr(element).encode("utf-8", "surrogatepass"))
+        return hasher.hexdigest()
+    return None
+
+
+def _sample(value: Any) -> list[Any]:
+    """Return up to _SAMPLES elements (items of dicts and attributes) spread over a value"""
+    if isinstance(value, list | tuple):
+        return list(value[::max(1, len(value) // _SAMPLES)])
+    if isinstance(value, dict):
+        elements = value.items()
+    elif isinstance(value, set | frozenset | deque):
+        elements = value
+    elif hasattr(value, "__dict__") and not isinstance(value, type):
+        elements = vars(value).items()
+    else:
+        return []
+    return list(itertools.islice(elements, 0, None, max(1, len(elements) // _SAMPLES)))
+
+
+def _numeric_stats(value: Any) -> tuple[float | None, float | None, float | None]:
+    """Return the minimum, maximum and mean of numeric values, or Nones"""
+    dtype = getattr(value, "dtype", None)
+    if dtype is not None:
+        if getattr(dtype, "kind", None) not in ("i", "u", "f") or not getattr(value, "size", 0):
+            return None, None, None
+        return float(value.min()), float(value.max()), float(value.mean())
+    if not isinstance(value, list | tuple | set | frozenset | deque) or not value:
+        return None, None, None
+    if not set(map(type, value)) <= {int, float}:
+        return None, None, None
+    mean = math.fsum(value) / len(value)
+    return float(min(value)), float(max(value)), mean
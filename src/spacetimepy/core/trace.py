@@ -6,7 +6,7 @@ import networkx as nx
 from sqlalchemy.orm import Session
 
 from .function_call import FunctionCallRepository
-from .models import CodeDefinition, FunctionCall, StackSnapshot
+from .models import CodeDefinition, FunctionCall, StackSnapshot, resolve_snapshot_refs
 from .representation import ObjectManager, PickleConfig
 
 logger = logging.getLogger(__name__)
@@ -87,12 +87,12 @@ class TraceExporter:
 
             # Export the trace with actual variable values
             trace_snapshots = []
-            for snapshot in snapshots:
+            for snapshot, (locals_refs, globals_refs) in zip(snapshots, resolve_snapshot_refs(snapshots), strict=True):
                 try:
                     # Rehydrate local variables
                     locals_values = {}
-                    if snapshot.locals_refs:
-                        for var_name, obj_ref in snapshot.locals_refs.items():
+                    if locals_refs:
+                        for var_name, obj_ref in locals_refs.items():
                             try:
                                 value = self.object_manager.rehydrate(obj_ref)
                                 locals_values[var_name] = self._serialize_value(value)
@@ -102,8 +102,8 @@ class TraceExporter:
 
                     # Rehydrate global variables (filtered to exclude system variables)
                     globals_values = {}
-                    if snapshot.globals_refs:
-                        for var_name, obj_ref in snapshot.globals_refs.items():
+                    if globals_refs:
+                        for var_name, obj_ref in globals_refs.items():
                             # Skip system variables and modules
                             if not var_name.startswith("__") and not var_name.endswith("__"):
                                 try:
@@ -0,0 +1,499 @@
+"""
+Background persistence for SpaceTimeMonitor.
+
+In writer mode the monitoring callbacks do not touch the database. They build
+compact event records and hand them to a CaptureWriter, whose thread drains a
+bounded queue and persists the records in bulk.
+"""
+
+import logging
+import pickle
+import queue
+import tempfile
+import threading
+import time
+from collections.abc import Callable
+from typing import Any, NamedTuple
+
+from sqlalchemy.orm import Session
+
+from .capture_store import CaptureBatch, create_capture_store
+from .representation import ObjectManager, PreparedObject
+from .stats import ALL_FUNCTIONS, MonitorStats
+
+logger = logging.getLogger(__name__)
+
+BACKPRESSURE_POLICIES = ("block", "drop", "spill")
+
+
+class CommitPolicy:
+    """Decide when captured events are committed.
+
+    Committing after every event is the safest but slowest option. Grouping
+    commits trades throughput against the events lost if the process crashes.
+    Whatever the policy, pending events are committed at session boundaries,
+    on flush() and on shutdown.
+
+    Args:
+        every: Commit once this many events are pending (None disables the count trigger)
+        interval_ms: Commit once the oldest pending event is older than this many milliseconds
+        session_only: Only commit at session boundaries, flush() and shutdown
+    """
+
+    def __init__(self, every: int | None = 1, interval_ms: float | None = None, session_only: bool = False):
+        if every is not None and every < 1:
+            raise ValueError(f"Invalid commit count: {every}. Must be at least 1")
+        if interval_ms is not None and interval_ms < 0:
+            raise ValueError(f"Invalid commit interval: {interval_ms}. Must be positive")
+
+        self.every = None if session_only else every
+        self.interval_ms = None if session_only else interval_ms
+        self.session_only = session_only
+
+        self.pending = 0  # Events written but not committed yet
+        self._pending_since: float | None = None
+
+        # Counters
+        self.events = 0
+        self.commits = 0
+        self.coalesced = 0  # Events that were committed together with a later one
+
+    @classmethod
+    def from_option(cls, option: "CommitPolicy | str | int | None") -> "CommitPolicy":
+        """Build a policy from the commit_policy option of init_monitoring
+
+        Args:
+            option: A CommitPolicy, "event" (commit every event), "session"
+                (only at session boundaries) or a number of events
+
+        Returns:
+            The matching CommitPolicy
+        """
+        if isinstance(option, CommitPolicy):
+            return option
+        if option is None or option == "event":
+            return cls()
+        if option == "session":
+            return cls(session_only=True)
+        if isinstance(option, int) and not isinstance(option, bool):
+            return cls(every=option)
+        raise ValueError(f"Invalid commit policy: {option!r}. Must be a CommitPolicy, 'event', 'session' or a number of events")
+
+    def record(self, count: int = 1) -> bool:
+        """Record events written to the session and return whether a commit is due"""
+        if self.pending == 0:
+            self._pending_since = time.monotonic()
+        self.pending += count
+        self.events += count
+        return self.is_due()
+
+    def is_due(self) -> bool:
+        """Whether the pending events should be committed now"""
+        if self.pending == 0:
+            return False
+        if self.every is not None and self.pending >= self.every:
+            return True
+        if self.interval_ms is not None and self._pending_since is not None:
+            return (time.monotonic() - self._pending_since) * 1000 >= self.interval_ms
+        return False
+
+    def committed(self):
+        """Record that every pending event was committed"""
+        if self.pending:
+            self.commits += 1
+            self.coalesced += self.pending - 1
+        self.pending = 0
+        self._pending_since = None
+
+    def discarded(self):
+        """Record that the pending events were rolled back"""
+        self.pending = 0
+        self._pending_since = None
+
+    def stats(self) -> dict[str, int]:
+        """Return the commit counters"""
+        return {
+            "events": self.events,
+            "commits": self.commits,
+            "coalesced": self.coalesced,
+            "pending": self.pending,
+        }
+
+
+class CallStart(NamedTuple):
+    """A function call that just started"""
+    id: int
+    function: str
+    file: str | None
+    line: int | None
+    start_ns: int  # Nanoseconds since the epoch
+    locals_refs: dict[str, str]
+    globals_refs: dict[str, str]
+    code_definition_id: str | None
+    call_metadata: dict[str, Any] | None
+    parent_call_id: int | None
+    session_id: int | None
+    order_in_session: int | None
+    order_in_parent: int | None
+    thread_id: int | None = None
+    thread_name: str | None = None
+    task_name: str | None = None
+    process_id: int | None = None
+
+
+class CallEnd(NamedTuple):
+    """The end (return or exception) of a previously started function call"""
+    id: int
+    end_ns: int
+    return_ref: str | None
+    call_metadata: dict[str, Any] | None
+    exception_ref: str | None = None
+
+
+class Snapshot(NamedTuple):
+    """A stack snapshot taken at a line event"""
+    id: int
+    function_call_id: int
+    line_number: int
+    timestamp_ns: int
+    locals_refs: dict[str, str]
+    globals_refs: dict[str, str]
+    order_in_call: int
+    previous_snapshot_id: int | None
+    is_keyframe: bool = True  # False if the refs only hold the bindings changed since the previous snapshot
+
+
+class CodeDefinitionRecord(NamedTuple):
+    """Source code of a monitored function"""
+    name: str
+    type: str
+    module_path: str
+    code_content: str
+    first_line_no: int | None
+
+
+class PendingCall(NamedTuple):
+    """Call stack entry of a function call handed to the writer"""
+    id: int
+    function: str
+    call_metadata: dict[str, Any] | None
+    dropped: bool  # The CallStart was dropped, later records of this call are skipped
+
+
+class _Barrier:
+    """Queue marker released once every record submitted before it is committed"""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class CaptureWriter:
+    """Persist capture records from a dedicated thread.
+
+    Every submitted event is a pair ``(objects, record)``: the prepared objects
+    referenced by the record and the record itself. Events are persisted in
+    submission order, objects before the rows referencing them.
+
+    When the queue is full the backpressure policy decides what happens:
+
+    - ``"block"``: the monitored thread waits for the writer
+    - ``"drop"``: the event is discarded and counted in ``dropped``
+    - ``"spill"``: the event is appended to a temporary file that the writer
+      replays once the queue has drained
+
+    Batches are written as soon as they are dequeued, the commit policy decides
+    when they are committed. Barriers (flush()) always commit. The capture
+    backend selects how rows are written: through the ORM ("orm") or with raw
+    sqlite3 executemany statements ("sqlite"). When a write or a commit fails
+    the session is rolled back and ``on_rollback`` is called, so that callers
+    forget the objects they consider persisted.
+    """
+
+    def __init__(self, session: Session, object_manager: ObjectManager, lock: Any = None,
+                 queue_size: int = 1000, backpressure: str = "block", batch_size: int = 500,
+                 flush_interval: float = 0.1, commit_policy: CommitPolicy | None = None,
+                 capture_backend: str = "orm", stats: MonitorStats | None = None,
+                 on_rollback: Callable[[], None] | None = None):
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Invalid backpressure policy: {backpressure}. Must be one of {', '.join(BACKPRESSURE_POLICIES)}")
+
+        self.session = session
+        self.object_manager = object_manager
+        self.lock = lock or threading.RLock()
+        self.backpressure = backpressure
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval  # Longest time spilled events wait before being replayed
+        self.commit_policy = commit_policy or CommitPolicy()
+        self.store = create_capture_store(capture_backend, session, object_manager)
+        self.stats = stats  # Durations of the writes ("db_flush") and commits ("db_commit")
+        self.on_rollback = on_rollback
+
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+
+        # Spill state: once spilling starts, every event goes to the spill file
+        # until the writer has replayed it, so that ordering is preserved
+        self._spill_lock = threading.Lock()
+        self._spill_file = None
+        self._spill_count = 0
+        self._spill_barriers: list[tuple[int, _Barrier]] = []
+        self._spilling = False
+
+        # Counters. Monitored threads update submitted and dropped under the counter lock,
+        # spilled under the spill lock; the writer thread alone updates persisted and batches.
+        self._counter_lock = threading.Lock()
+        self.submitted = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.persisted = 0
+        self.batches = 0
+
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="spacetimepy-writer", daemon=True)
+        self._thread.start()
+
+    @property
+    def is_alive(self) -> bool:
+        """Whether the writer thread is running"""
+        return self._thread.is_alive()
+
+    def submit(self, objects: list[PreparedObject], record: Any) -> bool:
+        """Queue an event for persistence.
+
+        Args:
+            objects: Prepared objects referenced by the record
+            record: A CallStart, CallEnd, Snapshot or CodeDefinitionRecord
+
+        Returns:
+            False if the event was dropped by the backpressure policy, True otherwise
+        """
+        with self._counter_lock:
+            self.submitted += 1
+        item = (objects, record)
+
+        if self._spilling:
+            with self._spill_lock:
+                if self._spilling:
+                    self._spill(item)
+                    return True
+
+        if self.backpressure == "block":
+            self._queue.put(item)
+            return True
+
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+
+        if self.backpressure == "drop":
+            with self._counter_lock:
+                self.dropped += 1
+            return False
+
+        with self._spill_lock:
+            self._spilling = True
+            self._spill(item)
+        return True
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Wait until every event submitted so far is committed.
+
+        Args:
+            timeout: Maximum number of seconds to wait (None waits forever)
+
+        Returns:
+            True if the barrier was reached, False on timeout or if the writer is not running
+        """
+        if not self.is_alive:
+            return False
+        barrier = _Barrier()
+        with self._spill_lock:
+            if self._spilling:
+                self._spill(barrier)
+            else:
+                self._queue.put(barrier)
+        return barrier.done.wait(timeout)
+
+    def close(self, timeout: float | None = None):
+        """Flush pending events and stop the writer thread"""
+        if not self.is_alive:
+            return
+        self.flush(timeout)
+        self._stopping = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _spill(self, item):
+        """Append an item to the spill file (caller holds the spill lock)"""
+        if isinstance(item, _Barrier):
+            # Barriers cannot be pickled, remember their position in the spill file instead
+            self._spill_barriers.append((self._spill_count, item))
+            return
+        if self._spill_file is None:
+            # Kept open across submissions, closed once replayed by _drain_spill
+            self._spill_file = tempfile.TemporaryFile(prefix="spacetimepy-spill-")  # noqa: SIM115
+        pickle.dump(item, self._spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spill_count += 1
+        self.spilled += 1
+
+    def _drain_spill(self) -> list:
+        """Read back every spilled item, in submission order, and leave spill mode"""
+        with self._spill_lock:
+            items = []
+            if self._spill_file is not None:
+                self._spill_file.seek(0)
+                for _ in range(self._spill_count):
+                    items.append(pickle.load(self._spill_file))
+                self._spill_file.close()
+                self._spill_file = None
+            for position, barrier in reversed(self._spill_barriers):
+                items.insert(position, barrier)
+            self._spill_barriers = []
+            self._spill_count = 0
+            self._spilling = False
+            return items
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                # Nothing reaches the queue while spilling, replay the spill file
+                if self._spilling:
+                    self._process(self._drain_spill())
+                elif self.commit_policy.is_due():
+                    # Time-based commits must not wait for the next event
+                    self._commit()
+                continue
+
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            batch = [entry for entry in batch if entry is not None]
+            if self._spilling and self._queue.empty():
+                batch.extend(self._drain_spill())
+
+            self._process(batch)
+            if stop and self._stopping:
+                return
+
+    def _process(self, batch: list):
+        """Persist a batch, then release the barriers it contains"""
+        events = []
+        for item in batch:
+            if isinstance(item, _Barrier):
+                self._persist(events)
+                events = []
+                self._commit()
+                item.done.set()
+            else:
+                events.append(item)
+        self._persist(events)
+
+    def _persist(self, events: list):
+        if not events:
+            return
+        with self.lock:
+            try:
+                t1 = time.perf_counter_ns()
+                self._write_events(events)
+                t2 = time.perf_counter_ns()
+                self.persisted += len(events)
+                self.batches += 1
+                if self.stats is not None:
+                    self.stats.record("db_flush", t2 - t1, ALL_FUNCTIONS)
+                if self.commit_policy.record(len(events)):
+                    self._commit_session()
+            except Exception:
+                logger.exception(f"Capture writer failed to persist {len(events)} events")
+                self._rollback()
+
+    def _commit(self):
+        """Commit the events written but not committed yet"""
+        if self.commit_policy.pending == 0:
+            return
+        with self.lock:
+            try:
+                self._commit_session()
+            except Exception:
+                logger.exception("Capture writer failed to commit")
+                self._rollback()
+
+    def _rollback(self):
+        """Roll back the session, discarding every event not committed yet (caller holds the lock)"""
+        self.session.rollback()
+        self.commit_policy.discarded()
+        self.store.clear_cache()
+        if self.on_rollback is not None:
+            self.on_rollback()
+
+    def _commit_session(self):
+        t1 = time.perf_counter_ns()
+        self.session.commit()
+        if self.stats is not None:
+            self.stats.record("db_commit", time.perf_counter_ns() - t1, ALL_FUNCTIONS)
+        self.commit_policy.committed()
+
+    def _write_events(self, events: list):
+        self.store.write(build_batch(events))
+
+
+def build_batch(events: list) -> CaptureBatch:
+    """Group a list of (objects, record) events into the rows of a CaptureBatch"""
+    objects: list[PreparedObject] = []
+    code_definitions = []
+    calls: dict[int, dict[str, Any]] = {}
+    snapshots: dict[int, dict[str, Any]] = {}
+    call_ends = []
+    first_snapshots = []
+    next_snapshots = []
+
+    for event_objects, record in events:
+        objects.extend(event_objects)
+
+        if isinstance(record, CallStart):
+            row = record._asdict()
+            row["end_ns"] = None
+            row["return_ref"] = None
+            row["exception_ref"] = None
+            row["first_snapshot_id"] = None
+            calls[record.id] = row
+        elif isinstance(record, CallEnd):
+            values = {"end_ns": record.end_ns, "return_ref": record.return_ref, "call_metadata": record.call_metadata,
+                      "exception_ref": record.exception_ref}
+            if record.id in calls:
+                calls[record.id].update(values)
+            else:
+                call_ends.append({"id": record.id, **values})
+        elif isinstance(record, Snapshot):
+            row = record._asdict()
+            previous_id = row.pop("previous_snapshot_id")
+            row["next_snapshot_id"] = None
+            snapshots[record.id] = row
+            if previous_id is None:
+                if record.function_call_id in calls:
+                    calls[record.function_call_id]["first_snapshot_id"] = record.id
+                else:
+                    first_snapshots.append({"id": record.function_call_id, "first_snapshot_id": record.id})
+            elif previous_id in snapshots:
+                snapshots[previous_id]["next_snapshot_id"] = record.id
+            else:
+                next_snapshots.append({"id": previous_id, "next_snapshot_id": record.id})
+        elif isinstance(record, CodeDefinitionRecord):
+            code_definitions.append(record._asdict())
+
+    return CaptureBatch(
+        objects=objects,
+        code_definitions=code_definitions,
+        calls=list(calls.values()),
+        snapshots=list(snapshots.values()),
+        call_ends=call_ends,
+        first_snapshots=first_snapshots,
+        next_snapshots=next_snapshots,
+    )
@@ -35,6 +35,7 @@ from spacetimepy.core import (
     StoredObject,
     init_db,
 )
+from spacetimepy.core.models import resolve_snapshot_refs
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -317,15 +318,15 @@ async def get_stack_recording(function_id: str):
         # Build a snapshots of function state for all recorded frames
         frames = []
         try:
-            # Process each snapshot
-            for stack_snapshot in snapshots:
+            # Process each snapshot (delta snapshots are applied to their keyframe)
+            for stack_snapshot, (locals_refs, globals_refs) in zip(snapshots, resolve_snapshot_refs(snapshots), strict=True):
                 frame_info = {
                     "id": stack_snapshot.id,
                     "line": stack_snapshot.line_number,
                     "snapshot_id": str(stack_snapshot.id),
                     "timestamp": stack_snapshot.timestamp.isoformat() if stack_snapshot.timestamp else None,
-                    "locals_refs": stack_snapshot.locals_refs,
-                    "globals_refs": stack_snapshot.globals_refs
+                    "locals_refs": locals_refs,
+                    "globals_refs": globals_refs
                 }
                 if (previous_snapshot := stack_snapshot.get_previous_snapshot(session)):
                     frame_info["previous_snapshot_id"] = str(previous_snapshot.id)
@@ -342,16 +343,16 @@ async def get_stack_recording(function_id: str):
                     frame_info["call_metadata"] = function_call.call_metadata
 
                 # Process locals from the snapshot's locals_refs
-                if stack_snapshot.locals_refs:
+                if locals_refs:
                     frame_info["locals"] = {}
-                    for name, value in stack_snapshot.locals_refs.items():
+                    for name, value in locals_refs.items():
                         frame_info["locals"][name] = serialize_stored_value(value)
 
 
                 # Process globals from the snapshot's globals_refs
-                if stack_snapshot.globals_refs:
+                if globals_refs:
                     frame_info["globals"] = {}
-                    for name, value in stack_snapshot.globals_refs.items():
+                    for name, value in globals_refs.items():
                         # Filter out module-level imports and other large objects
                         if not name.startswith("__") and not name.endswith("__"):
                             frame_info["globals"][name] = serialize_stored_value(value)
@@ -406,10 +407,11 @@ async def get_snapshot(snapshot_id: str):
         # Build the response with locals and globals data
         locals_data = {}
         globals_data = {}
+        locals_refs, globals_refs = snapshot.get_full_refs(session)
 
         # Process locals_refs
-        if snapshot.locals_refs:
-            for name, value in snapshot.locals_refs.items():
+        if locals_refs:
+            for name, value in locals_refs.items():
                 try:
                     locals_data[name] = serialize_stored_value(value)
                 except Exception as e:
@@ -417,8 +419,8 @@ async def get_snapshot(snapshot_id: str):
                     locals_data[name] = {"value": f"<error: {str(e)}>", "type": "Error"}
 
         # Process globals_refs
-        if snapshot.globals_refs:
-            for name, value in snapshot.globals_refs.items():
+        if globals_refs:
+            for name, value in globals_refs.items():
                 if not name.startswith("__") and not name.endswith("__"):
                     try:
                         globals_data[name] = serialize_stored_value(value)
@@ -751,6 +753,14 @@ async def get_db_info():
         logger.error(f"Error getting DB info: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/monitor-stats")
+async def get_monitor_stats():
+    """Get the cost of monitoring measured by the monitor running in this process (performance=True)"""
+    monitor = SpaceTimeMonitor.get_instance()
+    if monitor is None:
+        raise HTTPException(status_code=404, detail="No monitor is running in this process")
+    return monitor.stats()
+
 @app.get("/api/function-calls")
 async def get_function_calls(
     search: str = Query(None, description="Search term to filter function calls"),
@@ -786,7 +796,8 @@ async def get_function_calls(
             call_data = fc.to_dict()
 
             # Add additional fields for API
-            call_data["duration"] = (fc.end_time - fc.start_time).total_seconds() if fc.end_time and fc.start_time else None
+            call_data["duration"] = fc.duration
+            call_data["duration_ns"] = fc.duration_ns
             call_data["has_stack_recording"] = session.query(StackSnapshot).filter(StackSnapshot.function_call_id == fc.id).count() > 0
 
             # Add serialized locals
@@ -848,20 +859,18 @@ async def get_function_call(call_id: str):
                 StackSnapshot.function_call_id == call_id
             ).order_by(StackSnapshot.order_in_call.asc()).all()
 
-            for snapshot in stack_snapshots:
+            for snapshot, (locals_refs, globals_refs) in zip(stack_snapshots, resolve_snapshot_refs(stack_snapshots), strict=True):
                 # Process locals from the snapshot's locals_refs
                 locals_data = {}
-                if hasattr(snapshot, 'locals_refs') and snapshot.locals_refs is not None:
-                    for name, value in snapshot.locals_refs.items():
-                        locals_data[name] = serialize_stored_value(value)
+                for name, value in locals_refs.items():
+                    locals_data[name] = serialize_stored_value(value)
 
                 # Process globals from the snapshot's globals_refs
                 globals_data = {}
-                if hasattr(snapshot, 'globals_refs') and snapshot.globals_refs is not None:
-                    for name, value in snapshot.globals_refs.items():
-                        # Filter out module-level imports and other large objects
-                        if not name.startswith("__") and not name.endswith("__"):
-                            globals_data[name] = serialize_stored_value(value)
+                for name, value in globals_refs.items():
+                    # Filter out module-level imports and other large objects
+                    if not name.startswith("__") and not name.endswith("__"):
+                        globals_data[name] = serialize_stored_value(value)
 
                 # Format timestamp if it exists
                 timestamp_str = None
@@ -968,7 +977,8 @@ async def get_session_details(session_id: str):
             call_data = function_call.to_dict()
 
             # Add additional fields for API
-            call_data["duration"] = (function_call.end_time - function_call.start_time).total_seconds() if function_call.end_time and function_call.start_time else None
+            call_data["duration"] = function_call.duration
+            call_data["duration_ns"] = function_call.duration_ns
             call_data["has_stack_recording"] = session.query(StackSnapshot).filter(StackSnapshot.function_call_id == function_call.id).count() > 0
 
             # Add serialized locals
@@ -1301,24 +1311,24 @@ async def get_stack_recording_data(function_id: str):
 
     # Build frames data
     frames = []
-    for stack_snapshot in snapshots:
+    for stack_snapshot, (locals_refs, globals_refs) in zip(snapshots, resolve_snapshot_refs(snapshots), strict=True):
         frame_info = {
             "id": stack_snapshot.id,
             "line": stack_snapshot.line_number,
-            "locals_refs": stack_snapshot.locals_refs,
-            "globals_refs": stack_snapshot.globals_refs,
+            "locals_refs": locals_refs,
+            "globals_refs": globals_refs,
             "timestamp": stack_snapshot.timestamp.isoformat() if stack_snapshot.timestamp else None
         }
 
         # Process locals and globals
-        if stack_snapshot.locals_refs:
+        if locals_refs:
             frame_info["locals"] = {}
-            for name, value in stack_snapshot.locals_refs.items():
+            for name, value in locals_refs.items():
                 frame_info["locals"][name] = serialize_stored_value(value)
 
-        if stack_snapshot.globals_refs:
+        if globals_refs:
             frame_info["globals"] = {}
-            for name, value in stack_snapshot.globals_refs.items():
+            for name, value in globals_refs.items():
                 if not name.startswith("__") and not name.endswith("__"):
                     frame_info["globals"][name] = serialize_stored_value(value)
 
@@ -0,0 +1,107 @@
+import collections
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from spacetimepy.core.change_detection import ChangeDetector
+from spacetimepy.core.models import Base
+from spacetimepy.core.representation import ObjectManager
+
+
+class Plain:
+    def __init__(self):
+        self.items = [1, 2]
+        self.name = "plain"
+
+
+class Custom:
+    def __reduce__(self):
+        return (Custom, ())
+
+
+class Items(list):
+    pass
+
+
+class TestFingerprint(unittest.TestCase):
+    def setUp(self):
+        self.detector = ChangeDetector()
+
+    def test_supported_values(self):
+        fingerprint = self.detector.fingerprint
+        self.assertIsNotNone(fingerprint([1, "a", None, (2.0, b"x")]))
+        self.assertIsNotNone(fingerprint({"a": {1, 2}, "b": collections.deque([Plain()])}))
+
+    def test_unsupported_values(self):
+        shared = [1]
+        for value in (Custom(), Items([1]), [shared, shared], collections.OrderedDict(), list(range(20_000))):
+            self.assertIsNone(self.detector.fingerprint(value), value)
+
+    def test_equal_elements_of_other_types(self):
+        for old, new in ((1, True), (1, 1.0), (0.0, -0.0), ("a", b"a")):
+            value = [old]
+            self.detector.remember(value, "ref1", self.detector.check(value)[1])
+            value[0] = new
+            self.assertIsNone(self.detector.check(value)[0], (old, new))
+
+    def test_check(self):
+        value = {"items": [1, 2], "plain": Plain()}
+        ref, fingerprint = self.detector.check(value)
+        self.assertIsNone(ref)
+        self.detector.remember(value, "ref1", fingerprint)
+        self.assertEqual(self.detector.check(value)[0], "ref1")
+        self.assertIsNone(self.detector.check(dict(value))[0])  # Another object
+
+        value["plain"].items.append(3)
+        self.assertIsNone(self.detector.check(value)[0])
+        value["plain"].items.pop()
+        self.assertEqual(self.detector.check(value)[0], "ref1")
+        value["plain"].name = "".join(["pla", "in"])  # Equal but not the same string: compared by identity
+        self.assertIsNone(self.detector.check(value)[0])
+
+
+class TestUnchangedValues(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine, expire_on_commit=False)()
+        self.manager = ObjectManager(self.session)
+        self.manager.changes = ChangeDetector(dispatch_table=self.manager.pickle_config.dispatch_table)
+        self.pickles = []
+        dumps = self.manager.pickle_config.dumps
+        self.manager.pickle_config.dumps = lambda *args: self.pickles.append(args) or dumps(*args)
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_unchanged_values_are_not_pickled(self):
+        value = [1, {"a": Plain()}]
+        ref = self.manager.store(value)
+        self.assertEqual(self.manager.store(value), ref)
+        self.assertEqual(self.manager.prepare(value, {ref}), (ref, None))
+        self.assertEqual(len(self.pickles), 1)
+
+        value[1]["a"].name = "changed"
+        new_ref = self.manager.store(value)
+        self.assertNotEqual(new_ref, ref)
+        self.assertEqual(self.manager.rehydrate(new_ref)[1]["a"].name, "changed")
+        self.assertEqual(self.manager.get_history(new_ref), [ref, new_ref])
+
+    def test_strict(self):
+        self.assertIsNone(ObjectManager(self.session).changes)  # Off by default
+        self.manager.changes = None
+        value = [1, 2]
+        ref = self.manager.store(value)
+        self.assertEqual(self.manager.store(value), ref)
+        self.assertEqual(len(self.pickles), 2)
+
+    def test_prepare_without_known_refs(self):
+        value = [1, 2]
+        self.manager.prepare(value)
+        self.manager.prepare(value)
+        self.assertEqual((self.manager.changes.hits, self.manager.changes.misses), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from spacetimepy.core.checkpoint import CheckpointPolicy
+from spacetimepy.core.models import FunctionCall, StackSnapshot
+from spacetimepy.core.monitoring import SpaceTimeMonitor, pymonitor
+
+
+@pymonitor(mode="line")
+def checkpointed(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+# Kept alive across runs: its address, and so its identity hash, is the same in every run
+APPENDED = []
+
+
+@pymonitor(mode="line")
+def append_twice(values):
+    values.append(len(values))
+    values.append(len(values))
+    return len(values)
+
+
+class TestCheckpointPolicy(unittest.TestCase):
+    def test_from_option(self):
+        self.assertIsNone(CheckpointPolicy.from_option(None))
+        self.assertIsNone(CheckpointPolicy.from_option(False))
+        self.assertEqual(CheckpointPolicy.from_option(True).interval, 5.0)
+        self.assertEqual(CheckpointPolicy.from_option(0.5).interval, 0.5)
+        self.assertEqual(CheckpointPolicy.from_option({"interval": None, "max_events": 10}).max_events, 10)
+        with self.assertRaises(ValueError):
+            CheckpointPolicy(interval=None)
+        with self.assertRaises(ValueError):
+            CheckpointPolicy.from_option("often")
+        with self.assertRaises(ValueError):
+            SpaceTimeMonitor("monitoring.db", in_memory=False, checkpoint=True)
+
+    def test_is_due(self):
+        policy = CheckpointPolicy(interval=1.0, max_events=100)
+        self.assertFalse(policy.is_due(0.5, 10))
+        self.assertTrue(policy.is_due(1.5, 10))
+        self.assertTrue(policy.is_due(0.5, 100))
+
+
+class TestCheckpointing(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "monitoring.db")
+        # Only explicit checkpoints during the test
+        self.monitor = SpaceTimeMonitor(self.db_path, checkpoint={"interval": 3600, "evict_snapshots": True})
+
+    def tearDown(self):
+        self.monitor.shutdown()
+        SpaceTimeMonitor._instance = None
+        self.tmp_dir.cleanup()
+
+    def _disk_count(self, table):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_incremental_checkpoints(self):
+        self.monitor.start_session("checkpoints")
+        checkpointed(3)
+        counts = self.monitor.checkpoint()
+        self.assertEqual(counts["function_calls"], 1)
+        self.assertEqual(self._disk_count("function_calls"), 1)
+        snapshots = self._disk_count("stack_snapshots")
+        self.assertGreater(snapshots, 0)
+
+        # The snapshots of the ended call only remain on disk
+        self.assertEqual(counts["evicted"], snapshots)
+        self.assertEqual(self.monitor.session.query(StackSnapshot).count(), 0)
+
+        # Only the new rows are copied by the next checkpoint
+        checkpointed(2)
+        counts = self.monitor.checkpoint()
+        self.assertEqual(counts["function_calls"], 1)
+        self.assertEqual(self._disk_count("function_calls"), 2)
+        self.assertGreater(self._disk_count("stack_snapshots"), snapshots)
+
+        # The session ended after it was checkpointed: the final checkpoint updates it
+        self.monitor.end_session()
+        self.monitor.shutdown()
+        conn = sqlite3.connect(self.db_path)
+        end_time = conn.execute("SELECT end_time FROM monitoring_sessions").fetchone()[0]
+        conn.close()
+        self.assertIsNotNone(end_time)
+        self.assertEqual(self.monitor.commit_stats()["checkpoints"], 3)
+
+
+class TestAppendMode(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "monitoring.db")
+
+    def tearDown(self):
+        SpaceTimeMonitor._instance = None
+        self.tmp_dir.cleanup()
+
+    def _run(self, name, call=lambda: checkpointed(3), **options):
+        monitor = SpaceTimeMonitor(self.db_path, **options)
+        try:
+            monitor.start_session(name)
+            call()
+            monitor.end_session()
+            in_memory_calls = monitor.session.query(FunctionCall).count()
+        finally:
+            monitor.shutdown()
+            SpaceTimeMonitor._instance = None
+        return in_memory_calls
+
+    def test_append_runs(self):
+        self.assertEqual(self._run("first"), 1)
+        # The second run does not load the first one, its rows are merged at export
+        self.assertEqual(self._run("second", append=True), 1)
+        self.assertEqual(self._run("third", append=True), 1)
+
+        conn = sqlite3.connect(self.db_path)
+        try:
+            self.assertEqual([row[0] for row in conn.execute("SELECT name FROM monitoring_sessions ORDER BY id")],
+                             ["first", "second", "third"])
+            self.assertEqual(conn.execute("SELECT COUNT(DISTINCT session_id) FROM function_calls").fetchone()[0], 3)
+            # Snapshots of every run link to their own call
+            self.assertEqual(conn.execute(
+                "SELECT COUNT(DISTINCT function_call_id) FROM stack_snapshots "
+                "WHERE function_call_id IN (SELECT id FROM function_calls)").fetchone()[0], 3)
+            # Objects reference identities of the file
+            self.assertEqual(conn.execute(
+                "SELECT COUNT(*) FROM stored_objects WHERE identity_id NOT IN (SELECT id FROM object_identities)"
+            ).fetchone()[0], 0)
+            self.assertEqual(conn.execute(
+                "SELECT COUNT(*) FROM code_object_links GROUP BY object_id, definition_id HAVING COUNT(*) > 1"
+            ).fetchall(), [])
+        finally:
+            conn.close()
+
+    def test_identities_of_runs_are_distinct(self):
+        for i, name in enumerate(("first", "second", "third")):
+            self._run(name, call=lambda: append_twice(APPENDED), append=i > 0)
+
+        conn = sqlite3.connect(self.db_path)
+        try:
+            # Each run numbers the versions of its own identity of the list
+            self.assertEqual(conn.execute(
+                "SELECT identity_id, version_number FROM stored_objects GROUP BY identity_id, version_number "
+                "HAVING COUNT(*) > 1"
+            ).fetchall(), [])
+            hashes = [row[0] for row in conn.execute(
+                "SELECT identity_hash FROM object_identities WHERE identity_hash LIKE ?", (f"%{id(APPENDED)}",)
+            )]
+            self.assertEqual(len(hashes), 3)
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
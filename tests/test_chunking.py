@@ -0,0 +1,93 @@
+import pickle
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from spacetimepy.core.chunking import ChunkManifest, ChunkPolicy
+from spacetimepy.core.models import Base, ObjectChunk, StoredObject
+from spacetimepy.core.representation import HASH_FUNCTIONS, ObjectManager
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class TestChunkPolicy(unittest.TestCase):
+    def setUp(self):
+        self.policy = ChunkPolicy(items=10, size_bytes=16)
+
+    def split(self, value):
+        return self.policy.split(value, pickle.dumps, HASH_FUNCTIONS["md5"])
+
+    def test_from_option(self):
+        self.assertIsNone(ChunkPolicy.from_option(None))
+        self.assertIsNone(ChunkPolicy.from_option(False))
+        self.assertEqual(ChunkPolicy.from_option(True).items, 1024)
+        self.assertEqual(ChunkPolicy.from_option(100).items, 100)
+        self.assertEqual(ChunkPolicy.from_option({"size_bytes": 10}).size_bytes, 10)
+        with self.assertRaises(ValueError):
+            ChunkPolicy.from_option("large")
+        with self.assertRaises(ValueError):
+            ChunkPolicy(items=0)
+
+    def test_small_values_are_not_chunked(self):
+        for value in (list(range(10)), dict.fromkeys(range(10)), bytes(16), (1,) * 100, "x" * 100):
+            self.assertIsNone(self.split(value), value)
+
+    def test_versions_share_chunks(self):
+        value = list(range(95))
+        manifest, payloads = self.split(value)
+        self.assertEqual((manifest.kind, manifest.length, len(manifest.chunks)), ("list", 95, 10))
+        value[42] = "changed"
+        changed, _ = self.split(value)
+        self.assertEqual([a != b for a, b in zip(manifest.chunks, changed.chunks)], [i == 4 for i in range(10)])
+        self.assertEqual(changed.assemble([pickle.dumps(value[i:i + 10]) for i in range(0, 95, 10)], pickle.loads), value)
+
+    def test_round_trip(self):
+        values = [{f"key{i}": [i] for i in range(25)}, bytes(range(40)), bytearray(40), [0] * 30]
+        if numpy is not None:
+            values.append(numpy.arange(12, dtype="<f8").reshape(3, 4))
+        for value in values:
+            manifest, payloads = self.split(value)
+            self.assertEqual(len(set(manifest.chunks)), len(payloads))
+            rebuilt = manifest.assemble([payloads[ref] for ref in manifest.chunks], pickle.loads)
+            self.assertEqual(type(rebuilt), type(value))
+            self.assertEqual(repr(rebuilt), repr(value))
+        with self.assertRaises(ValueError):
+            ChunkManifest("set", [], 0).assemble([], pickle.loads)
+
+
+class TestChunkedStorage(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine, expire_on_commit=False)()
+        self.manager = ObjectManager(self.session)
+        self.manager.chunking = ChunkPolicy(items=100)
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_new_versions_store_changed_chunks(self):
+        value = [{"id": i} for i in range(1000)]
+        first = self.manager.store(value)
+        value[500]["id"] = -1
+        second = self.manager.store(value)
+        self.assertEqual(self.session.query(ObjectChunk).count(), 11)
+        self.assertLess(len(self.session.get(StoredObject, second).pickle_data), 1000)
+        self.assertEqual(self.manager.get_history(second), [first, second])
+        self.assertEqual(self.manager.rehydrate(second), value)
+        self.assertEqual(self.manager.rehydrate(first)[500], {"id": 500})
+        self.assertEqual(self.manager.get(second)[1], "list")
+
+    def test_missing_chunks(self):
+        ref = self.manager.store(dict.fromkeys(range(500)))
+        self.session.query(ObjectChunk).delete()
+        with self.assertRaises(ValueError):
+            self.manager.rehydrate(ref)
+
+
+if __name__ == '__main__':
+    unittest.main()
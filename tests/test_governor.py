@@ -0,0 +1,115 @@
+import os
+import tempfile
+import unittest
+
+from spacetimepy.core.capture_plan import CapturePlan
+from spacetimepy.core.governor import OverheadGovernor
+from spacetimepy.core.models import FunctionCall, MonitoringSession
+from spacetimepy.core.monitoring import SpaceTimeMonitor, pymonitor
+
+
+def hot(n):
+    return n + 1
+
+
+def cold(n):
+    return n - 1
+
+
+@pymonitor(mode="line")
+def governed(n):
+    a = n + 1
+    b = a * 2
+    return b
+
+
+class TestOverheadGovernor(unittest.TestCase):
+    def setUp(self):
+        self.governor = OverheadGovernor(budget=0.1, window=1.0)
+        self.hot = CapturePlan(hot.__code__, func=hot, mode="line")
+        self.cold = CapturePlan(cold.__code__, func=cold, mode="function")
+
+    def test_from_option(self):
+        self.assertIsNone(OverheadGovernor.from_option(None))
+        self.assertIsNone(OverheadGovernor.from_option(False))
+        self.assertEqual(OverheadGovernor.from_option(True).budget, 0.05)
+        self.assertEqual(OverheadGovernor.from_option(0.2).budget, 0.2)
+        self.assertEqual(OverheadGovernor.from_option({"window": 2.0}).window, 2.0)
+        self.assertIs(OverheadGovernor.from_option(self.governor), self.governor)
+        with self.assertRaises(ValueError):
+            OverheadGovernor(budget=1.5)
+
+    def test_within_budget(self):
+        self.assertEqual(self.governor.record(self.hot, 0.01, 0.5), [])
+        self.assertEqual(self.governor.record(self.hot, 0.01, 1.5), [])
+        self.assertAlmostEqual(self.governor.overhead, 0.02 / 1.01)
+        self.assertEqual(self.governor.degraded, {})
+
+    def test_downgrade_and_restore(self):
+        # 11% of the first window is spent in callbacks, mostly for hot
+        self.governor.record(self.cold, 0.05, 0.05)
+        self.assertEqual(self.governor.record(self.hot, 0.06, 1.0), [(self.hot.key, "line", "function")])
+        self.assertEqual(self.governor.degraded, {self.hot.key: "function"})
+
+        # Still over budget: hot is downgraded again
+        self.governor.record(self.cold, 0.05, 1.5)
+        self.assertEqual(self.governor.record(self.hot, 0.06, 2.0), [(self.hot.key, "function", "sampled")])
+
+        # Load drops: the downgrades are undone, last first
+        self.assertEqual(self.governor.record(self.hot, 0.01, 3.0), [(self.hot.key, "sampled", "function")])
+        self.assertEqual(self.governor.record(self.hot, 0.01, 4.0), [(self.hot.key, "function", "line")])
+        self.assertEqual(self.governor.record(self.hot, 0.01, 5.0), [])
+        self.assertEqual(self.governor.degraded, {})
+
+    def test_restore_waits_for_room(self):
+        self.governor.record(self.hot, 0.06, 0.06)
+        self.governor.record(self.cold, 0.05, 1.0)
+        # 3% + the 6% saved by the downgrade is over 80% of the budget
+        self.assertEqual(self.governor.record(self.hot, 0.03, 2.0), [])
+        self.assertEqual(self.governor.degraded, {self.hot.key: "function"})
+
+    def test_off_is_the_last_level(self):
+        now = 0.0
+        levels = []
+        for _ in range(5):
+            now += 1.0
+            levels += [new for _, _, new in self.governor.record(self.hot, 0.5, now)]
+        self.assertEqual(levels, ["function", "sampled", "off"])
+
+
+class TestMonitorGovernor(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        # Every callback ends a window and is well over budget
+        self.governor = OverheadGovernor(budget=0.01, window=1e-9)
+        self.monitor = SpaceTimeMonitor(os.path.join(self.tmp_dir.name, "monitoring.db"), governor=self.governor)
+
+    def tearDown(self):
+        self.monitor.shutdown()
+        SpaceTimeMonitor._instance = None
+        # Restore the configured plan of the decorated function
+        for plan in self.monitor._governed_plans.values():
+            SpaceTimeMonitor.register_plan(plan)
+        self.tmp_dir.cleanup()
+
+    def test_downgrades_are_recorded(self):
+        self.monitor.start_session("governed")
+        for n in range(10):
+            governed(n)
+        self.monitor.end_session()
+
+        self.assertEqual(self.governor.levels[SpaceTimeMonitor._capture_plans[governed.__code__].key], "off")
+        session = self.monitor.session.query(MonitoringSession).one()
+        changes = session.session_metadata["governor"]["changes"]
+        self.assertEqual([(c["function"], c["from"], c["to"]) for c in changes], [
+            ("governed", "line", "function"), ("governed", "function", "sampled"), ("governed", "sampled", "off"),
+        ])
+
+        # Calls are still balanced: the first one was recorded in full, none after "off"
+        calls = self.monitor.session.query(FunctionCall).order_by(FunctionCall.id).all()
+        self.assertGreaterEqual(len(calls), 1)
+        self.assertTrue(all(call.end_time is not None for call in calls))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,658 @@
+import asyncio
+import collections
+import datetime
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from spacetimepy.core.function_call import FunctionCallRepository
+from spacetimepy.core.models import (
+    FunctionCall,
+    MonitoringSession,
+    StackSnapshot,
+    init_db,
+    ns_to_datetime,
+)
+from spacetimepy.core.monitoring import SpaceTimeMonitor, pymonitor
+from spacetimepy.core.reanimation import load_snapshot
+
+
+@pymonitor(mode="line")
+def accumulate(n):
+    total = []
+    for i in range(n):
+        total.append(i)
+    return total
+
+
+@pymonitor(mode="function")
+def outer(n):
+    return accumulate(n)
+
+
+def helper(x):
+    return x * 2
+
+
+@pymonitor(mode="function", track=[helper])
+def tracking(x):
+    return helper(x)
+
+
+def _tag_a(monitor, code, offset):
+    return {"hook": "a"}
+
+
+def _tag_b(monitor, code, offset):
+    return {"hook": "b"}
+
+
+class First:
+    @pymonitor(mode="function", ignore=["secret"], start_hooks=[_tag_a])
+    def run(self, secret, visible):
+        return visible
+
+
+class Second:
+    @pymonitor(mode="function", start_hooks=[_tag_b])
+    def run(self, secret, visible):
+        return visible
+
+
+@pymonitor(mode="line", use_tag_line=True)
+def tagged(n):
+    a = n + 1  #tag
+    b = a * 2
+    return b
+
+
+@pymonitor(mode="line", lines=[])
+def filtered(n):
+    a = n + 1
+    b = a * 2
+    return b
+
+
+@pymonitor(mode="line")
+def mutate(n):
+    items = [n]
+    alias = items
+    size = n + 1
+    alias.append(size)
+    return items
+
+
+@pymonitor(mode="line")
+def count_missing(key):
+    counts = collections.defaultdict(int)
+    seen = counts[key]
+    return counts, seen
+
+
+@pymonitor(mode="line", sample=2)
+def sampled(n):
+    a = n + 1
+    return a
+
+
+@pymonitor(mode="function")
+def sampling_parent(n):
+    return sampled(n)
+
+
+SCALE = 3
+OFFSET = 1
+
+
+def scale(x):
+    return x * SCALE
+
+
+@pymonitor(mode="function")
+def scaled(x):
+    return scale(x)
+
+
+@pymonitor(mode="line")
+def threaded_child(n):
+    total = n * 2
+    return total
+
+
+@pymonitor(mode="function")
+def threaded_parent(barrier, n):
+    barrier.wait()  # Every parent is on its thread's stack before the children start
+    return threaded_child(n)
+
+
+@pymonitor(mode="function", sample=3)
+def stress_leaf(i):
+    return i
+
+
+@pymonitor(mode="line")
+def stress_child(values, i):
+    values.append(stress_leaf(i))
+    return list(values)
+
+
+@pymonitor(mode="function")
+def stress_parent(barrier, rounds):
+    barrier.wait()
+    values = []
+    for i in range(rounds):
+        stress_child(values, i)
+    return values
+
+
+@pymonitor(mode="line")
+def countdown(n):
+    while n > 0:
+        yield n
+        n -= 1
+
+
+@pymonitor(mode="function")
+def consume(n):
+    return list(countdown(n))
+
+
+@pymonitor(mode="function")
+def failing(n):
+    raise ValueError(n)
+
+
+@pymonitor(mode="function")
+async def fetch(n):
+    await asyncio.sleep(0)
+    return n * 2
+
+
+@pymonitor(mode="function")
+async def fetch_twice(n):
+    first = await fetch(n)
+    return first + await fetch(n)
+
+
+async def fetch_concurrently():
+    return await asyncio.gather(asyncio.create_task(fetch_twice(1), name="first"),
+                                asyncio.create_task(fetch_twice(2), name="second"))
+
+
+class Rect:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+PIPES = [Rect(10, 0), Rect(20, 0)]
+
+
+@pymonitor(mode="line", watch=["bird.y", "PIPES[-1].x", "missing.x"])
+def watched(bird, dy):
+    bird.y += dy
+    others = [bird] * 100  # A large local, not watched
+    return others[-1].y
+
+
+class MonitorTestCase(unittest.TestCase):
+    monitor_options = {}
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "monitoring.db")
+        self.monitor = SpaceTimeMonitor(self.db_path, **self.monitor_options)
+
+    def tearDown(self):
+        self.monitor.shutdown()
+        SpaceTimeMonitor._instance = None
+        self.tmp_dir.cleanup()
+
+    def _snapshot_chain(self, call):
+        chain = []
+        snapshot_id = call.first_snapshot_id
+        while snapshot_id is not None:
+            snapshot = self.monitor.session.get(StackSnapshot, snapshot_id)
+            chain.append(snapshot)
+            snapshot_id = snapshot.next_snapshot_id
+        return chain
+
+    def _check_calls(self):
+        self.assertTrue(self.monitor.flush())
+        session = self.monitor.session
+        calls = session.query(FunctionCall).order_by(FunctionCall.id).all()
+        self.assertEqual([call.function for call in calls], ["outer", "accumulate"])
+        outer_call, inner_call = calls
+        self.assertEqual(inner_call.parent_call_id, outer_call.id)
+        self.assertEqual(self.monitor.object_manager.rehydrate(inner_call.return_ref), [0, 1, 2])
+
+        # The snapshot chain covers every snapshot of the call, in order
+        chain = self._snapshot_chain(inner_call)
+        snapshots = session.query(StackSnapshot).filter(StackSnapshot.function_call_id == inner_call.id).all()
+        self.assertEqual(len(chain), len(snapshots))
+        self.assertEqual([snapshot.order_in_call for snapshot in chain], list(range(len(chain))))
+        self.assertTrue(all(snapshot.timestamp <= inner_call.end_time for snapshot in chain))
+
+        # Nanosecond timestamps from the monotonic clock nest exactly
+        self.assertTrue(outer_call.start_ns <= inner_call.start_ns <= inner_call.end_ns <= outer_call.end_ns)
+        self.assertTrue(all(inner_call.start_ns <= s.timestamp_ns <= inner_call.end_ns for s in chain))
+        self.assertEqual(inner_call.duration_ns, inner_call.end_ns - inner_call.start_ns)
+
+
+class TestMonitorCapture(MonitorTestCase):
+    def test_capture(self):
+        outer(3)
+        self._check_calls()
+
+    def test_ids_continue_after_existing_rows(self):
+        outer(3)
+        self.monitor.flush()
+        last_id = self.monitor.session.query(FunctionCall.id).order_by(FunctionCall.id.desc()).first()[0]
+        outer(2)
+        self.monitor.flush()
+        ids = [row[0] for row in self.monitor.session.query(FunctionCall.id).order_by(FunctionCall.id)]
+        self.assertEqual(ids, list(range(1, last_id + 3)))
+
+    def test_tracked_function(self):
+        helper(1)  # Not recorded outside of its tracking function
+        tracking(2)
+        self.monitor.flush()
+        calls = self.monitor.session.query(FunctionCall).order_by(FunctionCall.id).all()
+        self.assertEqual([call.function for call in calls], ["tracking", "helper"])
+        self.assertEqual(calls[1].parent_call_id, calls[0].id)
+
+    def test_same_name_functions(self):
+        First().run("a", 1)
+        Second().run("b", 2)
+        self.monitor.flush()
+        first, second = self.monitor.session.query(FunctionCall).order_by(FunctionCall.id).all()
+        self.assertEqual(first.call_metadata, {"hook": "a"})
+        self.assertNotIn("secret", first.locals_refs)
+        self.assertEqual(second.call_metadata, {"hook": "b"})
+        self.assertIn("secret", second.locals_refs)
+
+    def test_tagged_lines(self):
+        tagged(1)
+        self.monitor.flush()
+        call = self.monitor.session.query(FunctionCall).one()
+        snapshots = self.monitor.session.query(StackSnapshot).filter(StackSnapshot.function_call_id == call.id).all()
+        self.assertEqual([snapshot.line_number for snapshot in snapshots], [tagged.__code__.co_firstlineno + 2])
+
+    def test_line_filter_change(self):
+        def snapshot_lines():
+            self.monitor.flush()
+            call = self.monitor.session.query(FunctionCall).order_by(FunctionCall.id.desc()).first()
+            return [s.line_number for s in self.monitor.session.query(StackSnapshot).filter(
+                StackSnapshot.function_call_id == call.id).order_by(StackSnapshot.order_in_call)]
+
+        first_line = filtered.__code__.co_firstlineno
+        filtered(1)  # Every line is pruned
+        filtered(1)
+        self.assertEqual(snapshot_lines(), [])
+
+        # Pruned lines are reported again once the filter changes
+        SpaceTimeMonitor.set_line_filter(filtered, lines=[first_line + 3])
+        filtered(1)
+        self.assertEqual(snapshot_lines(), [first_line + 3])
+        SpaceTimeMonitor.set_line_filter(filtered, lines=None)
+        filtered(1)
+        self.assertEqual(snapshot_lines(), [first_line + 2, first_line + 3, first_line + 4])
+        SpaceTimeMonitor.set_line_filter(filtered, lines=[])
+
+    def test_used_globals_closure(self):
+        global SCALE, scale
+        code = scaled.__code__
+        self.assertEqual(self.monitor.get_used_globals(code, globals()), {"SCALE": 3})
+
+        # The closure is cached, values are read again on every event
+        closure = self.monitor._globals_result_cache[(code, id(globals()))]
+        SCALE = 4
+        try:
+            self.assertEqual(self.monitor.get_used_globals(code, globals()), {"SCALE": 4})
+        finally:
+            SCALE = 3
+        self.assertIs(self.monitor._globals_result_cache[(code, id(globals()))], closure)
+
+        # Rebinding a called function rebuilds the closure
+        original = scale
+        scale = lambda x: x + OFFSET  # noqa: E731
+        try:
+            self.assertEqual(self.monitor.get_used_globals(code, globals()), {"OFFSET": 1})
+            self.assertIsNot(self.monitor._globals_result_cache[(code, id(globals()))], closure)
+        finally:
+            scale = original
+        self.assertEqual(self.monitor.get_used_globals(code, globals()), {"SCALE": 3})
+
+        scaled(2)
+        self.monitor.flush()
+        call = self.monitor.session.query(FunctionCall).one()
+        self.assertEqual(list(call.globals_refs), ["SCALE"])
+
+
+class TestMonitorRefReuse(MonitorTestCase):
+    monitor_options = {"performance": True}
+
+    def test_unchanged_values_reuse_refs(self):
+        mutate(1)
+        self.monitor.flush()
+        call = self.monitor.session.query(FunctionCall).one()
+        states = [{name: self.monitor.object_manager.rehydrate(ref) for name, ref in snapshot.locals_refs.items()}
+                  for snapshot in self._snapshot_chain(call)]
+        self.assertEqual(states, [
+            {"n": 1},
+            {"n": 1, "items": [1]},
+            {"n": 1, "items": [1], "alias": [1]},
+            {"n": 1, "items": [1], "alias": [1], "size": 2},
+            # The list was mutated through its alias
+            {"n": 1, "items": [1, 2], "alias": [1, 2], "size": 2},
+        ])
+        self.assertEqual(self.monitor.performance_data["line_reused_refs"], 1 + 2 + 3 + 2)
+
+    def test_item_reads_are_not_pure(self):
+        count_missing("a")
+        self.monitor.flush()
+        call = self.monitor.session.query(FunctionCall).one()
+        counts = [self.monitor.object_manager.rehydrate(snapshot.locals_refs["counts"])
+                  for snapshot in self._snapshot_chain(call) if "counts" in snapshot.locals_refs]
+        # Reading a missing key of a defaultdict inserts it
+        self.assertEqual(counts, [{}, {"a": 0}])
+
+
+class TestMonitorSampling(MonitorTestCase):
+    def test_sampled_calls(self):
+        self.monitor.start_session("sampling")
+        for n in range(4):
+            sampled(n)
+        self.assertIn(sampled.__code__, SpaceTimeMonitor._suspended_line_codes)
+        sampling_parent(4)  # Fifth call, recorded: line events are back
+        self.assertNotIn(sampled.__code__, SpaceTimeMonitor._suspended_line_codes)
+        sampling_parent(5)
+        self.monitor.end_session()
+
+        calls = self.monitor.session.query(FunctionCall).order_by(FunctionCall.id).all()
+        self.assertEqual([call.function for call in calls], ["sampled", "sampled", "sampling_parent", "sampled", "sampling_parent"])
+        self.assertEqual([self.monitor.object_manager.rehydrate(call.locals_refs["n"]) for call in calls], [0, 2, 4, 4, 5])
+        self.assertEqual(calls[3].parent_call_id, calls[2].id)
+        for call in calls:
+            snapshots = self.monitor.session.query(StackSnapshot).filter(StackSnapshot.function_call_id == call.id).count()
+            self.assertEqual(snapshots, 2 if call.function == "sampled" else 0)
+
+        session = self.monitor.session.query(MonitoringSession).one()
+        self.assertEqual(session.session_metadata["sampling"]["sampled"], {"every": 2, "calls": 6, "recorded": 3})
+
+
+class TestMonitorWatch(MonitorTestCase):
+    def test_invalid_paths(self):
+        for path in ("a.b()", "a[i]", "a[1:2]", "a +"):
+            with self.assertRaises(ValueError):
+                pymonitor(mode="line", watch=[path])
+
+    def test_watched_paths(self):
+        watched(Rect(0, 5), 2)
+        self.monitor.flush()
+        call = self.monitor.session.query(FunctionCall).one()
+        rehydrate = self.monitor.object_manager.rehydrate_dict
+        # Only the watched paths are captured, not the locals (others) they do not name
+        self.assertEqual(rehydrate(call.locals_refs), {"bird.y": 5})
+        self.assertEqual(rehydrate(call.globals_refs), {"PIPES[-1].x": 20})
+        self.assertEqual([rehydrate(snapshot.get_full_refs(self.monitor.session)[0]) for snapshot in self._snapshot_chain(call)],
+                         [{"bird.y": 5}, {"bird.y": 7}, {"bird.y": 7}])
+
+
+class TestMonitorThreads(MonitorTestCase):
+    def test_per_thread_call_stacks(self):
+        self.monitor.start_session("threads")
+        barrier = threading.Barrier(4)
+        threads = [threading.Thread(target=threaded_parent, args=(barrier, n), name=f"worker-{n}") for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.monitor.end_session()
+
+        rehydrate = self.monitor.object_manager.rehydrate
+        calls = self.monitor.session.query(FunctionCall).all()
+        by_id = {call.id: call for call in calls}
+        children = [call for call in calls if call.function == "threaded_child"]
+        self.assertEqual(len(calls), 8)
+        self.assertEqual(sorted(rehydrate(call.locals_refs["n"]) for call in children), [0, 1, 2, 3])
+        for child in children:
+            parent = by_id[child.parent_call_id]
+            self.assertEqual(parent.function, "threaded_parent")
+            self.assertEqual(rehydrate(parent.locals_refs["n"]), rehydrate(child.locals_refs["n"]))
+            self.assertEqual((parent.thread_id, parent.thread_name), (child.thread_id, child.thread_name))
+            self.assertEqual(parent.thread_name, f"worker-{rehydrate(child.locals_refs['n'])}")
+            self.assertEqual(child.order_in_parent, 0)
+            self.assertEqual(rehydrate(child.return_ref), rehydrate(child.locals_refs["n"]) * 2)
+            self.assertEqual(len(self._snapshot_chain(child)), 2)
+        self.assertEqual(sorted(call.order_in_session for call in calls), list(range(8)))
+        self.assertEqual(self.monitor.call_stack, [])
+
+
+class TestMonitorWriterThreads(TestMonitorThreads):
+    monitor_options = {"async_writer": True, "capture_backend": "sqlite"}
+
+
+class TestMonitorConcurrentWriter(MonitorTestCase):
+    monitor_options = {"async_writer": True, "capture_backend": "sqlite", "strict": False}
+
+    def test_concurrent_capture(self):
+        thread_count, rounds = 8, 50
+        self.monitor.start_session("stress")
+        barrier = threading.Barrier(thread_count)
+        threads = [threading.Thread(target=stress_parent, args=(barrier, rounds)) for _ in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.monitor.end_session()
+
+        rehydrate = self.monitor.object_manager.rehydrate
+        calls = self.monitor.session.query(FunctionCall).all()
+        children: dict[int, list[FunctionCall]] = {}
+        for call in calls:
+            if call.function == "stress_child":
+                children.setdefault(call.parent_call_id, []).append(call)
+        self.assertEqual(len(children), thread_count)
+        for siblings in children.values():
+            siblings.sort(key=lambda call: call.order_in_parent)
+            self.assertEqual([call.order_in_parent for call in siblings], list(range(rounds)))
+            for i, child in enumerate(siblings):
+                self.assertEqual(rehydrate(child.locals_refs["i"]), i)
+                self.assertEqual(rehydrate(child.return_ref), list(range(i + 1)))
+                chain = self._snapshot_chain(child)
+                self.assertEqual([snapshot.order_in_call for snapshot in chain], list(range(len(chain))))
+                # Every ref handed to the writer was persisted
+                for snapshot in chain:
+                    for ref in snapshot.locals_refs.values():
+                        rehydrate(ref)
+        self.assertEqual(sorted(call.order_in_session for call in calls), list(range(len(calls))))
+
+        session = self.monitor.session.query(MonitoringSession).one()
+        self.assertEqual(session.session_metadata["sampling"]["stress_leaf"]["calls"], thread_count * rounds)
+
+
+class TestMonitorSuspensions(MonitorTestCase):
+    def _calls(self):
+        self.assertTrue(self.monitor.flush())
+        return self.monitor.session.query(FunctionCall).order_by(FunctionCall.id).all()
+
+    def _check_no_state_left(self):
+        self.assertEqual(self.monitor.call_stack, [])
+        self.assertEqual(self.monitor._suspended_calls, {})
+        self.assertEqual(self.monitor._parent_call_child_counts, {})
+        self.assertEqual(self.monitor._function_snapshot_counts, {})
+
+    def test_generator(self):
+        # Interleaved with the consumer, the generator is only on the stack while it runs
+        self.assertEqual(consume(2), [2, 1])
+        outer(3)
+        consumer, generator, outer_call, inner_call = self._calls()
+        self.assertEqual(generator.parent_call_id, consumer.id)
+        self.assertIsNotNone(generator.end_time)
+        self.assertEqual([s.line_number for s in self._snapshot_chain(generator)][:3],
+                         [countdown.__code__.co_firstlineno + n for n in (2, 3, 4)])
+        self.assertIsNone(outer_call.parent_call_id)
+        self.assertEqual(inner_call.parent_call_id, outer_call.id)
+        self._check_no_state_left()
+
+    def test_abandoned_generator(self):
+        generator = countdown(3)
+        next(generator)
+        del generator  # Closing it throws GeneratorExit into the frame
+        call, = self._calls()
+        self.assertIsNotNone(call.end_time)
+        self.assertIsInstance(self.monitor.object_manager.rehydrate(call.exception_ref), GeneratorExit)
+        self._check_no_state_left()
+
+    def test_exception(self):
+        with self.assertRaises(ValueError):
+            failing(3)
+        outer(3)
+        failed, outer_call, _ = self._calls()
+        self.assertIsNotNone(failed.end_time)
+        self.assertIsNone(failed.return_ref)
+        exception = self.monitor.object_manager.rehydrate(failed.exception_ref)
+        self.assertIsInstance(exception, ValueError)
+        self.assertEqual(exception.args, (3,))
+        # The failed call was popped: it is not the parent of later calls
+        self.assertIsNone(outer_call.parent_call_id)
+        self._check_no_state_left()
+
+    def test_asyncio_tasks(self):
+        self.assertEqual(asyncio.run(fetch_concurrently()), [4, 8])
+        calls = self._calls()
+        by_id = {call.id: call for call in calls}
+        rehydrate = self.monitor.object_manager.rehydrate
+        self.assertEqual(sorted(call.function for call in calls), ["fetch"] * 4 + ["fetch_twice"] * 2)
+        for call in calls:
+            self.assertIsNotNone(call.end_time)
+            if call.function == "fetch_twice":
+                self.assertIsNone(call.parent_call_id)
+                self.assertEqual(call.task_name, {1: "first", 2: "second"}[rehydrate(call.locals_refs["n"])])
+            else:
+                # The tasks ran interleaved, each awaited call is linked to its own task's caller
+                parent = by_id[call.parent_call_id]
+                self.assertEqual(parent.task_name, call.task_name)
+                self.assertEqual(rehydrate(parent.locals_refs["n"]), rehydrate(call.locals_refs["n"]))
+        self._check_no_state_left()
+
+
+class TestMonitorWriterSuspensions(TestMonitorSuspensions):
+    monitor_options = {"async_writer": True, "capture_backend": "sqlite"}
+
+
+class TestMonitorGroupCommit(MonitorTestCase):
+    monitor_options = {"commit_policy": "session"}
+
+    def test_capture(self):
+        outer(3)
+        self.assertEqual(self.monitor.commit_stats()["commits"], 0)
+        self._check_calls()
+        self.assertEqual(self.monitor.commit_stats()["commits"], 1)
+
+
+class TestMonitorWriter(MonitorTestCase):
+    monitor_options = {"async_writer": True}
+
+    def test_capture(self):
+        outer(3)
+        self._check_calls()
+
+
+class TestMonitorSqliteWriter(MonitorTestCase):
+    monitor_options = {"async_writer": True, "capture_backend": "sqlite"}
+
+    def test_capture(self):
+        outer(3)
+        self._check_calls()
+
+
+class TestMonitorDeltaSnapshots(MonitorTestCase):
+    monitor_options = {"snapshot_keyframe_interval": 3}
+
+    def test_capture(self):
+        outer(3)
+        self._check_calls()
+        call = self.monitor.session.query(FunctionCall).filter(FunctionCall.function == "accumulate").one()
+        chain = self._snapshot_chain(call)
+        self.assertEqual([s.is_keyframe for s in chain], [i % 3 == 0 for i in range(len(chain))])
+        # Deltas only hold the changed bindings
+        self.assertTrue(all(len(s.locals_refs) <= 1 for s in chain if not s.is_keyframe))
+
+        # Readers see the full state of every snapshot
+        rehydrate = self.monitor.object_manager.rehydrate
+        traces = FunctionCallRepository(self.monitor.session).get_function_traces(call.id)
+        states = [{name: rehydrate(ref) for name, ref in trace["locals_refs"].items()} for trace in traces]
+        self.assertEqual(states[-1], {"n": 3, "i": 2, "total": [0, 1, 2]})
+        self.assertTrue(all("n" in state and "total" in state for state in states[1:]))
+        for snapshot, state in zip(chain, states, strict=True):
+            self.assertEqual(load_snapshot(snapshot.id, self.monitor.session)["locals"], state)
+
+
+class TestMonitorWriterDeltaSnapshots(TestMonitorDeltaSnapshots):
+    monitor_options = {"snapshot_keyframe_interval": 3, "async_writer": True, "capture_backend": "sqlite"}
+
+
+class TestTimeQueries(unittest.TestCase):
+    def test_order_and_filter_by_datetimes(self):
+        session = init_db(":memory:")()
+        start = datetime.datetime(2024, 5, 1, 12, 30)
+        for call_id, offset in ((1, 2), (2, 0), (3, 1)):
+            call = FunctionCall(id=call_id, function="f", locals_refs={}, globals_refs={})
+            call.start_time = start + datetime.timedelta(seconds=offset)
+            session.add(call)
+        session.commit()
+
+        ordered = session.query(FunctionCall).order_by(FunctionCall.start_time).all()
+        self.assertEqual([call.id for call in ordered], [2, 3, 1])
+        later = session.query(FunctionCall).filter(FunctionCall.start_time > start).order_by(FunctionCall.id)
+        self.assertEqual([call.id for call in later], [1, 3])
+        self.assertEqual(session.query(FunctionCall).filter(FunctionCall.end_time.is_(None)).count(), 3)
+        self.assertEqual(session.get(FunctionCall, 3).start_time, start + datetime.timedelta(seconds=1))
+        session.close()
+
+
+class TestMigration(unittest.TestCase):
+    def test_add_snapshot_keyframe_column(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, "old.db")
+            connection = sqlite3.connect(db_path)
+            connection.execute("CREATE TABLE stack_snapshots (id INTEGER PRIMARY KEY, function_call_id INTEGER NOT NULL, "
+                               "line_number INTEGER NOT NULL, timestamp DATETIME, locals_refs JSON NOT NULL, "
+                               "globals_refs JSON NOT NULL, order_in_call INTEGER, next_snapshot_id INTEGER)")
+            connection.execute("INSERT INTO stack_snapshots VALUES (1, 1, 3, NULL, '{}', '{}', 0, NULL)")
+            connection.commit()
+            connection.close()
+
+            session = init_db(db_path, in_memory=False)()
+            self.assertTrue(session.get(StackSnapshot, 1).is_keyframe)
+            session.close()
+
+    def test_convert_datetime_columns(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, "old.db")
+            connection = sqlite3.connect(db_path)
+            connection.execute("CREATE TABLE function_calls (id INTEGER PRIMARY KEY, function VARCHAR NOT NULL, "
+                               "start_time DATETIME NOT NULL, end_time DATETIME, locals_refs JSON NOT NULL, "
+                               "globals_refs JSON NOT NULL)")
+            connection.execute("INSERT INTO function_calls VALUES (1, 'f', '2024-05-01 12:30:00.250000', "
+                               "'2024-05-01 12:30:01.500000', '{}', '{}')")
+            connection.commit()
+            connection.close()
+
+            init_db(db_path, in_memory=False)
+            connection = sqlite3.connect(db_path)
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(function_calls)")]
+            start_ns, end_ns = connection.execute("SELECT start_ns, end_ns FROM function_calls").fetchone()
+            connection.close()
+            self.assertNotIn("start_time", columns)
+            self.assertEqual(ns_to_datetime(start_ns), datetime.datetime(2024, 5, 1, 12, 30, 0, 250000))
+            self.assertEqual(ns_to_datetime(end_ns), datetime.datetime(2024, 5, 1, 12, 30, 1, 500000))
+            self.assertEqual(end_ns - start_ns, 1_250_000_000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from spacetimepy.core.models import Base, StoredObject
+from spacetimepy.core.ref_index import BloomFilter, RefIndex
+from spacetimepy.core.representation import ObjectManager
+
+
+class TestRefIndex(unittest.TestCase):
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        refs = [f"ref{i}" for i in range(1000)]
+        for ref in refs:
+            bloom.add(ref)
+        self.assertTrue(all(ref in bloom for ref in refs))
+        false_positives = sum(f"other{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_lru_bounds(self):
+        index = RefIndex(max_refs=2, max_identities=1)
+        index.add("a")
+        index.add("b")
+        self.assertIn("a", index)  # "a" is now the most recent
+        index.add("c")
+        self.assertEqual(("a" in index, "b" in index, "c" in index), (True, False, True))
+        index.set_identity("x", 1, 1)
+        index.set_identity("y", 2, 3)
+        self.assertIsNone(index.identity("x"))
+        self.assertEqual(index.identity("y"), (2, 3))
+
+    def test_from_option(self):
+        self.assertEqual(RefIndex.from_option(None).max_refs, 100_000)
+        self.assertEqual(RefIndex.from_option(10).max_refs, 10)
+        self.assertIsNotNone(RefIndex.from_option({"bloom_capacity": 100}).bloom)
+        with self.assertRaises(ValueError):
+            RefIndex.from_option("large")
+
+
+class TestIndexedStorage(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine, expire_on_commit=False)()
+        self.manager = ObjectManager(self.session)
+        self.manager.index = RefIndex(bloom_capacity=1000)
+        self.statements = []
+        event.listen(engine, "before_cursor_execute",
+                     lambda conn, cursor, statement, *args: self.statements.append(statement.split()[0]))
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_repeated_values_cost_no_query(self):
+        value = [1, 2, 3]
+        ref = self.manager.store(value)
+        self.statements.clear()
+        self.assertEqual(self.manager.store(value), ref)
+        self.assertEqual(self.statements, [])
+
+    def test_new_versions_cost_inserts(self):
+        value = {"a": 1}
+        first = self.manager.store(value)
+        value["b"] = 2
+        self.statements.clear()
+        second = self.manager.store(value)
+        self.assertEqual(set(self.statements), {"INSERT"})
+        self.assertEqual(self.manager.get_history(second), [first, second])
+        self.assertEqual(self.session.get(StoredObject, second).version_number, 2)
+
+    def test_evicted_refs(self):
+        self.manager.index = RefIndex(max_refs=1)
+        value = [1]
+        ref = self.manager.store(value)
+        self.manager.store([2])
+        # Looked up again once evicted, not stored twice
+        self.assertEqual(self.manager.store(value), ref)
+        self.assertEqual(self.session.query(StoredObject).filter(StoredObject.id == ref).count(), 1)
+
+        # After a rollback the index no longer claims rolled back refs are stored
+        self.session.commit()
+        self.manager.store([3])
+        self.session.rollback()
+        self.manager.clear_cache()
+        ref = self.manager.store([3])
+        self.session.commit()
+        self.assertIsNotNone(self.session.get(StoredObject, ref))
+
+
+if __name__ == '__main__':
+    unittest.main()
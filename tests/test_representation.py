@@ -15,7 +15,8 @@ from sqlalchemy.exc import SQLAlchemyError
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from spacetimepy.core.models import Base, init_db, StoredObject, ObjectIdentity
-from spacetimepy.core.representation import ObjectManager, ObjectType, Primitive, List, DictObject, CustomClass
+from spacetimepy.core.representation import (ObjectManager, ObjectType, Primitive, List, DictObject, CustomClass, content_hasher,
+                                          decode_inline_ref)
 
 class TestClass:
     def __init__(self, value):
@@ -212,5 +213,49 @@ class TestObjectManager(unittest.TestCase):
         self.assertIsNone(self.manager.next_ref("non_existent_ref"))
         self.assertEqual(self.manager.get_history("non_existent_ref"), [])
 
+    def test_single_pass_serialization(self):
+        """The pickle hashed for the reference is the one stored"""
+        calls = []
+        dumps = self.manager.pickle_config.dumps
+        self.manager.pickle_config.dumps = lambda *args: calls.append(args) or dumps(*args)
+        ref = self.manager.store(TestClass([1, 2]))
+        self.assertEqual(len(calls), 1)
+        stored = self.session.get(StoredObject, ref)
+        self.assertEqual(content_hasher("md5")(stored.pickle_data), ref)
+
+    def test_hash_functions(self):
+        """References come from the configured hash function"""
+        import hashlib
+        self.manager.hasher = content_hasher("blake2b")
+        ref = self.manager.store({"a": [1, 2]})
+        stored = self.session.get(StoredObject, ref)
+        self.assertEqual(ref, hashlib.blake2b(stored.pickle_data, digest_size=16).hexdigest())
+        self.assertEqual(self.manager.rehydrate(ref), {"a": [1, 2]})
+        with self.assertRaises(ValueError):
+            content_hasher("crc32")
+
+    def test_inline_primitives(self):
+        """Small primitives are refs of their own, without rows, and keep their type"""
+        values = [1, 1.0, True, "1", None, -0.0, "~i:1", 2**100]
+        refs = [self.manager.store(value) for value in values]
+        self.assertEqual(len(set(refs)), len(values))
+        for value, ref in zip(values, refs):
+            rehydrated = self.manager.rehydrate(ref)
+            self.assertEqual((type(rehydrated), repr(rehydrated)), (type(value), repr(value)))
+        self.assertEqual(self.session.query(StoredObject).count(), 0)
+        self.assertEqual(self.manager.get_history(refs[0]), [refs[0]])
+        self.assertIsNone(self.manager.next_ref(refs[0]))
+        with self.assertRaises(ValueError):
+            decode_inline_ref("~x:1")
+
+        # Longer primitives are stored under the hash of their pickle
+        long_ref = self.manager.store("x" * 100)
+        self.manager.inline_limit = 0
+        int_ref, str_ref = self.manager.store(1), self.manager.store("1")
+        self.assertNotEqual(int_ref, str_ref)
+        self.assertEqual(self.session.query(StoredObject).count(), 3)
+        self.assertEqual(self.manager.rehydrate(long_ref), "x" * 100)
+        self.assertEqual(self.manager.rehydrate(str_ref), "1")
+
 if __name__ == '__main__':
     unittest.main(failfast=True) 
\ No newline at end of file
@@ -0,0 +1,42 @@
+import unittest
+
+from spacetimepy.core.sampling import Sampler
+
+
+class TestSampler(unittest.TestCase):
+    def _decisions(self, sampler, calls):
+        return [sampler.should_record() for _ in range(calls)]
+
+    def test_every_nth_call(self):
+        sampler = Sampler.from_option(3)
+        self.assertEqual(self._decisions(sampler, 7), [True, False, False, True, False, False, True])
+        self.assertEqual((sampler.calls, sampler.recorded), (7, 3))
+
+    def test_first_calls_then_every_nth(self):
+        sampler = Sampler(first=2, every=3)
+        self.assertEqual(self._decisions(sampler, 6), [True, True, True, False, False, True])
+
+    def test_probability(self):
+        self.assertFalse(any(self._decisions(Sampler.from_option(0.0), 100)))
+        self.assertTrue(all(self._decisions(Sampler.from_option(1.0), 100)))
+        recorded = sum(self._decisions(Sampler(probability=0.5, seed=1), 1000))
+        self.assertTrue(400 < recorded < 600)
+
+    def test_max_per_second(self):
+        sampler = Sampler.from_option({"max_per_second": 5})
+        self.assertEqual(sum(self._decisions(sampler, 100)), 5)
+
+    def test_describe(self):
+        self.assertEqual(Sampler(every=10, first=3).describe(), {"every": 10, "first": 3})
+
+    def test_invalid_option(self):
+        with self.assertRaises(ValueError):
+            Sampler.from_option("often")
+        with self.assertRaises(ValueError):
+            Sampler(every=0)
+        with self.assertRaises(ValueError):
+            Sampler(probability=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
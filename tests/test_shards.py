@@ -0,0 +1,168 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from spacetimepy.core.models import (
+    FunctionCall,
+    MonitoringSession,
+    ObjectIdentity,
+    ProcessShard,
+    StoredObject,
+    init_db,
+)
+from spacetimepy.core.monitoring import SpaceTimeMonitor, pymonitor
+from spacetimepy.core.representation import ObjectManager
+from spacetimepy.core.shards import find_shards, merge_shards, shard_path
+
+
+@pymonitor(mode="function")
+def shard_worker(n):
+    return [n, n * 3]
+
+
+@pymonitor(mode="function")
+def shard_parent(n):
+    pid = os.fork()
+    if pid == 0:
+        # Child process: capture, make it durable and leave without running the test runner's exit
+        try:
+            shard_worker(n)
+            SpaceTimeMonitor._instance.shutdown()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    return shard_worker(n + 1), pid
+
+
+class TestShardPaths(unittest.TestCase):
+    def test_find_shards(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, "monitoring.db")
+            self.assertEqual(shard_path(db_path, 12), os.path.join(tmp_dir, "monitoring.12.db"))
+            for name in ("monitoring.12.db", "monitoring.3.db", "monitoring.db", "monitoring.x.db", "other.4.db"):
+                open(os.path.join(tmp_dir, name), "w").close()
+            self.assertEqual(find_shards(db_path), [shard_path(db_path, 3), shard_path(db_path, 12)])
+
+
+class TestMergeIdentities(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "monitoring.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _write_shard(self, pid, parent_pid, values):
+        """Store successive versions of the same object in the shard of a process"""
+        session = init_db(shard_path(self.db_path, pid), in_memory=False)()
+        session.add(ProcessShard(pid=pid, parent_pid=parent_pid))
+        manager = ObjectManager(session)
+        for value in values:
+            self.shared[:] = value
+            manager.store(self.shared)
+        session.commit()
+        session.close()
+
+    def _versions(self):
+        session = init_db(self.db_path, in_memory=False)()
+        try:
+            manager = ObjectManager(session)
+            identities = {}
+            for stored in session.query(StoredObject).order_by(StoredObject.version_number):
+                identities.setdefault(stored.identity_id, []).append(manager.rehydrate(stored.id))
+            self.assertEqual(session.query(ObjectIdentity).count(), len(identities))
+            return sorted(identities.values())
+        finally:
+            session.close()
+
+    def test_unrelated_processes_do_not_share_identities(self):
+        # The same address holds different objects in two processes
+        self.shared = []
+        self._write_shard(10, None, [[1], [1, 2]])
+        self._write_shard(11, None, [[3]])
+        self.assertEqual(merge_shards(self.db_path)["objects"], 3)
+        self.assertEqual(self._versions(), [[[1], [1, 2]], [[3]]])
+
+    def test_forked_processes_share_identities(self):
+        self.shared = []
+        self._write_shard(10, None, [[1], [1, 2]])
+        self._write_shard(11, 10, [[1, 2, 3]])
+        merge_shards(self.db_path)
+        self.assertEqual(self._versions(), [[[1], [1, 2], [1, 2, 3]]])
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "requires os.fork")
+class TestForkedShards(unittest.TestCase):
+    monitor_options = {}
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "monitoring.db")
+        self.monitor = SpaceTimeMonitor(self.db_path, shard_by_process=True, **self.monitor_options)
+
+    def tearDown(self):
+        self.monitor.shutdown()
+        SpaceTimeMonitor._instance = None
+        self.tmp_dir.cleanup()
+
+    def test_merge_forked_process(self):
+        self.monitor.start_session("fork")
+        _, child_pid = shard_parent(2)
+        self.monitor.end_session()
+        self.monitor.shutdown()
+
+        self.assertEqual(find_shards(self.db_path), [shard_path(self.db_path, pid) for pid in sorted((os.getpid(), child_pid))])
+        stats = merge_shards(self.db_path)
+        self.assertEqual(stats["shards"], 2)
+        self.assertEqual(stats["calls"], 3)
+        self.assertEqual(stats["sessions"], 1)  # The child's session is folded into the parent's
+
+        session = init_db(self.db_path, in_memory=False)()
+        self.assertEqual([s.name for s in session.query(MonitoringSession).all()], ["fork"])
+        calls = session.query(FunctionCall).order_by(FunctionCall.order_in_session).all()
+        self.assertEqual([(c.function, c.process_id) for c in calls], [
+            ("shard_parent", os.getpid()), ("shard_worker", child_pid), ("shard_worker", os.getpid()),
+        ])
+        root, child_worker, parent_worker = calls
+        self.assertEqual({c.session_id for c in calls}, {root.session_id})
+        self.assertEqual(child_worker.parent_call_id, root.id)
+        self.assertEqual(parent_worker.parent_call_id, root.id)
+        self.assertEqual([child_worker.order_in_parent, parent_worker.order_in_parent], [0, 1])
+        self.assertEqual(len({c.id for c in calls}), 3)
+
+        # Objects are deduplicated across processes and the child's return value is still loadable
+        manager = ObjectManager(session)
+        self.assertEqual(manager.rehydrate(child_worker.return_ref), [2, 6])
+        self.assertEqual(manager.rehydrate(parent_worker.return_ref), [3, 9])
+
+        shards = session.query(ProcessShard).order_by(ProcessShard.id).all()
+        self.assertEqual([(s.pid, s.parent_pid, s.parent_call_id) for s in shards],
+                         [(os.getpid(), None, None), (child_pid, os.getpid(), root.id)])
+        session.close()
+
+
+class TestForkedShardsWriter(TestForkedShards):
+    monitor_options = {"async_writer": True, "capture_backend": "sqlite"}
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "requires os.fork")
+class TestForkWithoutShards(unittest.TestCase):
+    def test_child_does_not_capture(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, "monitoring.db")
+            monitor = SpaceTimeMonitor(db_path)
+            try:
+                shard_parent(1)
+            finally:
+                monitor.shutdown()
+                SpaceTimeMonitor._instance = None
+
+            conn = sqlite3.connect(db_path)
+            functions = [row[0] for row in conn.execute("SELECT function FROM function_calls ORDER BY id")]
+            conn.close()
+            self.assertEqual(functions, ["shard_parent", "shard_worker"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import tempfile
+import unittest
+
+from spacetimepy.core.monitoring import SpaceTimeMonitor, pymonitor
+from spacetimepy.core.stats import ALL_FUNCTIONS, LatencyHistogram, MonitorStats
+
+CONFIG = {"scale": 3}
+
+
+@pymonitor(mode="line")
+def measured(n):
+    items = [i * CONFIG["scale"] for i in range(n)]
+    return items
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_buckets_cover_their_values(self):
+        for value in (0, 1, 15, 16, 17, 31, 32, 33, 1000, 123456789):
+            low, high = LatencyHistogram.bucket_range(LatencyHistogram.bucket_index(value))
+            self.assertLessEqual(low, value)
+            self.assertLessEqual(value, high)
+            # Buckets are narrower than 1/16 of their values
+            self.assertLessEqual(high - low, max(low // LatencyHistogram.SUB_BUCKETS, 0))
+
+    def test_fixed_memory(self):
+        histogram = LatencyHistogram()
+        size = len(histogram.counts)
+        histogram.record(10 ** 15)  # Over the largest bucket
+        self.assertEqual(len(histogram.counts), size)
+        self.assertEqual(histogram.counts[-1], 1)
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for value in range(1, 10001):
+            histogram.record(value * 1000)
+        self.assertEqual(histogram.count, 10000)
+        self.assertEqual(histogram.min, 1000)
+        self.assertEqual(histogram.max, 10_000_000)
+        for quantile in (0.5, 0.9, 0.99):
+            expected = quantile * 10_000_000
+            self.assertLess(abs(histogram.percentile(quantile) - expected) / expected, 0.04)
+        self.assertIsNone(LatencyHistogram().percentile(0.5))
+
+
+class TestMonitorStats(unittest.TestCase):
+    def test_per_function_and_merged(self):
+        stats = MonitorStats()
+        stats.record("pickling", 100)  # Outside callbacks
+        stats.function = "f"
+        stats.record("pickling", 300)
+        stats.record("pickling", 500, "g")
+
+        phases = stats.to_dict()
+        self.assertEqual(set(phases["pickling"]["functions"]), {ALL_FUNCTIONS, "f", "g"})
+        self.assertEqual(phases["pickling"]["functions"]["f"]["count"], 1)
+        self.assertEqual(phases["pickling"]["total"]["count"], 3)
+        self.assertEqual(phases["pickling"]["total"]["total_ns"], 900)
+
+    def test_prometheus(self):
+        stats = MonitorStats()
+        stats.record("db_commit", 2_000_000, 'say "hi"')
+        text = stats.to_prometheus()
+        self.assertIn("# TYPE spacetimepy_monitor_phase_seconds summary", text)
+        self.assertIn('spacetimepy_monitor_phase_seconds_count{phase="db_commit",function="say \\"hi\\""} 1', text)
+        self.assertIn('spacetimepy_monitor_phase_seconds_sum{phase="db_commit",function="say \\"hi\\""} 0.002', text)
+
+
+class TestMonitorSelfInstrumentation(unittest.TestCase):
+    monitor_options = {}
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.textfile = os.path.join(self.tmp_dir.name, "spacetimepy.prom")
+        self.monitor = SpaceTimeMonitor(os.path.join(self.tmp_dir.name, "monitoring.db"), performance=True,
+                                        stats_textfile=self.textfile, **self.monitor_options)
+
+    def tearDown(self):
+        self.monitor.shutdown()
+        SpaceTimeMonitor._instance = None
+        if os.path.exists("monitoring_performance.json"):
+            os.remove("monitoring_performance.json")
+        self.tmp_dir.cleanup()
+
+    def test_phases(self):
+        self.monitor.start_session("stats")
+        measured(4)
+        self.monitor.end_session()
+
+        stats = self.monitor.stats()
+        self.assertTrue(stats["enabled"])
+        phases = stats["phases"]
+        for phase in ("function_starts", "function_returns", "line_events", "frame_inspection",
+                      "globals_analysis", "pickling", "hashing", "db_commit"):
+            self.assertIn(phase, phases)
+        self.assertEqual(phases["function_starts"]["functions"]["measured"]["count"], 1)
+        self.assertGreater(phases["line_events"]["functions"]["measured"]["count"], 1)
+        # The list of the return value is pickled and hashed within the return callback
+        self.assertIn("measured", phases["hashing"]["functions"])
+        self.assertGreater(stats["counters"]["line_captured_locals"], 0)
+
+        with open(self.textfile) as f:
+            self.assertIn('phase="line_events",function="measured"', f.read())
+
+
+class TestWriterSelfInstrumentation(TestMonitorSelfInstrumentation):
+    monitor_options = {"async_writer": True, "capture_backend": "sqlite"}
+
+
+if __name__ == '__main__':
+    unittest.main()
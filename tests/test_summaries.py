@@ -0,0 +1,111 @@
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from spacetimepy.core.models import Base, StoredObject
+from spacetimepy.core.reanimation import (
+    _load_execution_data_from_call_info,
+    _load_globals_from_call_info,
+)
+from spacetimepy.core.representation import ObjectManager
+from spacetimepy.core.summaries import CaptureBudget, ValueSummary
+
+
+class Node:
+    def __init__(self, child=None):
+        self.child = child
+
+
+class Unpicklable:
+    def __reduce__(self):
+        raise TypeError("Unpicklable cannot be pickled")
+
+
+class TestCaptureBudget(unittest.TestCase):
+    def test_from_option(self):
+        self.assertIsNone(CaptureBudget.from_option(None))
+        self.assertEqual(CaptureBudget.from_option(1024).max_bytes, 1024)
+        self.assertEqual(CaptureBudget.from_option({"max_length": 10}).max_length, 10)
+        with self.assertRaises(ValueError):
+            CaptureBudget(max_depth=0)
+
+    def test_check(self):
+        budget = CaptureBudget(max_bytes=100, max_length=10, max_depth=2)
+        self.assertIsNone(budget.check([1, [2, 3]]))
+        self.assertEqual(budget.check("x" * 101), "bytes")
+        self.assertEqual(budget.check(list(range(11))), "length")
+        self.assertEqual(budget.check({"a": [0] * 11}), "length")
+        self.assertEqual(budget.check([[[1]]]), "depth")
+        self.assertEqual(budget.check(Node(Node(Node()))), "depth")
+        cycle = []
+        cycle.append(cycle)
+        self.assertEqual(CaptureBudget(max_length=10).check(cycle), None)
+
+    def test_summarize(self):
+        budget = CaptureBudget(max_length=3, items=2)
+        summary = budget.summarize([4, 1, 3, 2], "length")
+        self.assertEqual((summary.type_name, summary.length), ("builtins.list", 4))
+        self.assertEqual((summary.minimum, summary.maximum, summary.mean), (1.0, 4.0, 2.5))
+        self.assertEqual((summary.head, summary.tail), (["4", "1"], ["3", "2"]))
+        self.assertIsNotNone(summary.content_hash)
+        self.assertNotEqual(summary.content_hash, budget.summarize([4, 1, 3, 5], "length").content_hash)
+        self.assertFalse(summary.rehydratable)
+
+    def test_summarize_without_pickling(self):
+        budget = CaptureBudget(max_length=10)
+        value = [Unpicklable()] + list(range(63_999))  # Every 1000th element is sampled
+        summary = budget.summarize(value, "length")
+        self.assertIsNotNone(summary.content_hash)
+        self.assertEqual(summary.content_hash, budget.summarize(value, "length").content_hash)
+        value[32_000] = -1
+        self.assertNotEqual(summary.content_hash, budget.summarize(value, "length").content_hash)
+        nodes = {i: Node() for i in range(100)}
+        self.assertIsNotNone(budget.summarize(nodes, "length").content_hash)
+
+
+class TestBoundedStorage(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine, expire_on_commit=False)()
+        self.manager = ObjectManager(self.session)
+        self.manager.budget = CaptureBudget(max_bytes=200, max_length=50)
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_values_within_budget(self):
+        ref = self.manager.store([1, 2, 3])
+        self.assertEqual(self.manager.rehydrate(ref), [1, 2, 3])
+
+    def test_values_over_budget(self):
+        long_list = list(range(100))
+        ref = self.manager.store(long_list)
+        summary = self.manager.rehydrate(ref)
+        self.assertIsInstance(summary, ValueSummary)
+        self.assertEqual((summary.reason, summary.length, summary.maximum), ("length", 100, 99.0))
+        self.assertEqual(self.session.get(StoredObject, ref).type_name, "ValueSummary")
+
+        # Over max_bytes once pickled
+        wide = {"key": "x" * 150, "other": "y" * 150}
+        summary = self.manager.rehydrate(self.manager.store(wide))
+        self.assertEqual(summary.reason, "bytes")
+        self.assertGreater(summary.size_bytes, 200)
+
+        # A change of the value is a new version of the same object
+        long_list.append(100)
+        new_ref = self.manager.store(long_list)
+        self.assertNotEqual(new_ref, ref)
+        self.assertEqual(self.manager.get_history(new_ref), [ref, new_ref])
+
+    def test_reanimation(self):
+        call_info = {"locals_refs": {"items": self.manager.store(list(range(100)))},
+                     "globals_refs": {"small": self.manager.store([1]), "large": self.manager.store("x" * 300)}}
+        with self.assertRaises(ValueError):
+            _load_execution_data_from_call_info(call_info, self.manager)
+        self.assertEqual(_load_globals_from_call_info(call_info, self.manager, None), {"small": [1]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+import threading
+import time
+import unittest
+from datetime import datetime
+
+from spacetimepy.core.models import FunctionCall, StackSnapshot, StoredObject, init_db
+from spacetimepy.core.representation import ObjectManager
+from spacetimepy.core.writer import (
+    CallEnd,
+    CallStart,
+    CaptureWriter,
+    CommitPolicy,
+    Snapshot,
+)
+
+
+class TestCaptureWriter(unittest.TestCase):
+    def setUp(self):
+        Session = init_db(":memory:")
+        self.session = Session()
+        self.object_manager = ObjectManager(self.session)
+        self.submitted_refs = set()
+
+    def tearDown(self):
+        self.session.close()
+
+    def _call_start(self, call_id, value):
+        ref, prepared = self.object_manager.prepare(value, self.submitted_refs)
+        objects = [prepared] if prepared is not None else []
+        self.submitted_refs.add(ref)
+        record = CallStart(
+            id=call_id, function="f", file=None, line=None, start_ns=time.time_ns(),
+            locals_refs={"x": ref}, globals_refs={}, code_definition_id=None,
+            call_metadata=None, parent_call_id=None, session_id=None,
+            order_in_session=None, order_in_parent=None
+        )
+        return objects, record
+
+    def _snapshot(self, snapshot_id, call_id, order, previous_id):
+        return [], Snapshot(
+            id=snapshot_id, function_call_id=call_id, line_number=order + 1, timestamp_ns=time.time_ns(),
+            locals_refs={}, globals_refs={}, order_in_call=order, previous_snapshot_id=previous_id
+        )
+
+    def _check_call(self, call_id, value, snapshot_count):
+        call = self.session.get(FunctionCall, call_id)
+        self.assertIsNotNone(call)
+        self.assertEqual(self.object_manager.rehydrate(call.locals_refs["x"]), value)
+        self.assertEqual(self.object_manager.rehydrate(call.return_ref), value)
+
+        # Walk the snapshot chain
+        chain = []
+        snapshot_id = call.first_snapshot_id
+        while snapshot_id is not None:
+            snapshot = self.session.get(StackSnapshot, snapshot_id)
+            chain.append(snapshot.order_in_call)
+            snapshot_id = snapshot.next_snapshot_id
+        self.assertEqual(chain, list(range(snapshot_count)))
+
+    def _submit_calls(self, writer, count, snapshots_per_call=3):
+        snapshot_id = 0
+        for call_id in range(1, count + 1):
+            value = [call_id, "value"]
+            self.assertTrue(writer.submit(*self._call_start(call_id, value)))
+            previous_id = None
+            for order in range(snapshots_per_call):
+                snapshot_id += 1
+                writer.submit(*self._snapshot(snapshot_id, call_id, order, previous_id))
+                previous_id = snapshot_id
+            ref, prepared = self.object_manager.prepare(value, self.submitted_refs)
+            writer.submit([prepared] if prepared else [], CallEnd(call_id, time.time_ns(), ref, {"done": True}))
+
+    def test_block_persists_in_order(self):
+        writer = CaptureWriter(self.session, self.object_manager, queue_size=2, batch_size=3)
+        self._submit_calls(writer, 10)
+        self.assertTrue(writer.flush(timeout=10))
+        writer.close()
+
+        self.assertEqual(writer.persisted, writer.submitted)
+        self.assertEqual(self.session.query(FunctionCall).count(), 10)
+        for call_id in range(1, 11):
+            self._check_call(call_id, [call_id, "value"], 3)
+        self.assertEqual(self.session.get(FunctionCall, 1).call_metadata, {"done": True})
+
+    def test_sqlite_backend(self):
+        writer = CaptureWriter(self.session, self.object_manager, queue_size=2, batch_size=3, capture_backend="sqlite")
+        self._submit_calls(writer, 10)
+        self.assertTrue(writer.flush(timeout=10))
+        writer.close()
+
+        self.assertEqual(self.session.query(FunctionCall).count(), 10)
+        for call_id in range(1, 11):
+            self._check_call(call_id, [call_id, "value"], 3)
+        call = self.session.get(FunctionCall, 1)
+        self.assertEqual(call.call_metadata, {"done": True})
+        self.assertIsInstance(call.start_time, datetime)
+        self.assertLessEqual(call.start_time, call.end_time)
+
+    def test_sqlite_backend_versions(self):
+        writer = CaptureWriter(self.session, self.object_manager, batch_size=100, capture_backend="sqlite")
+        value = [0]
+        refs = []
+        for call_id in range(1, 4):
+            value.append(call_id)
+            objects, record = self._call_start(call_id, value)
+            refs.append(record.locals_refs["x"])
+            writer.submit(objects, record)
+        self.assertTrue(writer.flush(timeout=10))
+
+        # Versions already on disk are looked up once the index forgot the identity
+        self.object_manager.index.clear()
+        value.append(4)
+        objects, record = self._call_start(4, value)
+        refs.append(record.locals_refs["x"])
+        writer.submit(objects, record)
+        self.assertTrue(writer.flush(timeout=10))
+        writer.close()
+
+        versions = [self.session.get(StoredObject, ref).version_number for ref in refs]
+        self.assertEqual(versions, [1, 2, 3, 4])
+        self.assertEqual(self.object_manager.get_history(refs[0]), refs)
+        # The ORM path continues the numbering of the sqlite backend
+        value.append(5)
+        self.assertEqual(self.session.get(StoredObject, self.object_manager.store(value)).version_number, 5)
+
+    def test_spill_preserves_events(self):
+        lock = threading.RLock()
+        writer = CaptureWriter(self.session, self.object_manager, lock=lock, queue_size=1, backpressure="spill")
+        # Hold the writer so that the queue fills up and events spill to disk
+        with lock:
+            self._submit_calls(writer, 5)
+        self.assertTrue(writer.flush(timeout=10))
+        writer.close()
+
+        self.assertGreater(writer.spilled, 0)
+        self.assertEqual(writer.dropped, 0)
+        for call_id in range(1, 6):
+            self._check_call(call_id, [call_id, "value"], 3)
+
+    def test_drop_reports_dropped_events(self):
+        lock = threading.RLock()
+        writer = CaptureWriter(self.session, self.object_manager, lock=lock, queue_size=1, backpressure="drop")
+        with lock:
+            results = [writer.submit(*self._call_start(call_id, call_id)) for call_id in range(1, 6)]
+        self.assertTrue(writer.flush(timeout=10))
+        writer.close()
+
+        self.assertIn(False, results)
+        self.assertEqual(writer.dropped, results.count(False))
+        self.assertEqual(self.session.query(FunctionCall).count(), results.count(True))
+
+    def test_rollback_forgets_submitted_refs(self):
+        writer = CaptureWriter(self.session, self.object_manager, on_rollback=self.submitted_refs.clear)
+        writer.submit(*self._call_start(1, [1, "value"]))
+        self.assertTrue(writer.flush(timeout=10))
+        # A second call with the same ID fails to insert and rolls back the value it referenced
+        writer.submit(*self._call_start(1, [2, "value"]))
+        self.assertTrue(writer.flush(timeout=10))
+        self.assertEqual(self.submitted_refs, set())
+
+        # The value is submitted again with the next record that references it
+        writer.submit(*self._call_start(2, [2, "value"]))
+        self.assertTrue(writer.flush(timeout=10))
+        writer.close()
+        call = self.session.get(FunctionCall, 2)
+        self.assertEqual(self.object_manager.rehydrate(call.locals_refs["x"]), [2, "value"])
+
+    def test_concurrent_submit_counts(self):
+        writer = CaptureWriter(self.session, self.object_manager, queue_size=16, backpressure="drop")
+
+        def submit(thread_id):
+            for call_id in range(thread_id * 1000, thread_id * 1000 + 200):
+                writer.submit(*self._call_start(call_id, call_id))
+
+        threads = [threading.Thread(target=submit, args=(thread_id,)) for thread_id in range(1, 9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(writer.flush(timeout=10))
+        writer.close()
+
+        self.assertEqual(writer.submitted, 1600)
+        self.assertEqual(writer.persisted + writer.dropped, writer.submitted)
+
+    def test_invalid_backpressure(self):
+        with self.assertRaises(ValueError):
+            CaptureWriter(self.session, self.object_manager, backpressure="wait")
+
+
+class TestCommitPolicy(unittest.TestCase):
+    def test_every_event(self):
+        policy = CommitPolicy.from_option("event")
+        self.assertTrue(policy.record())
+        policy.committed()
+        self.assertEqual(policy.stats(), {"events": 1, "commits": 1, "coalesced": 0, "pending": 0})
+
+    def test_every_n_events(self):
+        policy = CommitPolicy.from_option(3)
+        results = [policy.record() for _ in range(3)]
+        self.assertEqual(results, [False, False, True])
+        policy.committed()
+        self.assertEqual(policy.commits, 1)
+        self.assertEqual(policy.coalesced, 2)
+
+    def test_interval(self):
+        policy = CommitPolicy(every=None, interval_ms=0)
+        self.assertTrue(policy.record())
+        policy = CommitPolicy(every=None, interval_ms=60_000)
+        self.assertFalse(policy.record())
+
+    def test_session_only(self):
+        policy = CommitPolicy.from_option("session")
+        self.assertFalse(any(policy.record() for _ in range(1000)))
+        self.assertEqual(policy.pending, 1000)
+        policy.discarded()
+        self.assertEqual(policy.pending, 0)
+        self.assertEqual(policy.commits, 0)
+
+    def test_invalid_option(self):
+        with self.assertRaises(ValueError):
+            CommitPolicy.from_option("sometimes")
+        with self.assertRaises(ValueError):
+            CommitPolicy(every=0)
+
+    def test_writer_commits_on_flush(self):
+        Session = init_db(":memory:")
+        session = Session()
+        object_manager = ObjectManager(session)
+        policy = CommitPolicy.from_option("session")
+        writer = CaptureWriter(session, object_manager, commit_policy=policy)
+        for call_id in range(1, 4):
+            writer.submit([], CallStart(
+                id=call_id, function="f", file=None, line=None, start_ns=time.time_ns(),
+                locals_refs={}, globals_refs={}, code_definition_id=None, call_metadata=None,
+                parent_call_id=None, session_id=None, order_in_session=None, order_in_parent=None
+            ))
+        self.assertTrue(writer.flush(timeout=10))
+        writer.close()
+        self.assertEqual(policy.pending, 0)
+        self.assertEqual(policy.events, 3)
+        self.assertGreaterEqual(policy.commits, 1)
+        session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()